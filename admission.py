@@ -0,0 +1,196 @@
+"""
+Cost-based admission control for PDF operations.
+
+Each operation request is given a cost estimate from its operation, upload
+size and page count, in units of roughly one page of structural work. That
+cost is used twice:
+
+- it is charged to the client's budget, a token bucket refilled at a fixed
+  number of units per minute, so a client can send many cheap requests or a
+  few expensive ones;
+- the request must take a slot of its operation class before it runs.
+  Rasterizing operations (OCR, rendering, image recompression) share a few
+  "heavy" slots, everything else the larger "light" pool, so cheap requests
+  are not stuck behind a queue of heavy ones.
+
+A request that finds its class full waits a bounded time in a bounded queue.
+If the queue is full, the wait runs out or the client's budget is spent, it
+is refused with 429 and a Retry-After estimate. Like the metrics, all of this
+state is per process; each server worker enforces its own limits.
+"""
+import math
+import threading
+import time
+
+import metrics
+
+HEAVY = "heavy"
+LIGHT = "light"
+
+_MB = 1024 * 1024
+
+# operation -> (class, cost per page)
+OPERATIONS = {
+    "ocr": (HEAVY, 20.0),
+    "pdf_to_images": (HEAVY, 5.0),
+    "compress": (HEAVY, 2.0),
+    "extract_images": (LIGHT, 1.0),
+    "extract_text": (LIGHT, 1.0),
+    "images_to_pdf": (LIGHT, 1.0),  # pages are the uploaded images
+    "watermark": (LIGHT, 0.5),
+    "pipeline": (LIGHT, 0.5),  # with a compress preset, charged as compress
+    "merge": (LIGHT, 0.2),
+    "split": (LIGHT, 0.2),
+    "rearrange": (LIGHT, 0.2),
+    "rotate": (LIGHT, 0.2),
+    "encrypt": (LIGHT, 0.2),
+    "decrypt": (LIGHT, 0.2),
+    "inspect": (LIGHT, 0.1),
+    "documents": (LIGHT, 0.0),
+}
+COST_PER_MB = 1.0
+
+REJECTED = metrics.REGISTRY.counter(
+    "pdftoolkit_admission_rejected_total", "Requests refused by admission control.", ("operation", "reason")
+)
+QUEUE_SECONDS = metrics.REGISTRY.histogram(
+    "pdftoolkit_admission_wait_seconds", "Time admitted requests waited for a slot.", ("class",)
+)
+COST = metrics.REGISTRY.histogram(
+    "pdftoolkit_request_cost", "Estimated cost of operation requests.", ("operation",),
+    (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000),
+)
+
+
+def estimate_cost(operation, size, pages):
+    """Estimated cost of running operation on size bytes and pages pages."""
+    _, per_page = OPERATIONS.get(operation, (LIGHT, 1.0))
+    return round(1 + size / _MB * COST_PER_MB + pages * per_page, 1)
+
+
+def operation_class(operation):
+    return OPERATIONS.get(operation, (LIGHT, 1.0))[0]
+
+
+class Rejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class ClassLimiter:
+    """
+    A counting semaphore with a bounded queue. It remembers how long slots
+    are held, to tell refused clients when to come back.
+    """
+
+    def __init__(self, slots, max_waiting, wait_seconds):
+        self.slots = slots
+        self.max_waiting = max_waiting
+        self.wait_seconds = wait_seconds
+        self.running = 0
+        self.waiting = 0
+        self._held = 1.0  # moving average of seconds a slot is held
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting if needed; raises Rejected. Returns the wait."""
+        started = time.monotonic()
+        with self._cond:
+            if self.running >= self.slots:
+                if self.waiting >= self.max_waiting:
+                    raise Rejected("queue full", self._retry_after())
+                self.waiting += 1
+                try:
+                    deadline = started + self.wait_seconds
+                    while self.running >= self.slots:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise Rejected("queue timeout", self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+        return time.monotonic() - started
+
+    def release(self, held_seconds):
+        with self._cond:
+            self.running -= 1
+            self._held = 0.8 * self._held + 0.2 * held_seconds
+            self._cond.notify()
+
+    def _retry_after(self):
+        # Everyone queued ahead, served self.slots at a time.
+        return self._held * (self.waiting + 1) / max(1, self.slots)
+
+
+class ClientBudgets:
+    """
+    Per-client token buckets of cost units. A request is let in while the
+    bucket holds its cost, or is full: a request costing more than the whole
+    bucket is not refused forever, it leaves the client in debt instead.
+    """
+
+    def __init__(self, per_minute, burst, max_clients=10000):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = {}  # client -> (tokens, time)
+        self._lock = threading.Lock()
+
+    def charge(self, client, cost):
+        """Take cost from client's bucket; raises Rejected if it can't."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < min(cost, self.burst):
+                self._buckets[client] = (tokens, now)
+                raise Rejected("client budget", (min(cost, self.burst) - tokens) / self.rate)
+            self._buckets[client] = (tokens - cost, now)
+            if len(self._buckets) > self.max_clients:
+                self._forget_full(now)
+
+    def _forget_full(self, now):
+        # A client whose bucket has refilled is the same as one never seen.
+        for client, (tokens, updated) in list(self._buckets.items()):
+            if tokens + (now - updated) * self.rate >= self.burst:
+                del self._buckets[client]
+
+
+class Admission:
+    """The per-class limiters and client budgets of one app."""
+
+    def __init__(self, heavy_slots, light_slots, max_waiting, wait_seconds, client_per_minute, client_burst):
+        self.limiters = {
+            HEAVY: ClassLimiter(heavy_slots, max_waiting, wait_seconds),
+            LIGHT: ClassLimiter(light_slots, max_waiting, wait_seconds),
+        }
+        self.budgets = ClientBudgets(client_per_minute, client_burst) if client_per_minute > 0 else None
+
+    def admit(self, operation, client, cost, queued=False, charged_as=None):
+        """
+        Charge the client and take a slot for operation, or for the class of
+        charged_as when the request does that operation's work. Returns a
+        ticket to pass to release(), or raises Rejected. Queued requests
+        (background jobs, which have their own workers) are only charged.
+        """
+        COST.observe(cost, operation=operation)
+        try:
+            if self.budgets is not None:
+                self.budgets.charge(client, cost)
+            if queued:
+                return None
+            op_class = operation_class(charged_as or operation)
+            waited = self.limiters[op_class].acquire()
+        except Rejected as e:
+            REJECTED.inc(operation=operation, reason=e.reason)
+            raise
+        QUEUE_SECONDS.observe(waited, **{"class": op_class})
+        return op_class, time.monotonic()
+
+    def release(self, ticket):
+        if ticket is not None:
+            op_class, started = ticket
+            self.limiters[op_class].release(time.monotonic() - started)
@@ -0,0 +1,36 @@
+"""
+Heavy PDF and image backends, imported on first use.
+
+PyMuPDF and Pillow take a large share of the app's import time, and many
+requests never touch them: the home page, structural pikepdf operations,
+job polling. Modules import the proxies defined here instead of the real
+modules, so a worker only pays for a backend when a request first uses it.
+pikepdf is imported normally; nearly every operation and error handler needs
+it.
+"""
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module and imports it on the first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            # The import system's own lock makes concurrent first uses safe.
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+fitz = LazyModule("fitz")  # PyMuPDF
+Image = LazyModule("PIL.Image")
+ImageChops = LazyModule("PIL.ImageChops")
+ImageOps = LazyModule("PIL.ImageOps")
@@ -0,0 +1,295 @@
+"""
+Run a PDF operation over many files from the command line.
+
+    python batch.py compress scans/ --output-dir compressed/ -o preset=ebook
+    python batch.py ocr 'inbox/**/*.pdf' -o skip_text=1 --workers 4
+    python batch.py extract_text archive/ -o fmt=ndjson
+
+Inputs are PDF files, directories (searched recursively for *.pdf) and glob
+patterns. Every file is processed by the same function the web app's route
+calls, on a pool of --workers processes, without HTTP, multipart encoding or
+the upload size limit. With --output-dir, outputs mirror the inputs' layout
+under it (relative to each directory or glob argument); otherwise each goes
+next to its input as <name>.<operation><ext>.
+
+Results are streamed to a temporary file beside their destination and renamed
+into place once complete, so an interrupted run leaves no partial outputs.
+Run the same command again to resume: inputs whose output already exists and
+is newer are skipped, unless --force is given. Operations that start process
+pools of their own (OCR, rendering, compression) run them with
+--inner-workers processes per file, 1 by default, since the files are already
+processed in parallel. The exit status is 1 if any file failed.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
+import flask_app
+from zipstream import iter_zip
+
+_CHUNK_SIZE = 1024 * 1024
+_POOL_SETTINGS = ("OCR_WORKERS", "RENDER_WORKERS", "COMPRESS_WORKERS", "EXTRACT_WORKERS", "SPLIT_WORKERS")
+_TEXT_EXTENSIONS = {"text": ".txt", "json": ".json", "ndjson": ".ndjson"}
+
+
+def _flag(value):
+    return value.lower() in ("1", "true", "on", "yes")
+
+
+def _chunks(output):
+    output.seek(0)
+    return iter(lambda: output.read(_CHUNK_SIZE), b"")
+
+
+# operation -> (function returning the result as bytes chunks, output extension, option types)
+OPERATIONS = {
+    "compress": (lambda source, **options: _chunks(flask_app.compress_pdf(source, **options)), ".pdf", {"preset": str}),
+    "ocr": (
+        lambda source, **options: _chunks(flask_app.ocr_pdf(source, **options)),
+        ".pdf",
+        {"dpi": int, "skip_text": _flag},
+    ),
+    "extract_text": (flask_app.extract_text_chunks, ".txt", {"pages": str, "fmt": str, "detail": str}),
+    "extract_images": (
+        lambda source, **options: iter_zip(flask_app.extract_image_entries(source, **options)),
+        ".zip",
+        {"min_size": int},
+    ),
+    "pdf_to_images": (
+        lambda source, **options: iter_zip(flask_app.pdf_to_image_entries(source, **options)),
+        ".zip",
+        {"dpi": int, "fmt": str, "quality": int, "pages": str, "grayscale": _flag},
+    ),
+    "split": (
+        lambda source, ranges: iter_zip(flask_app.split_pdf_entries(source, ranges)[1]),
+        ".zip",
+        {"ranges": str},
+    ),
+    "rotate": (lambda source, **options: _chunks(flask_app.rotate_pdf(source, **options)), ".pdf", {"degree": int}),
+    "watermark": (
+        lambda source, **options: _chunks(flask_app.add_watermark(source, **options)),
+        ".pdf",
+        {
+            "text": str, "opacity": float, "position": str, "angle": float, "font_size": float, "color": str,
+            "scale": float, "pages": str,
+        },
+    ),
+    "pipeline": (
+        lambda source, steps: _chunks(flask_app.run_pipeline(source, flask_app.parse_pipeline_steps(steps))),
+        ".pdf",
+        {"steps": str},
+    ),
+    "encrypt": (lambda source, **options: _chunks(flask_app.encrypt_pdf(source, **options)), ".pdf", {"password": str}),
+    "decrypt": (lambda source, **options: _chunks(flask_app.decrypt_pdf(source, **options)), ".pdf", {"password": str}),
+}
+
+
+# (operation, option) -> the values it accepts, checked before any file is read.
+_CHOICES = {
+    ("compress", "preset"): flask_app.COMPRESSION_PRESETS,
+    ("extract_text", "fmt"): flask_app.TEXT_FORMATS,
+    ("extract_text", "detail"): ("blocks", "words"),
+    ("pdf_to_images", "fmt"): flask_app.IMAGE_FORMATS,
+}
+
+
+def parse_options(operation, pairs):
+    """Turn NAME=VALUE strings into keyword arguments for operation; raises ValueError."""
+    types = OPERATIONS[operation][2]
+    options = {}
+    for pair in pairs:
+        name, sep, value = pair.partition("=")
+        if not sep or name not in types:
+            raise ValueError(f"{operation} options are NAME=VALUE with NAME one of {', '.join(types)}; got {pair!r}")
+        options[name] = types[name](value)
+        choices = _CHOICES.get((operation, name))
+        if choices is not None and options[name] not in choices:
+            raise ValueError(f"{operation} option {name} must be one of {', '.join(choices)}; got {value!r}")
+    if operation == "pipeline":
+        flask_app.parse_pipeline_steps(options.get("steps"))
+    elif operation == "watermark":
+        flask_app._watermark_options(**{name: value for name, value in options.items() if name != "text"})
+    return options
+
+
+def output_extension(operation, options):
+    if operation == "extract_text":
+        return _TEXT_EXTENSIONS.get(options.get("fmt", "text"), ".txt")
+    return OPERATIONS[operation][1]
+
+
+def _glob_root(pattern):
+    # The leading directories of a pattern, before any wildcard.
+    parts = []
+    for part in pattern.split(os.sep):
+        if any(char in part for char in "*?["):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+
+def find_inputs(specs):
+    """
+    Yield (path, root) for every PDF named by specs, each once. Outputs are
+    laid out relative to root under --output-dir.
+    """
+    seen = set()
+    for spec in specs:
+        if os.path.isdir(spec):
+            found = (
+                (os.path.join(dirpath, name), spec)
+                for dirpath, dirnames, filenames in sorted(os.walk(spec))
+                for name in sorted(filenames)
+                if name.lower().endswith(".pdf")
+            )
+        elif any(char in spec for char in "*?["):
+            root = _glob_root(spec)
+            found = ((path, root) for path in sorted(glob.glob(spec, recursive=True)) if os.path.isfile(path))
+        else:
+            found = [(spec, os.path.dirname(spec))]
+        for path, root in found:
+            key = os.path.realpath(path)
+            if key not in seen:
+                seen.add(key)
+                yield path, root
+
+
+def output_path(source, root, operation, extension, output_dir=None):
+    stem = os.path.splitext(source)[0]
+    if output_dir is None:
+        return f"{stem}.{operation}{extension}"
+    return os.path.join(output_dir, os.path.relpath(stem, root) + extension)
+
+
+def _is_done(source, target):
+    try:
+        return os.path.getmtime(target) >= os.path.getmtime(source)
+    except OSError:
+        return False
+
+
+def _init_worker(settings):
+    # Operations read their settings from the default app outside a request.
+    flask_app.app.config.update(settings)
+
+
+def process_file(operation, source, target, options):
+    """Run operation on source, streaming its result to target. Returns the seconds taken."""
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.part"
+    try:
+        with open(source, "rb") as f, open(tmp_path, "wb") as out:
+            for chunk in OPERATIONS[operation][0](f, **options):
+                out.write(chunk)
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return time.perf_counter() - started
+
+
+def run(operation, specs, options, output_dir=None, workers=1, inner_workers=1, force=False, log=print):
+    """
+    Process every input named by specs. Returns {"done", "skipped",
+    "failed"} counts; log receives one progress line per file.
+    """
+    extension = output_extension(operation, options)
+    tasks = []
+    skipped = 0
+    for source, root in find_inputs(specs):
+        if output_dir is None and source.endswith(f".{operation}{extension}"):
+            continue  # an output of an earlier run
+        target = output_path(source, root, operation, extension, output_dir)
+        if os.path.abspath(target) == os.path.abspath(source):
+            raise ValueError(f"Output would overwrite its input: {source}")
+        if not force and _is_done(source, target):
+            skipped += 1
+        else:
+            tasks.append((source, target))
+    log(f"{operation}: {len(tasks)} to process, {skipped} already done")
+
+    settings = dict.fromkeys(_POOL_SETTINGS, inner_workers)
+    counts = {"done": 0, "skipped": skipped, "failed": 0}
+    started = time.perf_counter()
+    with _in_process(settings) if workers <= 1 else nullcontext():
+        for number, (source, target, result) in enumerate(_results(operation, tasks, options, workers, settings), 1):
+            try:
+                outcome = f"ok {result():.2f}s"
+                counts["done"] += 1
+            except Exception as e:
+                outcome = f"FAILED {type(e).__name__}: {e}"
+                counts["failed"] += 1
+            rate = number / (time.perf_counter() - started)
+            log(f"[{number}/{len(tasks)}] {outcome} {source} -> {target} ({rate:.2f} files/s)")
+    return counts
+
+
+@contextmanager
+def _in_process(settings):
+    saved = {name: flask_app.app.config[name] for name in settings}
+    _init_worker(settings)
+    try:
+        yield
+    finally:
+        flask_app.app.config.update(saved)
+
+
+def _results(operation, tasks, options, workers, settings):
+    """Yield (source, target, result) as files finish; result() returns the seconds taken or raises."""
+    if workers <= 1:
+        for source, target in tasks:
+            yield source, target, partial(process_file, operation, source, target, options)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(settings,)) as executor:
+        futures = {
+            executor.submit(process_file, operation, source, target, options): (source, target)
+            for source, target in tasks
+        }
+        for future in as_completed(futures):
+            yield (*futures[future], future.result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("operation", choices=sorted(OPERATIONS))
+    parser.add_argument("inputs", nargs="+", help="PDF files, directories or glob patterns")
+    parser.add_argument("--output-dir", help="mirror the inputs' layout here instead of writing next to them")
+    parser.add_argument("-o", "--option", action="append", default=[], metavar="NAME=VALUE",
+                        help="operation option, e.g. preset=ebook, dpi=150, fmt=ndjson; repeatable")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="files processed in parallel")
+    parser.add_argument("--inner-workers", type=int, default=1, help="pool size of each operation, per file")
+    parser.add_argument("--force", action="store_true", help="redo files whose output is already there")
+    args = parser.parse_args(argv)
+
+    try:
+        options = parse_options(args.operation, args.option)
+        started = time.perf_counter()
+        counts = run(
+            args.operation,
+            args.inputs,
+            options,
+            output_dir=args.output_dir,
+            workers=args.workers,
+            inner_workers=args.inner_workers,
+            force=args.force,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    print(
+        f"{counts['done']} done, {counts['skipped']} skipped, {counts['failed']} failed "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
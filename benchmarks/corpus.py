@@ -0,0 +1,150 @@
+"""
+Deterministic synthetic PDF corpus for the benchmarks.
+
+Every document is generated from a fixed seed, so the same kind and size
+always produce byte-identical files and results stay comparable between
+runs and machines. Generated files are kept in a corpus directory and only
+rebuilt when missing.
+"""
+import io
+import os
+import random
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+# Pages per document for each size; "many" documents get ten times as many.
+SIZES = {"small": 4, "medium": 40, "large": 400}
+KINDS = ("text", "image", "scanned", "many")
+
+_WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+    "dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea "
+    "commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur"
+).split()
+
+
+def _paragraph(rng, words):
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def _photo(rng, width, height):
+    """A smooth, photo-like RGB image: random blobs over a gradient."""
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for _ in range(24):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randrange(width // 16, width // 4)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    return img
+
+
+def _jpeg(img, quality=80):
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+def text_pdf(pages, seed=0):
+    """Dense, multi-column text pages with an outline entry per page."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    toc = []
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 60), f"Section {number + 1}", fontsize=16)
+        for column in range(2):
+            rect = fitz.Rect(72 + column * 240, 80, 290 + column * 240, 770)
+            page.insert_textbox(rect, _paragraph(rng, 420), fontsize=8)
+        toc.append([1, f"Section {number + 1}", number + 1])
+    doc.set_toc(toc)
+    return _finish(doc)
+
+
+def image_pdf(pages, seed=0):
+    """Pages with a caption and three JPEG photos, one of them shared by every page."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    logo = _jpeg(_photo(rng, 200, 100))
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 60), f"Figure page {number + 1}", fontsize=14)
+        page.insert_image(fitz.Rect(72, 80, 272, 180), stream=logo)
+        page.insert_image(fitz.Rect(72, 200, 523, 500), stream=_jpeg(_photo(rng, 1200, 800)))
+        page.insert_image(fitz.Rect(72, 520, 523, 770), stream=_jpeg(_photo(rng, 900, 500)))
+    return _finish(doc)
+
+
+def scanned_pdf(pages, seed=0, dpi=150):
+    """Pages that are only a grayscale image of rendered text, with no text layer."""
+    source = fitz.open(stream=text_pdf(pages, seed), filetype="pdf")
+    doc = fitz.open()
+    for page in source:
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        img = Image.frombytes("L", (pix.width, pix.height), pix.samples).rotate(0.4, fillcolor=255)
+        scan = doc.new_page(width=page.rect.width, height=page.rect.height)
+        scan.insert_image(scan.rect, stream=_jpeg(img, quality=70))
+    source.close()
+    return _finish(doc)
+
+
+def many_pdf(pages, seed=0):
+    """Many short pages: stresses per-page overhead rather than content."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {number + 1}: {_paragraph(rng, 8)}", fontsize=11)
+    return _finish(doc)
+
+
+def _finish(doc):
+    data = doc.tobytes(garbage=3, deflate=True, no_new_id=True)
+    doc.close()
+    return data
+
+
+_GENERATORS = {"text": text_pdf, "image": image_pdf, "scanned": scanned_pdf, "many": many_pdf}
+
+
+def page_count(kind, size):
+    return SIZES[size] * (10 if kind == "many" else 1)
+
+
+def build(kind, size):
+    """Return the bytes of one corpus document."""
+    return _GENERATORS[kind](page_count(kind, size))
+
+
+def ensure_corpus(root, sizes=SIZES, kinds=KINDS):
+    """
+    Make sure every requested document exists under root and return
+    {(kind, size): path}.
+    """
+    os.makedirs(root, exist_ok=True)
+    paths = {}
+    for size in sizes:
+        for kind in kinds:
+            path = os.path.join(root, f"{kind}-{size}.pdf")
+            if not os.path.exists(path):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(build(kind, size))
+                os.replace(tmp_path, path)
+            paths[(kind, size)] = path
+    return paths
+
+
+def sample_images(count, seed=0):
+    """JPEG and PNG photos for images_to_pdf, as (filename, bytes)."""
+    rng = random.Random(seed)
+    images = []
+    for index in range(count):
+        img = _photo(rng, 1024, 768)
+        if index % 4 == 3:
+            output = io.BytesIO()
+            img.save(output, format="PNG")
+            images.append((f"photo_{index}.png", output.getvalue()))
+        else:
+            images.append((f"photo_{index}.jpg", _jpeg(img)))
+    return images
@@ -0,0 +1,426 @@
+"""
+Benchmark every PDF operation, and the HTTP routes, on the synthetic corpus.
+
+    python -m benchmarks.run                                # small and medium corpus
+    python -m benchmarks.run --sizes large --filter compress
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Each case runs in a forked process, so memory figures are not polluted by
+earlier cases. A case is timed over --repeat runs after a warm-up run, then
+run once more under tracemalloc. The report records the median wall time,
+pages per second, the peak traced Python allocation and the peak RSS of the
+process and of any worker processes it started. With --baseline the report
+is compared against a stored one; a result slower or bigger than the
+baseline by more than --threshold is a regression, and the exit status is 1.
+The result and OCR page caches are disabled so that every run does the work,
+and routes are served by an app without admission limits, so that repeated
+runs are never refused.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fitz  # PyMuPDF
+import pikepdf
+from werkzeug.datastructures import FileStorage
+
+import flask_app
+from benchmarks import corpus
+
+DEFAULT_SIZES = ("small", "medium")
+# Settings of the app the routes are benchmarked on.
+APP_CONFIG = {
+    "TESTING": True,
+    "RESULT_CACHE_MAX_BYTES": 0,
+    "OCR_CACHE_MAX_BYTES": 0,
+    "CLIENT_COST_PER_MINUTE": 0,
+    "MAX_PAGES": 10 ** 9,
+    "MAX_REQUEST_COST": 10 ** 12,
+}
+# Differences smaller than this are noise, whatever the ratio.
+_MIN_SECONDS = 0.005
+_MIN_MB = 1.0
+
+
+class Document:
+    """A corpus document, or for images_to_pdf a set of photos."""
+
+    def __init__(self, kind, size, path=None):
+        self.kind = kind
+        self.size = size
+        self.path = path
+        if kind == "photos":
+            self.images = corpus.sample_images(corpus.SIZES[size])
+            self.data = None
+            self.pages = len(self.images)
+        else:
+            with open(path, "rb") as f:
+                self.data = f.read()
+            with fitz.open(stream=self.data, filetype="pdf") as doc:
+                self.pages = len(doc)
+
+    def stream(self):
+        return io.BytesIO(self.data)
+
+    def uploads(self):
+        return [FileStorage(io.BytesIO(data), filename=name) for name, data in self.images]
+
+
+def _encrypted(doc):
+    return flask_app.encrypt_pdf(doc.stream(), "secret").getvalue()
+
+
+def _reversed_order(doc):
+    return ",".join(str(n) for n in range(doc.pages, 0, -1))
+
+
+_PIPELINE = [
+    {"op": "rearrange", "order": "1"},
+    {"op": "rotate", "degree": 90},
+    {"op": "watermark", "text": "DRAFT"},
+    {"op": "compress", "preset": "ebook"},
+]
+
+
+def _pipeline_steps(doc):
+    steps = [dict(step) for step in _PIPELINE]
+    steps[0]["order"] = _reversed_order(doc)
+    return flask_app.parse_pipeline_steps(json.dumps(steps))
+
+
+# name -> (document kinds, factory). A factory does any setup for a document
+# and returns the zero-argument callable that is timed.
+FUNCTIONS = {
+    "encrypt_pdf": (("text", "image", "many"), lambda doc: lambda: flask_app.encrypt_pdf(doc.stream(), "secret")),
+    "decrypt_pdf": (
+        ("text", "image"),
+        lambda doc: (lambda data: lambda: flask_app.decrypt_pdf(io.BytesIO(data), "secret"))(_encrypted(doc)),
+    ),
+    "merge_pdfs": (("text", "image"), lambda doc: lambda: flask_app.merge_pdfs([doc.stream() for _ in range(3)])),
+    "merge_pdfs[dedupe]": (
+        ("image",),
+        lambda doc: lambda: flask_app.merge_pdfs([doc.stream() for _ in range(3)], dedupe=True, bookmarks=True),
+    ),
+    "split_pdf": (("text", "many"), lambda doc: lambda: flask_app.split_pdf(doc.stream(), "every 10 pages")),
+    "compress_pdf": (("text", "image", "scanned"), lambda doc: lambda: flask_app.compress_pdf(doc.stream())),
+    "compress_pdf[ebook]": (
+        ("image", "scanned"),
+        lambda doc: lambda: flask_app.compress_pdf(doc.stream(), preset="ebook"),
+    ),
+    "extract_text_from_pdf": (("text", "many"), lambda doc: lambda: flask_app.extract_text_from_pdf(doc.stream())),
+    "extract_images_from_pdf": (
+        ("image", "scanned"),
+        lambda doc: lambda: flask_app.extract_images_from_pdf(doc.stream()),
+    ),
+    "ocr_pdf": (("scanned",), lambda doc: lambda: flask_app.ocr_pdf(doc.stream())),
+    "rearrange_pdf_pages": (
+        ("text", "many"),
+        lambda doc: (lambda order: lambda: flask_app.rearrange_pdf_pages(doc.stream(), order))(_reversed_order(doc)),
+    ),
+    "rotate_pdf": (("text", "many"), lambda doc: lambda: flask_app.rotate_pdf(doc.stream(), 90)),
+    "pdf_to_images": (("text", "image"), lambda doc: lambda: flask_app.pdf_to_images(doc.stream())),
+    "images_to_pdf": (("photos",), lambda doc: lambda: flask_app.images_to_pdf(doc.uploads())),
+    "add_watermark": (("text", "many"), lambda doc: lambda: flask_app.add_watermark(doc.stream(), text="DRAFT")),
+    "run_pipeline": (
+        ("text", "image"),
+        lambda doc: (lambda steps: lambda: flask_app.run_pipeline(doc.stream(), steps))(_pipeline_steps(doc)),
+    ),
+}
+
+
+def _pdf_field(doc, name="pdf"):
+    return {name: (doc.stream(), "input.pdf")}
+
+
+# route -> (document kinds, form builder)
+ROUTES = {
+    "/encrypt": (("text",), lambda doc: {**_pdf_field(doc, "pdfs"), "password": "secret"}),
+    "/decrypt": (
+        ("text",),
+        lambda doc: (lambda data: lambda: {"pdfs": (io.BytesIO(data), "input.pdf"), "password": "secret"})(
+            _encrypted(doc)
+        ),
+    ),
+    "/merge": (("text",), lambda doc: {"pdfs": [(doc.stream(), f"input{i}.pdf") for i in range(3)]}),
+    "/split": (("text",), lambda doc: {**_pdf_field(doc), "pages": "every 10 pages"}),
+    "/compress": (("image",), lambda doc: {**_pdf_field(doc), "preset": "ebook"}),
+    "/extract_text": (("text",), lambda doc: {**_pdf_field(doc), "format": "ndjson"}),
+    "/extract_images": (("image",), lambda doc: _pdf_field(doc)),
+    "/ocr": (("scanned",), lambda doc: _pdf_field(doc)),
+    "/rearrange": (("text",), lambda doc: {**_pdf_field(doc), "order": _reversed_order(doc)}),
+    "/rotate": (("many",), lambda doc: {**_pdf_field(doc), "degree": 90}),
+    "/pdf_to_images": (("text",), lambda doc: {**_pdf_field(doc), "dpi": 72}),
+    "/images_to_pdf": (("photos",), lambda doc: {"images": [(io.BytesIO(d), name) for name, d in doc.images]}),
+    "/watermark": (("many",), lambda doc: {**_pdf_field(doc), "text": "DRAFT", "position": "tile"}),
+    "/pipeline": (("image",), lambda doc: {**_pdf_field(doc), "steps": json.dumps(_PIPELINE[1:])}),
+}
+
+
+_app = None
+
+
+def _bench_app():
+    global _app
+    if _app is None:
+        _app = flask_app.create_app(APP_CONFIG)
+    return _app
+
+
+def _route_factory(route, build_form):
+    def factory(doc):
+        form = build_form(doc)
+        if callable(form):  # setup was done once; call for a fresh form
+            make_form = form
+        else:
+            make_form = lambda: build_form(doc)  # noqa: E731
+        client = _bench_app().test_client()
+
+        def run():
+            response = client.post(route, data=make_form())
+            body = response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f"{route} returned {response.status_code}: {body[:200]!r}")
+            return body
+
+        return run
+
+    return factory
+
+
+def cases(sizes, name_filter=None):
+    """Yield (case name, benchmark name, kind, size, factory) for every selected case."""
+    benchmarks = [(name, kinds, factory) for name, (kinds, factory) in FUNCTIONS.items()]
+    benchmarks += [
+        (f"POST {route}", kinds, _route_factory(route, build_form)) for route, (kinds, build_form) in ROUTES.items()
+    ]
+    for name, kinds, factory in benchmarks:
+        for size in sizes:
+            for kind in kinds:
+                case = f"{name}[{kind}-{size}]"
+                if name_filter and name_filter not in case:
+                    continue
+                yield case, name, kind, size, factory
+
+
+def _output_size(result):
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, io.BytesIO):
+        return len(result.getbuffer())
+    if isinstance(result, (bytes, bytearray)):
+        return len(result)
+    return None
+
+
+def _peak_rss_mb(who):
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def measure(factory, doc, repeat=3, warmup=1):
+    """
+    Run one benchmark and return its measurements.
+    """
+    run = factory(doc)
+    for _ in range(warmup):
+        run()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = run()
+        times.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds = statistics.median(times)
+    return {
+        "seconds": round(seconds, 5),
+        "min_seconds": round(min(times), 5),
+        "runs": repeat,
+        "pages": doc.pages,
+        "pages_per_second": round(doc.pages / seconds, 1) if seconds else None,
+        "output_bytes": _output_size(result),
+        "peak_traced_mb": round(traced_peak / (1024 * 1024), 2),
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF),
+        "workers_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def _skip_reason(name):
+    if "ocr" in name:
+        try:
+            flask_app._ensure_tesseract_available()
+        except RuntimeError:
+            return "tesseract is not installed"
+    return None
+
+
+def _run_case(factory, doc, repeat, warmup):
+    try:
+        return measure(factory, doc, repeat, warmup)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
+
+def _case_in_child(conn, factory, doc, repeat, warmup):
+    conn.send(_run_case(factory, doc, repeat, warmup))
+    conn.close()
+
+
+def run_isolated(factory, doc, repeat, warmup):
+    """Run a case in a forked process where available, otherwise inline."""
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return _run_case(factory, doc, repeat, warmup)
+    context = multiprocessing.get_context("fork")
+    parent, child = context.Pipe(duplex=False)
+    process = context.Process(target=_case_in_child, args=(child, factory, doc, repeat, warmup))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {"error": f"benchmark process died with exit code {process.exitcode}"}
+    process.join()
+    return result
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pikepdf": pikepdf.__version__,
+        "pymupdf": fitz.VersionBind,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def run(sizes=DEFAULT_SIZES, name_filter=None, repeat=3, warmup=1, corpus_dir=None, isolate=True, log=None):
+    """
+    Run the selected cases and return a report dict.
+    """
+    corpus_dir = corpus_dir or os.path.join(tempfile.gettempdir(), "pdftoolkit_bench_corpus")
+    selected = list(cases(sizes, name_filter))
+    kinds = {kind for _, _, kind, _, _ in selected if kind != "photos"}
+    paths = corpus.ensure_corpus(corpus_dir, sizes=sizes, kinds=sorted(kinds))
+    documents = {}
+
+    results = {}
+    # Functions called directly use the default app's settings.
+    ocr_cache_limit = flask_app.app.config["OCR_CACHE_MAX_BYTES"]
+    flask_app.app.config["OCR_CACHE_MAX_BYTES"] = 0
+    try:
+        for case, name, kind, size, factory in selected:
+            if (kind, size) not in documents:
+                documents[(kind, size)] = Document(kind, size, paths.get((kind, size)))
+            doc = documents[(kind, size)]
+            reason = _skip_reason(name)
+            if reason:
+                results[case] = {"skipped": reason}
+            elif isolate:
+                results[case] = run_isolated(factory, doc, repeat, warmup)
+            else:
+                results[case] = _run_case(factory, doc, repeat, warmup)
+            if log:
+                log(case, results[case])
+    finally:
+        flask_app.app.config["OCR_CACHE_MAX_BYTES"] = ocr_cache_limit
+    return {"environment": environment(), "results": results}
+
+
+def compare(report, baseline, threshold=0.15):
+    """
+    Compare a report with a baseline report. Returns a list of
+    (case, metric, baseline value, new value, ratio, regressed) rows for
+    every case measured in both.
+    """
+    rows = []
+    for case, result in report["results"].items():
+        base = baseline.get("results", {}).get(case)
+        if not base or "seconds" not in base or "seconds" not in result:
+            continue
+        for metric, floor in (("seconds", _MIN_SECONDS), ("peak_traced_mb", _MIN_MB), ("peak_rss_mb", _MIN_MB)):
+            old, new = base.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            ratio = new / old if old else None
+            regressed = new - old > max(old * threshold, floor)
+            rows.append((case, metric, old, new, ratio, regressed))
+    return rows
+
+
+def _print_result(case, result):
+    if "seconds" in result:
+        print(
+            f"{case:<48} {result['seconds']:>9.4f}s {result['pages_per_second'] or 0:>9.1f} p/s "
+            f"{result['peak_traced_mb']:>8.2f} MB traced {result['peak_rss_mb']:>8.1f} MB rss"
+        )
+    else:
+        print(f"{case:<48} {result.get('skipped') or result.get('error')}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(DEFAULT_SIZES), help="comma-separated: small, medium, large")
+    parser.add_argument("--filter", help="only run cases whose name contains this text")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--corpus-dir", help="where generated PDFs are kept")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against this JSON report")
+    parser.add_argument("--save-baseline", help="also write the report here, as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown or growth (0.15 = 15%%)")
+    parser.add_argument("--no-isolate", action="store_true", help="run cases in this process")
+    args = parser.parse_args(argv)
+
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    unknown = [size for size in sizes if size not in corpus.SIZES]
+    if unknown:
+        parser.error(f"unknown size: {unknown[0]}")
+
+    report = run(
+        sizes,
+        args.filter,
+        repeat=args.repeat,
+        warmup=args.warmup,
+        corpus_dir=args.corpus_dir,
+        isolate=not args.no_isolate,
+        log=_print_result,
+    )
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = compare(report, baseline, args.threshold)
+    regressions = [row for row in rows if row[5]]
+    print(f"\nCompared {len({row[0] for row in rows})} cases with {args.baseline}")
+    for case, metric, old, new, ratio, _ in regressions:
+        print(f"REGRESSION {case} {metric}: {old} -> {new} ({ratio:.2f}x)")
+    if not regressions:
+        print("No regressions.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Benchmark how quickly a fresh worker process becomes useful.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --repeat 10 --save-baseline startup.json
+    python -m benchmarks.startup --baseline startup.json
+
+Every sample is a new interpreter that imports flask_app and serves one
+request, the way a newly spawned or recycled server worker does. The report
+records the median import time, the median time from interpreter start to
+the first response for each route, the process's peak RSS and which heavy
+backends (PyMuPDF, Pillow, pytesseract) had been loaded by the end. It has
+the same shape as benchmarks.run reports, so --baseline comparison works the
+same way.
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROUTES = ("GET /", "POST /rotate", "POST /extract_text")
+BACKENDS = ("fitz", "PIL.Image", "pytesseract")
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _blank_pdf():
+    import pikepdf
+
+    pdf = pikepdf.new()
+    pdf.add_blank_page()
+    output = io.BytesIO()
+    pdf.save(output)
+    return output.getvalue()
+
+
+def _child(route):
+    """Runs in the fresh interpreter: import the app, serve route, report."""
+    import resource
+
+    started = time.perf_counter()
+    import flask_app
+
+    imported = time.perf_counter()
+    method, path = route.split(" ", 1)
+    client = flask_app.app.test_client()
+    if method == "GET":
+        response = client.get(path)
+    else:
+        form = {"pdf": (io.BytesIO(_blank_pdf()), "blank.pdf")}
+        if path == "/rotate":
+            form["degree"] = "90"
+        response = client.post(path, data=form)
+    response.get_data()
+    response.close()
+    finished = time.perf_counter()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    json.dump(
+        {
+            "status": response.status_code,
+            "import_seconds": imported - started,
+            "first_response_seconds": finished - started,
+            "peak_rss_mb": round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+            "backends_loaded": [name for name in BACKENDS if name in sys.modules],
+        },
+        sys.stdout,
+    )
+    sys.stdout.write("\n")
+
+
+def sample(route):
+    """Start a fresh interpreter for one route and return its measurements."""
+    jobs_dir = os.path.join(tempfile.gettempdir(), "pdftoolkit_bench_jobs")
+    env = dict(os.environ, RESULT_CACHE_MAX_BYTES="0", JOBS_DIR=jobs_dir)
+    proc = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", route],
+        cwd=_ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"startup sample for {route} failed: {proc.stderr.strip()[-500:]}")
+    # PyMuPDF prints a deprecation notice on stdout; the report is the last line.
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def run(routes=ROUTES, repeat=5, log=None):
+    """Return a report in the benchmarks.run format."""
+    from benchmarks.run import environment
+
+    results = {}
+    imports = []
+    for route in routes:
+        samples = [sample(route) for _ in range(repeat)]
+        imports += [s["import_seconds"] for s in samples]
+        times = [s["first_response_seconds"] for s in samples]
+        results[f"startup first {route}"] = {
+            "seconds": round(statistics.median(times), 5),
+            "min_seconds": round(min(times), 5),
+            "runs": repeat,
+            "status": samples[-1]["status"],
+            "peak_rss_mb": max(s["peak_rss_mb"] for s in samples),
+            "backends_loaded": samples[-1]["backends_loaded"],
+        }
+        if log:
+            log(f"startup first {route}", results[f"startup first {route}"])
+    results["startup import"] = {
+        "seconds": round(statistics.median(imports), 5),
+        "min_seconds": round(min(imports), 5),
+        "runs": len(imports),
+    }
+    if log:
+        log("startup import", results["startup import"])
+    return {"environment": environment(), "results": results}
+
+
+def _print_result(case, result):
+    backends = result.get("backends_loaded")
+    loaded = f"  loads {', '.join(backends) or 'no backends'}" if backends is not None else ""
+    print(f"{case:<36} {result['seconds']:>8.4f}s{loaded}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh processes per route")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="compare against this JSON report")
+    parser.add_argument("--save-baseline", help="also write the report here, as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown or growth (0.15 = 15%%)")
+    args = parser.parse_args(argv)
+    if args.child:
+        _child(args.child)
+        return 0
+
+    from benchmarks.run import compare
+
+    report = run(repeat=args.repeat, log=_print_result)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = [row for row in compare(report, baseline, args.threshold) if row[5]]
+    for case, metric, old, new, ratio, _ in regressions:
+        print(f"REGRESSION {case} {metric}: {old} -> {new} ({ratio:.2f}x)")
+    if not regressions:
+        print("No regressions.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
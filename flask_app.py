@@ -1,262 +1,1186 @@
-from flask import Flask, request, send_file, render_template, redirect, url_for
-from pikepdf import Pdf, Encryption, Permissions, PdfError
+from flask import (
+    Blueprint, Flask, Response, current_app, g, has_app_context, make_response, request, send_file, render_template,
+    url_for, jsonify, stream_with_context,
+)
+from werkzeug.datastructures import FileStorage, ImmutableMultiDict
+from pikepdf import (
+    Pdf, Encryption, Permissions, PdfError, PasswordError, PdfImage, AccessMode, StreamDecodeLevel,
+    Array, Dictionary, Name, Object, Stream, OutlineItem,
+)
 import io
+import hashlib
+import json
+import math
+import re
+import subprocess
+import time
 import zipfile
-import pytesseract
-from pytesseract import TesseractNotFoundError
-from PIL import Image
-import fitz  # PyMuPDF
+from collections import deque
+from itertools import chain
+from concurrent.futures import Future, ProcessPoolExecutor
 import os
 import tempfile
+from contextlib import ExitStack, nullcontext
+from functools import lru_cache, partial
+
+import admission
+import metrics
+import preflight
+import profiling
+import sandbox
+from backends import Image, ImageChops, fitz
+from ingest import Upload
+from jobs import JobStore, report_progress
+from result_cache import ResultCache, stream_digest
+from sessions import DocumentStore
+from pdfimages import decode_image, image_xobject, placement_matrix, sniff_image
+from watermark import POSITIONS as WATERMARK_POSITIONS, image_watermark, stamp_pages, text_watermark
+from zipstream import iter_zip, zip_to_buffer
+
+
+def default_config():
+    """
+    Settings read from the environment. create_app() applies its overrides
+    on top of these.
+    """
+    return {
+        "MAX_CONTENT_LENGTH": 100 * 1024 * 1024,  # 100MB
+        "OCR_WORKERS": int(os.environ.get("OCR_WORKERS", os.cpu_count() or 1)),
+        "OCR_DPI": int(os.environ.get("OCR_DPI", 72)),
+        "OCR_CACHE_DIR": os.environ.get("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdftoolkit_ocr_cache")),
+        "OCR_CACHE_MAX_BYTES": int(os.environ.get("OCR_CACHE_MAX_BYTES", 64 * 1024 * 1024)),  # 0: no page cache
+        "MERGE_MAX_OPEN": int(os.environ.get("MERGE_MAX_OPEN", 16)),
+        "RENDER_WORKERS": int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1)),
+        "RENDER_CHUNK_PAGES": int(os.environ.get("RENDER_CHUNK_PAGES", 8)),
+        "COMPRESS_WORKERS": int(os.environ.get("COMPRESS_WORKERS", os.cpu_count() or 1)),
+        "EXTRACT_WORKERS": int(os.environ.get("EXTRACT_WORKERS", os.cpu_count() or 1)),
+        "IMAGE_WORKERS": int(os.environ.get("IMAGE_WORKERS", os.cpu_count() or 1)),
+        "SPLIT_WORKERS": int(os.environ.get("SPLIT_WORKERS", os.cpu_count() or 1)),
+        "BATCH_WORKERS": int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 1)),
+        "JOBS_DIR": os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "pdftoolkit_jobs")),
+        "JOB_WORKERS": int(os.environ.get("JOB_WORKERS", 2)),
+        "JOB_TTL": int(os.environ.get("JOB_TTL", 3600)),  # seconds
+        "JOB_TIMEOUT": int(os.environ.get("JOB_TIMEOUT", 3600)),  # seconds without progress before a job is failed
+        "UPLOAD_SPOOL_THRESHOLD": int(os.environ.get("UPLOAD_SPOOL_THRESHOLD", 4 * 1024 * 1024)),
+        "UPLOAD_SPOOL_DIR": os.environ.get("UPLOAD_SPOOL_DIR") or None,
+        "RESULT_CACHE_DIR": os.environ.get("RESULT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdftoolkit_cache")),
+        "RESULT_CACHE_MAX_BYTES": int(os.environ.get("RESULT_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+        "DOCUMENTS_DIR": os.environ.get("DOCUMENTS_DIR", os.path.join(tempfile.gettempdir(), "pdftoolkit_documents")),
+        "DOCUMENT_TTL": int(os.environ.get("DOCUMENT_TTL", 1800)),  # seconds since last use
+        "DOCUMENT_CACHE_MAX_BYTES": int(os.environ.get("DOCUMENT_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+        "ADMISSION_HEAVY_SLOTS": int(os.environ.get("ADMISSION_HEAVY_SLOTS", 2)),  # OCR, rendering, compression
+        "ADMISSION_LIGHT_SLOTS": int(os.environ.get("ADMISSION_LIGHT_SLOTS", 16)),
+        "ADMISSION_MAX_QUEUE": int(os.environ.get("ADMISSION_MAX_QUEUE", 16)),  # waiting requests per class
+        "ADMISSION_QUEUE_SECONDS": float(os.environ.get("ADMISSION_QUEUE_SECONDS", 10)),
+        "CLIENT_COST_PER_MINUTE": float(os.environ.get("CLIENT_COST_PER_MINUTE", 3000)),  # 0: no per-client limit
+        "CLIENT_COST_BURST": float(os.environ.get("CLIENT_COST_BURST", 3000)),
+        "MAX_PAGES": int(os.environ.get("MAX_PAGES", 5000)),  # per request, refused with 413 before any work
+        "MAX_REQUEST_COST": float(os.environ.get("MAX_REQUEST_COST", 20000)),  # synchronous requests only
+        "SANDBOX": os.environ.get("SANDBOX", "").lower() in ("1", "true", "on"),  # run operations in limited workers
+        "SANDBOX_WORKERS": int(os.environ.get("SANDBOX_WORKERS", 2)),
+        "SANDBOX_MAX_TASKS": int(os.environ.get("SANDBOX_MAX_TASKS", 50)),  # calls before a worker is replaced
+        "SANDBOX_MEMORY_MB": int(os.environ.get("SANDBOX_MEMORY_MB", 1024)),  # address space per worker
+        "SANDBOX_CPU_SECONDS": int(os.environ.get("SANDBOX_CPU_SECONDS", 120)),  # per operation
+        "SANDBOX_TIMEOUT": int(os.environ.get("SANDBOX_TIMEOUT", 300)),  # wall clock seconds per operation
+        "SANDBOX_QUEUE_SECONDS": float(os.environ.get("SANDBOX_QUEUE_SECONDS", 30)),  # wait for a free worker
+        "PROFILE_TOKEN": os.environ.get("PROFILE_TOKEN") or None,  # unset: profiling disabled
+        "PROFILE_DIR": os.environ.get("PROFILE_DIR", profiling.DEFAULT_DIR),
+        "PROFILE_MAX_CAPTURES": int(os.environ.get("PROFILE_MAX_CAPTURES", 20)),
+        "SECRET_KEY": os.environ.get("SECRET_KEY") or None,
+    }
+
+
+def _setting(name):
+    """
+    A setting of the app handling the current request or job. Operations
+    called directly, outside any app context, use the default app's.
+    """
+    return (current_app if has_app_context() else app).config[name]
+
+
+def _open_upload(file_stream) -> Upload:
+    """
+    Ingest an uploaded file stream exactly once, spooling large uploads to disk.
+    Use the result as a context manager so handles and temp files are released.
+    """
+    with metrics.stage("upload"):
+        return Upload(
+            file_stream,
+            spool_threshold=_setting("UPLOAD_SPOOL_THRESHOLD"),
+            spool_dir=_setting("UPLOAD_SPOOL_DIR"),
+        )
+
+
+def _save_pdf(pdf, **options):
+    """
+    Save a pikepdf Pdf or PyMuPDF Document into a BytesIO, rewound for reading.
+    """
+    output = io.BytesIO()
+    with metrics.stage("serialize"):
+        pdf.save(output, **options)
+    output.seek(0)
+    return output
+
+
+def _ordered_map(func, args_iter, workers, initializer=None, initargs=()):
+    """
+    Yield func(*args) for every args tuple, in order. With more than one
+    worker the calls run on a process pool with at most 2 * workers in flight;
+    initializer(*initargs) runs once in each pool process.
+    """
+    if workers <= 1:
+        for args in args_iter:
+            yield func(*args)
+        return
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        for args in args_iter:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _parse_page_range(spec, num_pages):
+    """
+    Parse a page selection like "1-3, 5" into 0-based page indexes, in the
+    order given. An empty spec selects every page.
+    """
+    if not spec or not spec.strip():
+        return list(range(num_pages))
+    indexes = []
+    for r in spec.split(","):
+        r = r.strip()
+        try:
+            if "-" in r:
+                start, end = map(int, r.split("-"))
+            else:
+                start = end = int(r)
+        except ValueError:
+            raise ValueError(f"Invalid page range: {r}")
+        if start < 1 or end > num_pages or start > end:
+            raise ValueError(f"Page range out of bounds: {r}")
+        indexes.extend(range(start - 1, end))
+    return indexes
+
+
+_worker_pdf = None
+
+
+def _init_pdf_worker(source):
+    """
+    Pool initializer: open the source with pikepdf once per process, from an
+    Upload's spool path or its in-memory bytes.
+    """
+    global _worker_pdf
+    if isinstance(source, str):
+        _worker_pdf = Pdf.open(source, access_mode=AccessMode.mmap)
+    else:
+        _worker_pdf = Pdf.open(io.BytesIO(source))
+
 
-app = Flask(__name__)
-app.config["MAX_CONTENT_LENGTH"] = 100 * 1024 * 1024  # 100MB
+_worker_doc = None
 
 
-def _read_all_bytes(file_stream) -> bytes:
+def _init_fitz_worker(source):
     """
-    Read the uploaded file stream exactly once and return raw bytes.
-    This avoids empty reads when the stream cursor is already at EOF.
+    Pool initializer: open the source with PyMuPDF once per process, from an
+    Upload's spool path or its in-memory bytes.
     """
-    data = file_stream.read()
-    if not data:
-        raise ValueError("Empty upload or unreadable file stream")
-    return data
+    global _worker_doc
+    if isinstance(source, str):
+        _worker_doc = fitz.open(source, filetype="pdf")
+    else:
+        _worker_doc = fitz.open(stream=source, filetype="pdf")
 
 
 # ======== PDF Operations ========
 def encrypt_pdf(file_stream, password):
-    file_bytes = _read_all_bytes(file_stream)
-    pdf = Pdf.open(io.BytesIO(file_bytes))
-    encryption = Encryption(owner=password, user=password, allow=Permissions(extract=True))
-    output = io.BytesIO()
-    pdf.save(output, encryption=encryption)
-    output.seek(0)
+    with _open_upload(file_stream) as upload:
+        pdf = upload.open_pikepdf()
+        encryption = Encryption(owner=password, user=password, allow=Permissions(extract=True))
+        output = _save_pdf(pdf, encryption=encryption)
     return output
 
 
 def decrypt_pdf(file_stream, password):
     try:
-        file_bytes = _read_all_bytes(file_stream)
-        pdf = Pdf.open(io.BytesIO(file_bytes), password=password)
-        output = io.BytesIO()
-        pdf.save(output)
-        output.seek(0)
+        with _open_upload(file_stream) as upload:
+            pdf = upload.open_pikepdf(password=password)
+            output = _save_pdf(pdf)
         return output
     except PdfError:
         raise PdfError("Incorrect password or invalid PDF.")
 
 
-def merge_pdfs(files):
-    merged = Pdf.new()
-    for file in files:
-        src = Pdf.open(io.BytesIO(file.read()))
-        merged.pages.extend(src.pages)
-    output = io.BytesIO()
-    merged.save(output)
-    output.seek(0)
-    return output
+# Dictionaries of these types belong to one place in the document structure
+# and must stay distinct even when their contents happen to match.
+_STRUCTURAL_TYPES = {"/Page", "/Pages", "/Catalog", "/Annot", "/Outlines", "/StructElem", "/StructTreeRoot", "/Sig"}
+# Annotations often leave out /Type, but one may only ever sit on one page.
+_ANNOTATION_SUBTYPES = {
+    "/Text", "/Link", "/FreeText", "/Line", "/Square", "/Circle", "/Polygon", "/PolyLine", "/Highlight",
+    "/Underline", "/Squiggly", "/StrikeOut", "/Stamp", "/Caret", "/Ink", "/Popup", "/FileAttachment", "/Sound",
+    "/Movie", "/Widget", "/Screen", "/PrinterMark", "/TrapNet", "/Watermark", "/3D", "/Redact", "/Projection",
+    "/RichMedia",
+}
+_ANNOTATION_KEYS = ("/P", "/FT", "/Rect")
 
 
-def split_pdf(file_stream, ranges):
+def _object_key(obj):
     """
-    Returns (buffer, download_name, mimetype)
-    download_name is either split.pdf or split_files.zip
+    Content hash used to find duplicate objects, or None if obj must stay
+    unique. Streams hash their raw (still encoded) data and their dictionary
+    without /Length; references inside hash as "n g R".
+    """
+    if isinstance(obj, Stream):
+        stream_dict = Dictionary(obj.stream_dict)
+        if "/Length" in stream_dict:
+            del stream_dict["/Length"]
+        digest = hashlib.sha256(b"stream")
+        digest.update(stream_dict.unparse())
+        digest.update(b"\0")
+        digest.update(obj.read_raw_bytes())
+        return digest.digest()
+    # unparse() on an indirect object only yields its reference, so hash a
+    # direct copy; scalars have nothing nested and can be fully resolved.
+    if isinstance(obj, Dictionary):
+        if "/Parent" in obj or obj.get("/Type") in _STRUCTURAL_TYPES:
+            return None
+        if obj.get("/Subtype") in _ANNOTATION_SUBTYPES or any(key in obj for key in _ANNOTATION_KEYS):
+            return None
+        return hashlib.sha256(b"dict" + Dictionary(obj).unparse()).digest()
+    if isinstance(obj, Array):
+        return hashlib.sha256(b"array" + Array(obj).unparse()).digest()
+    return hashlib.sha256(b"scalar" + obj.unparse(resolved=True)).digest()
+
+
+def _repoint_references(container, replace):
+    """
+    Point every reference in container (recursing into direct dictionaries and
+    arrays) whose object is a key of replace at the replacement object.
+    """
+    if isinstance(container, Array):
+        items = enumerate(list(container))
+    else:
+        items = [(key, container[key]) for key in list(container.keys())]
+    for key, value in items:
+        if not isinstance(value, Object):
+            continue
+        if value.is_indirect:
+            if value.objgen in replace:
+                container[key] = replace[value.objgen]
+        elif isinstance(value, (Array, Dictionary)):
+            _repoint_references(value, replace)
+
+
+def _dedupe_objects(pdf):
+    """
+    Make identical objects (fonts, images, ICC profiles, color spaces...) share
+    one object, so duplicates are not written on save. Repeats until stable,
+    since merging e.g. two ICC profiles makes the images using them identical.
+    """
+    replaced = {}
+    while True:
+        canonical = {}
+        found = {}
+        for obj in pdf.objects:
+            if obj.objgen in replaced:
+                continue
+            key = _object_key(obj)
+            if key is None:
+                continue
+            first = canonical.setdefault(key, obj)
+            if first.objgen != obj.objgen:
+                found[obj.objgen] = first
+        if not found:
+            return len(replaced)
+        replaced.update(found)
+        for obj in pdf.objects:
+            if isinstance(obj, (Array, Dictionary, Stream)) and obj.objgen not in replaced:
+                _repoint_references(obj, found)
+
+
+def _outline_page(item, page_index):
+    destination = item.destination
+    if destination is None and item.action is not None and item.action.get("/S") == "/GoTo":
+        destination = item.action.get("/D")
+    if isinstance(destination, Array) and len(destination) and destination[0].is_indirect:
+        return page_index.get(destination[0].objgen)
+    return None
+
+
+def _source_outline(src, title, first_page):
+    """
+    Return (title, page, children) for one merged source: an entry for its
+    first page with the source's own outline, retargeted, nested below it.
     """
+    page_index = {page.obj.objgen: i for i, page in enumerate(src.pages)}
+
+    def convert(items):
+        converted = []
+        for item in items:
+            page = _outline_page(item, page_index)
+            converted.append((item.title, first_page + (page or 0), convert(item.children)))
+        return converted
+
+    try:
+        with src.open_outline() as outline:
+            children = convert(outline.root)
+    except Exception:
+        children = []
+    return title, first_page, children
+
+
+def _build_outline(entries):
+    items = []
+    for title, page, children in entries:
+        item = OutlineItem(title, page)
+        item.children.extend(_build_outline(children))
+        items.append(item)
+    return items
+
+
+def merge_pdfs(files, dedupe=False, bookmarks=False, max_open=None):
+    """
+    Merge files in order. At most max_open inputs are open at once: when a
+    group is full the merged document is saved to a spool file and reopened,
+    which releases the group's sources. With dedupe, identical objects across
+    sources are stored once; with bookmarks, each source gets an outline entry.
+    """
+    max_open = max_open or _setting("MERGE_MAX_OPEN")
+    outline = []
+    spool_paths = []
+    group = ExitStack()
+    merged = Pdf.new()
     try:
-        file_bytes = _read_all_bytes(file_stream)
-        src = Pdf.open(io.BytesIO(file_bytes))
-        num_pages = len(src.pages)
+        in_group = 0
+        for index, file in enumerate(files):
+            if in_group == max_open:
+                if dedupe:
+                    _dedupe_objects(merged)
+                fd, spool_path = tempfile.mkstemp(suffix=".pdf", prefix="merge_", dir=_setting("UPLOAD_SPOOL_DIR"))
+                os.close(fd)
+                spool_paths.append(spool_path)
+                # Keep stream data byte-identical so later groups still dedupe against it.
+                merged.save(spool_path, compress_streams=False)
+                merged.close()
+                group.close()
+                group = ExitStack()
+                merged = Pdf.open(spool_path, access_mode=AccessMode.mmap)
+                in_group = 0
+
+            upload = group.enter_context(_open_upload(file))
+            src = upload.open_pikepdf()
+            first_page = len(merged.pages)
+            merged.pages.extend(src.pages)
+            in_group += 1
+
+            if bookmarks:
+                title = os.path.splitext(getattr(file, "filename", None) or "")[0] or f"Document {index + 1}"
+                outline.append(_source_outline(src, title, first_page))
+
+        if dedupe:
+            _dedupe_objects(merged)
+        if bookmarks:
+            with merged.open_outline() as merged_outline:
+                merged_outline.root.extend(_build_outline(outline))
+
+        output = _save_pdf(merged)
+    finally:
+        merged.close()
+        group.close()
+        for spool_path in spool_paths:
+            try:
+                os.remove(spool_path)
+            except OSError:
+                pass
+    return output
+
+
+_SIZE_SPEC = re.compile(r"^(?:size|max)\s+(\d+(?:\.\d+)?)\s*mb$")
 
-        output_files = []
-        output_zip = io.BytesIO()
 
-        if ranges.lower().startswith("every"):
+def _page_stream_sizes(page):
+    """
+    Return {objgen: raw size} for the content streams and resource streams
+    (images, forms, embedded fonts) a page draws from.
+    """
+    sizes = {}
+    contents = page.obj.get("/Contents")
+    if contents is not None:
+        for stream in (contents if isinstance(contents, Array) else [contents]):
+            sizes[stream.objgen] = len(stream.read_raw_bytes())
+
+    resources = page.obj.get("/Resources") or Dictionary()
+    for xobject in (resources.get("/XObject") or Dictionary()).values():
+        if isinstance(xobject, Stream):
+            sizes[xobject.objgen] = len(xobject.read_raw_bytes())
+            smask = xobject.get("/SMask")
+            if isinstance(smask, Stream):
+                sizes[smask.objgen] = len(smask.read_raw_bytes())
+    for font in (resources.get("/Font") or Dictionary()).values():
+        descriptor = font.get("/FontDescriptor") if isinstance(font, Dictionary) else None
+        if descriptor is None:
+            continue
+        for key in ("/FontFile", "/FontFile2", "/FontFile3"):
+            font_file = descriptor.get(key)
+            if isinstance(font_file, Stream):
+                sizes[font_file.objgen] = len(font_file.read_raw_bytes())
+    return sizes
+
+
+def _split_by_size(src, max_bytes):
+    """
+    Greedily group consecutive pages so each part's estimated size (its unique
+    streams, shared resources counted once) stays under max_bytes.
+    """
+    parts = []
+    current, current_streams, current_size = [], set(), 0
+    for index, page in enumerate(src.pages):
+        sizes = _page_stream_sizes(page)
+        added = sum(size for objgen, size in sizes.items() if objgen not in current_streams)
+        if current and current_size + added > max_bytes:
+            parts.append(current)
+            current, current_streams, current_size = [], set(), 0
+            added = sum(sizes.values())
+        current.append(index)
+        current_streams.update(sizes)
+        current_size += added
+    if current:
+        parts.append(current)
+    return [(f"split_{p[0] + 1}-{p[-1] + 1}.pdf", p) for p in parts]
+
+
+def _split_by_bookmarks(src):
+    """
+    One part per top-level bookmark, running up to the next bookmark's page.
+    Pages before the first bookmark become a split_front.pdf part.
+    """
+    page_index = {page.obj.objgen: i for i, page in enumerate(src.pages)}
+    with src.open_outline() as outline:
+        starts = []
+        for item in outline.root:
+            page = _outline_page(item, page_index)
+            if page is not None and (not starts or page > starts[-1][1]):
+                starts.append((item.title, page))
+    if not starts:
+        raise ValueError("This PDF has no bookmarks to split by")
+
+    num_pages = len(src.pages)
+    parts = []
+    if starts[0][1] > 0:
+        parts.append(("split_front.pdf", list(range(0, starts[0][1]))))
+    for number, (title, start) in enumerate(starts, 1):
+        end = starts[number][1] if number < len(starts) else num_pages
+        safe_title = re.sub(r"[^A-Za-z0-9_-]+", "_", title).strip("_")[:50] or "bookmark"
+        parts.append((f"split_{number:02d}_{safe_title}.pdf", list(range(start, end))))
+    return parts
+
+
+def _parse_split_ranges(ranges, src):
+    """
+    Turn a split spec into a list of (filename, page indexes) parts.
+
+    Supported specs: "every X pages", "bookmarks", "size X MB", or a comma
+    separated list of pages, ranges ("2-5"), "odd" and "even".
+    """
+    num_pages = len(src.pages)
+    spec = ranges.strip().lower()
+    parts = []
+    if spec.startswith("every"):
+        try:
+            interval = int(ranges.split()[1])
+            if interval < 1:
+                raise ValueError("Invalid interval size.")
+        except (IndexError, ValueError):
+            raise ValueError("Invalid format. Use 'every X pages', for example: 'every 2 pages'.")
+
+        for i in range(0, num_pages, interval):
+            end = min(i + interval, num_pages)
+            parts.append((f"split_{i+1}-{end}.pdf", list(range(i, end))))
+        return parts
+
+    if spec in ("bookmarks", "by bookmark", "by bookmarks"):
+        return _split_by_bookmarks(src)
+
+    size_match = _SIZE_SPEC.match(spec)
+    if size_match:
+        max_bytes = float(size_match.group(1)) * 1024 * 1024
+        if max_bytes <= 0:
+            raise ValueError("Part size must be greater than 0 MB")
+        return _split_by_size(src, max_bytes)
+
+    for r in ranges.split(","):
+        r = r.strip()
+        if r.lower() in ("odd", "even"):
+            first = 0 if r.lower() == "odd" else 1
+            indexes = list(range(first, num_pages, 2))
+            if indexes:
+                parts.append((f"split_{r.lower()}.pdf", indexes))
+        elif "-" in r:
+            try:
+                start, end = map(int, r.split("-"))
+                if start < 1 or end > num_pages or start > end:
+                    raise ValueError(f"Invalid range: {r}")
+            except ValueError:
+                raise ValueError(f"Invalid range format: {r}")
+            parts.append((f"split_{r}.pdf", list(range(start - 1, end))))
+        else:
             try:
-                interval = int(ranges.split()[1])
-                if interval < 1:
-                    raise ValueError("Invalid interval size.")
+                page_num = int(r)
+                if page_num < 1 or page_num > num_pages:
+                    raise ValueError(f"Page number out of range: {r}")
+            except ValueError:
+                raise ValueError(f"Invalid page number: {r}")
+            parts.append((f"split_{r}.pdf", [page_num - 1]))
+    return parts
+
+
+def _write_split_part(src, indexes):
+    split_doc = Pdf.new()
+    split_doc.pages.extend(src.pages[i] for i in indexes)
+    return _save_pdf(split_doc).getvalue()
+
 
-                for i in range(0, num_pages, interval):
-                    split_doc = Pdf.new()
-                    split_doc.pages.extend(src.pages[i : i + interval])
+def _split_part_worker(indexes):
+    return _write_split_part(_worker_pdf, indexes)
 
-                    pdf_output = io.BytesIO()
-                    split_doc.save(pdf_output)
-                    pdf_output.seek(0)
-                    output_files.append((f"split_{i+1}-{min(i+interval, num_pages)}.pdf", pdf_output))
-            except (IndexError, ValueError):
-                raise ValueError("Invalid format. Use 'every X pages', for example: 'every 2 pages'.")
 
+def _iter_split_parts(upload, src, parts):
+    """
+    Yield (filename, pdf_bytes, ZIP_STORED) per part, in order. Parts are
+    written on up to SPLIT_WORKERS processes, each parsing the source once.
+    PDF parts are already compressed, so they are stored without deflate.
+    """
+    try:
+        workers = min(_setting("SPLIT_WORKERS"), len(parts))
+        if workers <= 1:
+            results = (_write_split_part(src, indexes) for _, indexes in parts)
         else:
-            for r in ranges.split(","):
-                r = r.strip()
-                split_doc = Pdf.new()
-
-                if "-" in r:
-                    try:
-                        start, end = map(int, r.split("-"))
-                        if start < 1 or end > num_pages or start > end:
-                            raise ValueError(f"Invalid range: {r}")
-                        split_doc.pages.extend(src.pages[start - 1 : end])
-                    except ValueError:
-                        raise ValueError(f"Invalid range format: {r}")
-                else:
-                    try:
-                        page_num = int(r)
-                        if page_num < 1 or page_num > num_pages:
-                            raise ValueError(f"Page number out of range: {r}")
-                        split_doc.pages.append(src.pages[page_num - 1])
-                    except ValueError:
-                        raise ValueError(f"Invalid page number: {r}")
-
-                if split_doc.pages:
-                    pdf_output = io.BytesIO()
-                    split_doc.save(pdf_output)
-                    pdf_output.seek(0)
-                    output_files.append((f"split_{r}.pdf", pdf_output))
-
-        if len(output_files) > 1:
-            with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                for filename, pdf_output in output_files:
-                    zip_file.writestr(filename, pdf_output.read())
-            output_zip.seek(0)
-            return output_zip, "split_files.zip", "application/zip"
-
-        if not output_files:
-            raise ValueError("No pages matched the requested ranges")
-
-        single_buf = output_files[0][1]
-        single_buf.seek(0)
-        return single_buf, "split.pdf", "application/pdf"
+            results = _ordered_map(
+                _split_part_worker,
+                ((indexes,) for _, indexes in parts),
+                workers,
+                initializer=_init_pdf_worker,
+                initargs=(upload.path or upload.data,),
+            )
+        for (filename, _), pdf_bytes in zip(parts, results):
+            yield filename, pdf_bytes, zipfile.ZIP_STORED
+    finally:
+        upload.close()
 
+
+def split_pdf_entries(file_stream, ranges):
+    """
+    Parse the source and the ranges, and return (part_count, entries), where
+    entries lazily yields (filename, pdf_bytes, compress_type) for each part.
+    """
+    try:
+        upload = _open_upload(file_stream)
+        try:
+            src = upload.open_pikepdf()
+            parts = _parse_split_ranges(ranges, src)
+            if not parts:
+                raise ValueError("No pages matched the requested ranges")
+        except Exception:
+            upload.close()
+            raise
+        return len(parts), _iter_split_parts(upload, src, parts)
+
+    except ValueError:
+        raise
     except PdfError as e:
         raise PdfError(f"PDF Processing Error: {str(e)}")
     except Exception as e:
         raise RuntimeError(f"Unexpected error: {str(e)}")
 
 
-def compress_pdf(file_stream):
-    file_bytes = _read_all_bytes(file_stream)
-    pdf = Pdf.open(io.BytesIO(file_bytes))
-    pdf.remove_unreferenced_resources()
+def split_pdf(file_stream, ranges):
+    """
+    Returns (buffer, download_name, mimetype)
+    download_name is either split.pdf or split_files.zip
+    """
+    part_count, entries = split_pdf_entries(file_stream, ranges)
+    if part_count > 1:
+        return zip_to_buffer(entries), "split_files.zip", "application/zip"
+
+    pdf_bytes = next(entries)[1]
+    entries.close()
+    return io.BytesIO(pdf_bytes), "split.pdf", "application/pdf"
+
+
+# Target resolution and JPEG quality per preset, in the spirit of Ghostscript's
+# -dPDFSETTINGS. Images are only downsampled above 1.5x the target DPI.
+COMPRESSION_PRESETS = {
+    "screen": {"dpi": 72, "quality": 40},
+    "ebook": {"dpi": 150, "quality": 60},
+    "print": {"dpi": 300, "quality": 80},
+}
+_DOWNSAMPLE_THRESHOLD = 1.5
+_GRAY_TOLERANCE = 12
+
+
+def _size_by_category(pdf):
+    """
+    Sum raw stream sizes into images, fonts (embedded font files) and other.
+    """
+    font_files = set()
+    for obj in pdf.objects:
+        if isinstance(obj, Dictionary) and obj.get("/Type") == "/FontDescriptor":
+            for key in ("/FontFile", "/FontFile2", "/FontFile3"):
+                font_file = obj.get(key)
+                if isinstance(font_file, Stream):
+                    font_files.add(font_file.objgen)
+
+    sizes = {"images": 0, "fonts": 0, "other": 0}
+    for obj in pdf.objects:
+        if not isinstance(obj, Stream):
+            continue
+        size = len(obj.read_raw_bytes())
+        if obj.get("/Subtype") == "/Image":
+            sizes["images"] += size
+        elif obj.objgen in font_files:
+            sizes["fonts"] += size
+        else:
+            sizes["other"] += size
+    return sizes
+
+
+def _image_scales(doc, target_dpi):
+    """
+    Return {xref: scale} for every placed image, where scale (<= 1) brings the
+    image down to target_dpi at its largest placement on any page.
+    """
+    min_dpi = {}
+    for page in doc:
+        for info in page.get_image_info(xrefs=True):
+            xref = info.get("xref")
+            bbox = fitz.Rect(info["bbox"])
+            if not xref or bbox.width <= 0 or bbox.height <= 0:
+                continue
+            dpi = min(info["width"] * 72 / bbox.width, info["height"] * 72 / bbox.height)
+            min_dpi[xref] = min(dpi, min_dpi.get(xref, dpi))
+
+    scales = {}
+    for xref, dpi in min_dpi.items():
+        scales[xref] = target_dpi / dpi if dpi > target_dpi * _DOWNSAMPLE_THRESHOLD else 1.0
+    return scales
+
+
+def _is_near_gray(img):
+    # Nearest-neighbour sampling keeps real pixel values; averaging would hide color noise.
+    sample = img.resize((min(img.width, 128), min(img.height, 128)), Image.NEAREST)
+    red, green, blue = sample.split()
+    spread = max(
+        ImageChops.difference(red, green).getextrema()[1],
+        ImageChops.difference(green, blue).getextrema()[1],
+    )
+    return spread <= _GRAY_TOLERANCE
+
+
+def _recompress_image(pdf, objgen, scale, quality):
+    """
+    Downsample and re-encode one image XObject as JPEG. Returns
+    (objgen, jpeg_bytes, width, height, grayscale), or None when the image is
+    unsuitable (masks, bilevel, CMYK...) or would not get smaller.
+    """
+    obj = pdf.get_object(objgen)
+    if obj.get("/ImageMask") or obj.get("/BitsPerComponent", 8) < 8 or "/Decode" in obj:
+        return None
+    try:
+        img = PdfImage(obj).as_pil_image()
+    except Exception:
+        return None
+    if img.mode not in ("RGB", "L", "P"):
+        return None
+    if img.mode == "P":
+        img = img.convert("RGB")
+    if img.mode == "RGB" and _is_near_gray(img):
+        img = img.convert("L")
+
+    if scale < 1.0:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.LANCZOS)
+
     output = io.BytesIO()
-    pdf.save(output, compress_streams=True, object_stream_mode=2)
+    img.save(output, format="JPEG", quality=quality, optimize=True)
+    jpeg_bytes = output.getvalue()
+    if len(jpeg_bytes) >= len(obj.read_raw_bytes()) * 0.95:
+        return None
+    return objgen, jpeg_bytes, img.width, img.height, img.mode == "L"
+
+
+def _recompress_image_worker(objgen, scale, quality):
+    return _recompress_image(_worker_pdf, objgen, scale, quality)
+
+
+def _fonttools_available():
+    try:
+        import fontTools  # noqa: F401  (PyMuPDF's subset_fonts needs it)
+    except ImportError:
+        return False
+    return True
+
+
+def _subset_fonts(pdf_bytes):
+    """
+    Subset embedded fonts with PyMuPDF when fontTools is installed; otherwise
+    return the input unchanged.
+    """
+    if not _fonttools_available():
+        return pdf_bytes
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        doc.subset_fonts()
+        # Keep the object streams pikepdf wrote.
+        return doc.tobytes(garbage=3, deflate=True, use_objstms=1)
+    finally:
+        doc.close()
+
+
+def _apply_compression_preset(pdf, doc, source, preset):
+    """
+    Downsample and re-encode the images of pdf for preset, then deduplicate
+    identical objects. doc and source (a path or bytes, for pool workers)
+    must be the same file pdf was opened from, so their xrefs line up.
+    """
+    settings = COMPRESSION_PRESETS[preset]
+    scales = _image_scales(doc, settings["dpi"])
+    # PyMuPDF gives object numbers only; the generation is not always 0.
+    objgens = {obj.objgen[0]: obj.objgen for obj in pdf.objects if obj.objgen[0] in scales}
+    tasks = [(objgens[xref], scale, settings["quality"]) for xref, scale in sorted(scales.items()) if xref in objgens]
+    workers = min(_setting("COMPRESS_WORKERS"), len(tasks))
+    if workers <= 1:
+        results = (_recompress_image(pdf, *task) for task in tasks)
+    else:
+        results = _ordered_map(
+            _recompress_image_worker,
+            tasks,
+            workers,
+            initializer=_init_pdf_worker,
+            initargs=(source,),
+        )
+    for result in results:
+        if result is None:
+            continue
+        objgen, jpeg_bytes, width, height, grayscale = result
+        obj = pdf.get_object(objgen)
+        obj.write(jpeg_bytes, filter=Name.DCTDecode)
+        obj.Width = width
+        obj.Height = height
+        obj.BitsPerComponent = 8
+        obj.ColorSpace = Name.DeviceGray if grayscale else Name.DeviceRGB
+        for key in ("/DecodeParms", "/SMaskInData"):
+            if key in obj:
+                del obj[key]
+    _dedupe_objects(pdf)
+
+
+def compress_pdf(file_stream, preset=None, stats=None):
+    """
+    Compress a PDF. Without a preset only unreferenced resources are dropped
+    and streams are compressed. With a preset ("screen", "ebook" or "print"),
+    images above the preset's DPI are downsampled and re-encoded as JPEG
+    (near-gray ones as grayscale) on up to COMPRESS_WORKERS processes,
+    identical objects are deduplicated and fonts are subset when possible.
+    If stats is a dict, it receives before/after sizes per category.
+    """
+    with _open_upload(file_stream) as upload:
+        pdf = upload.open_pikepdf()
+        before = _size_by_category(pdf) if stats is not None else None
+
+        if preset is not None:
+            _apply_compression_preset(pdf, upload.open_fitz(), upload.path or upload.data, preset)
+
+        pdf.remove_unreferenced_resources()
+        output = _save_pdf(pdf, compress_streams=True, object_stream_mode=2)
+
+    if preset is not None:
+        output = io.BytesIO(_subset_fonts(output.getvalue()))
+
+    if stats is not None:
+        with Pdf.open(io.BytesIO(output.getvalue())) as result:
+            after = _size_by_category(result)
+        stats.update({key: {"before": before[key], "after": after[key]} for key in before})
+        stats["total"] = {"before": upload.size, "after": len(output.getvalue())}
+
     output.seek(0)
     return output
 
 
-def extract_text_from_pdf(file_stream):
-    file_bytes = _read_all_bytes(file_stream)
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
-    text_chunks = []
-    for page in doc:
-        text_chunks.append(page.get_text())
-    doc.close()
+TEXT_FORMATS = {
+    "text": ("extracted_text.txt", "text/plain"),
+    "ndjson": ("extracted_text.ndjson", "application/x-ndjson"),
+    "json": ("extracted_text.json", "application/json"),
+}
+
+
+def _page_text_record(page, detail):
+    record = {"page": page.number + 1, "text": page.get_text()}
+    if detail == "blocks":
+        record["blocks"] = [
+            {"bbox": [round(v, 2) for v in block[:4]], "text": block[4]}
+            for block in page.get_text("blocks")
+            if block[6] == 0
+        ]
+    elif detail == "words":
+        record["words"] = [
+            {"bbox": [round(v, 2) for v in word[:4]], "text": word[4], "block": word[5], "line": word[6]}
+            for word in page.get_text("words")
+        ]
+    return record
 
+
+def extract_text_chunks(file_stream, pages=None, fmt="text", detail=None):
+    """
+    Yield the extracted text as UTF-8 chunks, one page at a time.
+
+    fmt "text" yields plain page text; "ndjson" one JSON record per line; and
+    "json" a {"pages": [...]} document. JSON records hold the page number and
+    text, plus block or word boxes when detail is "blocks" or "words".
+    """
+    with _open_upload(file_stream) as upload:
+        doc = upload.open_fitz()
+        indexes = _parse_page_range(pages, len(doc))
+        if fmt == "json":
+            yield b'{"pages": ['
+        for n, page_num in enumerate(indexes):
+            page = doc[page_num]
+            if fmt == "text":
+                yield page.get_text().encode("utf-8")
+                continue
+            record = json.dumps(_page_text_record(page, detail), ensure_ascii=False)
+            if fmt == "ndjson":
+                yield (record + "\n").encode("utf-8")
+            else:
+                yield (("," if n else "") + record).encode("utf-8")
+        if fmt == "json":
+            yield b"]}"
+
+
+def extract_text_from_pdf(file_stream, **options):
     output = io.BytesIO()
-    output.write(("".join(text_chunks)).encode("utf-8"))
+    for chunk in extract_text_chunks(file_stream, **options):
+        output.write(chunk)
     output.seek(0)
     return output
 
 
-def extract_images_from_pdf(file_stream):
-    file_bytes = _read_all_bytes(file_stream)
-    doc = fitz.open(stream=file_bytes, filetype="pdf")
+# Formats that are already compressed go into the archive as stored entries.
+_COMPRESSED_IMAGE_EXTS = {"jpg", "jpeg", "jpx", "jp2", "png", "jb2", "jbig2", "webp", "gif"}
+_EXTRACT_CHUNK = 16
+
+
+def _extract_images(doc, xrefs):
+    """
+    Return [(xref, ext, image_bytes)] for the given image xrefs.
+    """
+    extracted = []
+    for xref in xrefs:
+        base_image = doc.extract_image(xref)
+        if base_image:
+            extracted.append((xref, base_image.get("ext", "bin"), base_image["image"]))
+    return extracted
+
+
+def _extract_images_worker(xrefs):
+    return _extract_images(_worker_doc, xrefs)
+
+
+def extract_image_entries(file_stream, min_size=0):
+    """
+    Yield (filename, image_bytes, compress_type) for every unique embedded
+    image, followed by a manifest.json mapping each file to the pages using it.
+
+    Images are deduplicated by xref and then by content hash, so an image that
+    appears on many pages is extracted and stored once. Images smaller than
+    min_size pixels in either dimension are skipped. Unique images are
+    extracted on up to EXTRACT_WORKERS processes.
+    """
+    with _open_upload(file_stream) as upload:
+        doc = upload.open_fitz()
 
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        image_count = 0
+        pages_by_xref = {}
         for page_num in range(len(doc)):
-            page = doc[page_num]
-            image_list = page.get_images(full=True)
+            for img in doc[page_num].get_images(full=True):
+                xref, width, height = img[0], img[2], img[3]
+                if width < min_size or height < min_size:
+                    continue
+                pages = pages_by_xref.setdefault(xref, [])
+                if page_num + 1 not in pages:
+                    pages.append(page_num + 1)
+
+        xrefs = list(pages_by_xref)
+        chunks = [xrefs[i : i + _EXTRACT_CHUNK] for i in range(0, len(xrefs), _EXTRACT_CHUNK)]
+        workers = min(_setting("EXTRACT_WORKERS"), len(chunks))
+        if workers <= 1:
+            results = (_extract_images(doc, chunk) for chunk in chunks)
+        else:
+            results = _ordered_map(
+                _extract_images_worker,
+                ((chunk,) for chunk in chunks),
+                workers,
+                initializer=_init_fitz_worker,
+                initargs=(upload.path or upload.data,),
+            )
+
+        manifest = []
+        by_hash = {}
+        for extracted in results:
+            for xref, ext, image_bytes in extracted:
+                digest = hashlib.sha256(image_bytes).hexdigest()
+                if digest in by_hash:
+                    entry = by_hash[digest]
+                    entry["xrefs"].append(xref)
+                    entry["pages"] = sorted(set(entry["pages"]) | set(pages_by_xref[xref]))
+                    continue
 
-            for img in image_list:
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                ext = base_image.get("ext", "bin")
+                pages = pages_by_xref[xref]
+                filename = f"image_{pages[0]}_{len(manifest) + 1}.{ext}"
+                entry = {"file": filename, "sha256": digest, "xrefs": [xref], "pages": list(pages)}
+                by_hash[digest] = entry
+                manifest.append(entry)
+                compress_type = zipfile.ZIP_STORED if ext.lower() in _COMPRESSED_IMAGE_EXTS else zipfile.ZIP_DEFLATED
+                yield filename, image_bytes, compress_type
 
-                image_count += 1
-                filename = f"image_{page_num + 1}_{image_count}.{ext}"
-                zip_file.writestr(filename, image_bytes)
+        if not manifest:
+            yield "README.txt", b"No embedded images were found in this PDF.\n"
+        else:
+            yield "manifest.json", json.dumps({"images": manifest}, indent=2).encode("utf-8")
 
-        if image_count == 0:
-            zip_file.writestr("README.txt", "No embedded images were found in this PDF.\n")
 
-    doc.close()
-    zip_buffer.seek(0)
-    return zip_buffer
+def extract_images_from_pdf(file_stream, **options):
+    return zip_to_buffer(extract_image_entries(file_stream, **options))
 
 
-def _ensure_tesseract_available():
+@lru_cache(maxsize=None)
+def _tesseract_version():
+    """
+    Probe for Tesseract once per process. Returns its version, or None if it
+    is not installed.
+    """
+    import pytesseract
+
     try:
-        _ = pytesseract.get_tesseract_version()
-    except TesseractNotFoundError as e:
+        return str(pytesseract.get_tesseract_version())
+    except pytesseract.TesseractNotFoundError:
+        return None
+
+
+def _ensure_tesseract_available():
+    if _tesseract_version() is None:
         raise RuntimeError(
             "Tesseract is not available on the server, so OCR cannot run. "
             "On PythonAnywhere free plan, system packages like tesseract are usually not installable. "
             "Either disable the OCR feature, upgrade your plan, or use an external OCR API."
-        ) from e
+        )
 
 
-def ocr_pdf(file_stream):
-    _ensure_tesseract_available()
+def _tesseract_recognize(image_bytes):
+    """
+    Run Tesseract on an in-memory PNM/PNG image. Returns {"text", "words"},
+    words being [left, top, width, height, text] boxes in image pixels. The
+    image is piped through stdin, so no page ever touches the filesystem.
+    """
+    import pytesseract
+
+    proc = subprocess.run(
+        [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout", "tsv"],
+        input=image_bytes,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0:
+        raise pytesseract.TesseractError(proc.returncode, proc.stderr.decode("utf-8", "replace").strip())
+
+    words = []
+    lines = {}  # (block, paragraph, line) -> words, in reading order
+    for row in proc.stdout.decode("utf-8", "replace").splitlines()[1:]:
+        fields = row.split("\t")
+        if len(fields) < 12 or fields[0] != "5" or not fields[11].strip():
+            continue  # level 5 rows are words
+        left, top, width, height = (int(value) for value in fields[6:10])
+        words.append([left, top, width, height, fields[11]])
+        lines.setdefault(tuple(fields[2:5]), []).append(fields[11])
+    paragraphs = {}
+    for (block, paragraph, _), line in lines.items():
+        paragraphs.setdefault((block, paragraph), []).append(" ".join(line))
+    text = "\n\n".join("\n".join(paragraph) for paragraph in paragraphs.values())
+    return {"text": text, "words": words}
+
+
+def _ocr_page_cache():
+    """
+    The app's on-disk cache of OCR records, keyed by the rendered page's
+    pixels, so pages seen before (cover sheets, separators) are not
+    recognized again. None when OCR_CACHE_MAX_BYTES is 0.
+    """
+    extensions = (current_app if has_app_context() else app).extensions["pdftoolkit"]
+    root, max_bytes = _setting("OCR_CACHE_DIR"), _setting("OCR_CACHE_MAX_BYTES")
+    cache = extensions["ocr_cache"]
+    if (cache.root, cache.max_bytes) != (root, max_bytes):
+        # Settings changed since the app was built: a sandbox or batch
+        # worker running operations for an app with other settings.
+        cache = extensions["ocr_cache"] = ResultCache(root, max_bytes)
+    return cache if cache.enabled else None
 
-    file_bytes = _read_all_bytes(file_stream)
-    src = fitz.open(stream=file_bytes, filetype="pdf")
 
-    out = fitz.open()
+def _ocr_cache_key(cache, pix):
+    digest = hashlib.sha256(pix.samples_mv).hexdigest()
+    return cache.key("ocr_page", digest, {"size": (pix.width, pix.height, pix.n), "engine": _tesseract_version()})
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for page_num in range(len(src)):
-            page = src[page_num]
-            pix = page.get_pixmap()
 
-            img_path = os.path.join(temp_dir, f"page_{page_num}.png")
-            pix.save(img_path)
+def _ocr_cache_get(cache, key):
+    path = cache.get(key)
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # evicted meanwhile, or cut short
 
-            img = Image.open(img_path)
-            text = pytesseract.image_to_string(img)
 
-            rect = page.rect
-            out_page = out.new_page(width=rect.width, height=rect.height)
+def _has_text_layer(page):
+    return bool(page.get_text("text").strip())
 
-            out_page.insert_image(rect, filename=img_path)
 
-            safe_text = (text or "").strip()
-            if safe_text:
-                out_page.insert_text((20, 20), safe_text[:20000], fontsize=9)
+def _ocr_pages(src, dpi, workers, skip_text=False, cache=None):
+    """
+    Yield (page, pixmap, record, source) for every page of src, in page
+    order. source is "ocr", "cached" (the record came from cache), or
+    "skipped" for pages that already have text when skip_text is set; those
+    are not rendered and have no pixmap or record. Pages are rendered here
+    and recognized on a bounded process pool; at most 2 * workers pages are
+    held in memory at a time.
+    """
+    window = max(1, workers * 2) if workers > 1 else 1
+    pending = deque()
+
+    def finish(page, pix, key, result):
+        if pix is None:
+            return page, None, None, "skipped"
+        if isinstance(result, dict):
+            return page, pix, result, "cached"
+        record = result.result() if isinstance(result, Future) else result()
+        if cache is not None:
+            cache.put(key, io.BytesIO(json.dumps(record).encode("utf-8")))
+        return page, pix, record, "ocr"
+
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        for page in src:
+            if skip_text and _has_text_layer(page):
+                pending.append((page, None, None, None))
+            else:
+                pix = page.get_pixmap(dpi=dpi)
+                key = _ocr_cache_key(cache, pix) if cache is not None else None
+                record = _ocr_cache_get(cache, key) if cache is not None else None
+                if record is None:
+                    if executor is not None:
+                        record = executor.submit(_tesseract_recognize, pix.tobytes("pnm"))
+                    else:
+                        record = partial(_tesseract_recognize, pix.tobytes("pnm"))
+                pending.append((page, pix, key, record))
+            if len(pending) >= window:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+
+
+def _insert_text_layer(page, record, scale):
+    """
+    Lay the recognized words over the page image as invisible text (render
+    mode 3), each fitted to its box scaled from image pixels by scale, so the text
+    can be selected and searched where it appears. Records without word
+    boxes fall back to their text in the top left corner.
+    """
+    writer = fitz.TextWriter(page.rect)
+    for left, top, width, height, text in record.get("words") or ():
+        length = fitz.get_text_length(text, fontsize=1)
+        if height > 0 and length > 0:
+            # The box's height, shrunk if needed so the word fits its width.
+            fontsize = min(height, width / length) * scale
+            writer.append((left * scale, (top + height) * scale), text, fontsize=fontsize)
+    if not writer.text_rect.is_empty:
+        writer.write_text(page, render_mode=3)
+        return
+    safe_text = (record["text"] or "").strip()
+    if safe_text:
+        page.insert_text((20, 20), safe_text[:20000], fontsize=9, render_mode=3)
+
+
+def ocr_pdf(file_stream, workers=None, dpi=None, skip_text=False, stats=None):
+    """
+    Rasterize every page and add its recognized text. With skip_text, pages
+    that already have extractable text are copied through unchanged. If
+    stats is a dict, it receives how many pages were recognized ("ocr"),
+    taken from the OCR page cache ("cached") and copied through ("skipped").
+    """
+    _ensure_tesseract_available()
+
+    workers = workers or _setting("OCR_WORKERS")
+    dpi = dpi or _setting("OCR_DPI")
+    counts = {"ocr": 0, "cached": 0, "skipped": 0}
+
+    out = fitz.open()
+    run = []  # consecutive skipped page numbers not yet copied
+
+    def copy_run():
+        # One call per run, and final=False so fonts and images shared with
+        # earlier runs are not embedded again.
+        if run:
+            out.insert_pdf(src, from_page=run[0], to_page=run[-1], final=False)
+            run.clear()
+
+    with _open_upload(file_stream) as upload:
+        src = upload.open_fitz()
+        for page, pix, record, source in _ocr_pages(src, dpi, workers, skip_text, _ocr_page_cache()):
+            report_progress(page.number + 1, len(src))
+            counts[source] += 1
+            if source == "skipped":
+                run.append(page.number)
+                continue
+            copy_run()
+            rect = page.rect
+            out_page = out.new_page(width=rect.width, height=rect.height)
 
-    src.close()
+            out_page.insert_image(rect, pixmap=pix)
+            _insert_text_layer(out_page, record, 72 / dpi)
+        copy_run()
 
-    output_pdf = io.BytesIO()
-    out.save(output_pdf)
+    if stats is not None:
+        stats.update(pages=sum(counts.values()), **counts)
+    output_pdf = _save_pdf(out)
     out.close()
-    output_pdf.seek(0)
     return output_pdf
 
 
-def rearrange_pdf_pages(file_stream, order):
-    try:
-        file_bytes = _read_all_bytes(file_stream)
-        pdf = Pdf.open(io.BytesIO(file_bytes))
+def _rearranged(pdf, order):
+    """
+    Return a new Pdf with the pages of pdf in order ("3,1,2", 1-based).
+    The result refers to pdf's objects, so pdf must stay open until it is saved.
+    """
+    new_order = [int(p.strip()) - 1 for p in order.split(",") if p.strip()]
 
-        new_order = [int(p.strip()) - 1 for p in order.split(",") if p.strip()]
+    if not new_order:
+        raise ValueError("No page numbers provided")
 
-        if not new_order:
-            raise ValueError("No page numbers provided")
+    if any(i < 0 or i >= len(pdf.pages) for i in new_order):
+        raise ValueError("Page numbers out of range")
 
-        if any(i < 0 or i >= len(pdf.pages) for i in new_order):
-            raise ValueError("Page numbers out of range")
+    new_pdf = Pdf.new()
+    for page_num in new_order:
+        new_pdf.pages.append(pdf.pages[page_num])
+    return new_pdf
 
-        new_pdf = Pdf.new()
-        for page_num in new_order:
-            new_pdf.pages.append(pdf.pages[page_num])
 
-        output = io.BytesIO()
-        new_pdf.save(output)
-        output.seek(0)
+def rearrange_pdf_pages(file_stream, order):
+    try:
+        with _open_upload(file_stream) as upload:
+            new_pdf = _rearranged(upload.open_pikepdf(), order)
+            output = _save_pdf(new_pdf)
         return output
 
     except ValueError as e:
@@ -265,90 +1189,728 @@ def rearrange_pdf_pages(file_stream, order):
         raise RuntimeError(f"Error rearranging PDF: {str(e)}")
 
 
+def _rotate_pages(pdf, degree):
+    for page in pdf.pages:
+        page.rotate(degree, relative=True)
+
+
 def rotate_pdf(file_stream, degree):
     try:
-        file_bytes = _read_all_bytes(file_stream)
-        pdf = Pdf.open(io.BytesIO(file_bytes))
-        for page in pdf.pages:
-            page.rotate(degree, relative=True)
-        output = io.BytesIO()
-        pdf.save(output)
-        output.seek(0)
+        with _open_upload(file_stream) as upload:
+            pdf = upload.open_pikepdf()
+            _rotate_pages(pdf, degree)
+            output = _save_pdf(pdf)
         return output
     except Exception as e:
         raise RuntimeError(f"Rotation failed: {str(e)}")
 
 
-def pdf_to_images(file_stream):
+IMAGE_FORMATS = {"png": "png", "jpeg": "jpg", "jpg": "jpg", "webp": "webp"}
+
+
+def _render_pages(doc, indexes, dpi, fmt, quality, grayscale):
+    """
+    Render the given pages and return [(page_index, filename, image_bytes)].
+    """
+    ext = IMAGE_FORMATS[fmt]
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    rendered = []
+    for page_num in indexes:
+        pix = doc[page_num].get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+        if ext == "png":
+            image_bytes = pix.tobytes("png")
+        else:
+            img = Image.frombytes("L" if grayscale else "RGB", (pix.width, pix.height), pix.samples)
+            output = io.BytesIO()
+            img.save(output, format="JPEG" if ext == "jpg" else "WEBP", quality=quality)
+            image_bytes = output.getvalue()
+        rendered.append((page_num, f"page_{page_num + 1}.{ext}", image_bytes))
+    return rendered
+
+
+def _render_chunk_worker(indexes, options):
+    return _render_pages(_worker_doc, indexes, *options)
+
+
+def pdf_to_image_entries(file_stream, dpi=72, fmt="png", quality=85, pages=None, grayscale=False):
+    """
+    Yield (filename, image_bytes, ZIP_STORED) for every selected page, in order.
+    Pages are rendered in chunks of RENDER_CHUNK_PAGES on up to RENDER_WORKERS
+    processes; the images are already compressed, so entries are stored.
+    """
     try:
-        file_bytes = _read_all_bytes(file_stream)
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                pix = page.get_pixmap()
-                img_bytes = pix.tobytes("png")
-                zip_file.writestr(f"page_{page_num + 1}.png", img_bytes)
-        doc.close()
-        zip_buffer.seek(0)
-        return zip_buffer
+        with _open_upload(file_stream) as upload:
+            doc = upload.open_fitz()
+            indexes = _parse_page_range(pages, len(doc))
+            options = (dpi, fmt.lower(), quality, grayscale)
+            chunk_size = _setting("RENDER_CHUNK_PAGES")
+            chunks = [indexes[i : i + chunk_size] for i in range(0, len(indexes), chunk_size)]
+
+            workers = min(_setting("RENDER_WORKERS"), len(chunks))
+            if workers <= 1:
+                results = (_render_pages(doc, chunk, *options) for chunk in chunks)
+            else:
+                results = _ordered_map(
+                    _render_chunk_worker,
+                    ((chunk, options) for chunk in chunks),
+                    workers,
+                    initializer=_init_fitz_worker,
+                    initargs=(upload.path or upload.data,),
+                )
+
+            done = 0
+            for rendered in results:
+                for _, filename, image_bytes in rendered:
+                    yield filename, image_bytes, zipfile.ZIP_STORED
+                done += len(rendered)
+                report_progress(done, len(indexes))
+    except ValueError:
+        raise
     except Exception as e:
         raise RuntimeError(f"Conversion failed: {str(e)}")
 
 
-def images_to_pdf(image_files):
-    try:
-        doc = fitz.open()
+def pdf_to_images(file_stream, **options):
+    return zip_to_buffer(pdf_to_image_entries(file_stream, **options))
+
+
+# Page sizes in points, portrait.
+PAGE_SIZES = {
+    "a3": (842, 1191),
+    "a4": (595, 842),
+    "a5": (420, 595),
+    "letter": (612, 792),
+    "legal": (612, 1008),
+}
+IMAGE_FITS = ("contain", "cover", "stretch", "none")
+
+
+def _image_page(pdf, spec, page_size, orientation, fit, margin):
+    """
+    Append a page showing the image described by spec. With page_size
+    "image" the page takes the image's own size at its DPI (72 if unknown);
+    otherwise the image is fitted into the page's margin box.
+    """
+    dpi_x, dpi_y = spec["dpi"] or (72, 72)
+    rotated = spec["orientation"] in (6, 8)
+    natural_width = spec["width"] * 72 / dpi_x
+    natural_height = spec["height"] * 72 / dpi_y
+    if rotated:
+        natural_width, natural_height = natural_height, natural_width
+
+    if page_size == "image":
+        page_width, page_height = natural_width + 2 * margin, natural_height + 2 * margin
+    else:
+        page_width, page_height = PAGE_SIZES[page_size]
+        landscape = natural_width > natural_height if orientation == "auto" else orientation == "landscape"
+        if landscape:
+            page_width, page_height = page_height, page_width
+    box_width, box_height = page_width - 2 * margin, page_height - 2 * margin
+    if box_width <= 0 or box_height <= 0:
+        raise ValueError("Margin leaves no room for the image")
+
+    if page_size == "image" or fit == "stretch":
+        width, height = box_width, box_height
+    else:
+        scale = {
+            "contain": min(box_width / natural_width, box_height / natural_height),
+            "cover": max(box_width / natural_width, box_height / natural_height),
+            "none": 1.0,
+        }[fit]
+        width, height = natural_width * scale, natural_height * scale
+    x = margin + (box_width - width) / 2
+    y = margin + (box_height - height) / 2
+
+    matrix = placement_matrix(spec["orientation"], x, y, width, height)
+    content = f"q {' '.join(f'{v:.4f}' for v in matrix)} cm /Im0 Do Q"
+    if fit in ("cover", "none") and page_size != "image":
+        content = f"q {margin} {margin} {box_width:.4f} {box_height:.4f} re W n {content} Q"
+
+    page = pdf.add_blank_page(page_size=(page_width, page_height))
+    page.Resources = Dictionary(XObject=Dictionary(Im0=image_xobject(pdf, spec)))
+    page.Contents = pdf.make_stream(content.encode("ascii"))
+
+
+def images_to_pdf(image_files, page_size="image", orientation="auto", fit="contain", margin=0):
+    """
+    Build a PDF with one page per image, reading the uploads one at a time.
+    JPEG, JPEG 2000 and plain PNG data is embedded unchanged; other images
+    are decoded and stored losslessly, on up to IMAGE_WORKERS processes once
+    a second image needs decoding (a lone one is decoded here).
+    """
+    workers = min(_setting("IMAGE_WORKERS"), len(image_files))
+    window = max(1, workers * 2)
+    pending = deque()  # (filename, spec, data or Future), in page order
+    pdf = Pdf.new()
+    placed = 0
+
+    def place(filename, spec, work):
+        nonlocal placed
+        if spec is None:
+            try:
+                spec = work.result() if isinstance(work, Future) else decode_image(work)
+            except ValueError:
+                raise ValueError(f"Unreadable image: {filename}")
+        _image_page(pdf, spec, page_size, orientation, fit, margin)
+        placed += 1
+        report_progress(placed, len(image_files))
+
+    with ExitStack() as stack:
+        executor = None
+        to_decode = 0
         for img_file in image_files:
-            img_bytes = img_file.read()
-            img = fitz.open(stream=img_bytes, filetype=img_file.filename.split('.')[-1])
-            rect = img[0].rect
-            pdfbytes = img.convert_to_pdf()
-            img.close()
-            img_pdf = fitz.open("pdf", pdfbytes)
-            page = doc.new_page(width=rect.width, height=rect.height)
-            page.show_pdf_page(rect, img_pdf, 0)
-            img_pdf.close()
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
-        return output
-    except Exception as e:
-        raise RuntimeError(f"Conversion failed: {str(e)}")
+            data = img_file.read()
+            spec = sniff_image(data)
+            work = None
+            if spec is None:
+                to_decode += 1
+                if executor is None and to_decode > 1 and workers > 1:
+                    executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+                    # Hand the decodes still waiting to the new pool.
+                    for index, (filename, waiting_spec, waiting) in enumerate(pending):
+                        if waiting_spec is None:
+                            pending[index] = (filename, None, executor.submit(decode_image, waiting))
+                work = executor.submit(decode_image, data) if executor is not None else data
+            pending.append((img_file.filename, spec, work))
+            if len(pending) > window:
+                place(*pending.popleft())
+        while pending:
+            place(*pending.popleft())
+
+    output = _save_pdf(pdf)
+    pdf.close()
+    return output
 
 
-def add_watermark(file_stream, watermark_text):
+def _watermark_options(opacity=0.3, position="center", angle=None, font_size=50, color="#cccccc", scale=0.5,
+                       pages=None):
+    """
+    Validate watermark options and return them normalized, raising ValueError.
+    """
+    def is_number(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if not is_number(opacity) or not 0 < opacity <= 1:
+        raise ValueError("Opacity must be between 0 and 1")
+    if position not in WATERMARK_POSITIONS:
+        raise ValueError(f"Position must be one of {', '.join(WATERMARK_POSITIONS)}")
+    if angle is not None and not is_number(angle):
+        raise ValueError("Angle must be a number of degrees")
+    if not is_number(font_size) or not 1 <= font_size <= 500:
+        raise ValueError("Font size must be between 1 and 500")
+    if not is_number(scale) or not 0 < scale <= 1:
+        raise ValueError("Scale must be between 0 and 1")
+    if not isinstance(color, str) or not re.fullmatch(r"#?[0-9a-fA-F]{6}", color):
+        raise ValueError("Color must be a hex value such as #cccccc")
+    if pages is not None and not isinstance(pages, str):
+        raise ValueError("Pages must be a range such as 1-3, 5")
+    pages = "".join((pages or "").split()) or None
+    return {
+        "opacity": float(opacity),
+        "position": position,
+        "angle": None if angle is None else float(angle),
+        "font_size": float(font_size),
+        "color": "#" + color.lstrip("#").lower(),
+        "scale": float(scale),
+        "pages": pages,
+    }
+
+
+def _watermark_pdf(pdf, text=None, image=None, opacity=0.3, position="center", angle=None, font_size=50,
+                   color="#cccccc", scale=0.5, pages=None):
+    """
+    Stamp text, or image bytes scaled to a fraction of the page width, on the
+    selected pages of pdf through one shared Form XObject. Text runs
+    diagonally unless an angle is given.
+    """
+    indexes = _parse_page_range(pages, len(pdf.pages))
+    if image is not None:
+        form, width, height = image_watermark(pdf, image, opacity)
+        relative_width, default_angle = scale, 0
+    else:
+        rgb = tuple(int(color.lstrip("#")[i : i + 2], 16) / 255 for i in (0, 2, 4))
+        form, width, height = text_watermark(pdf, text, font_size, rgb, opacity)
+        relative_width, default_angle = None, 45
+    stamp_pages(
+        pdf, form, width, height, indexes, position, default_angle if angle is None else angle, relative_width
+    )
+
+
+def add_watermark(file_stream, text=None, image=None, **options):
     try:
-        file_bytes = _read_all_bytes(file_stream)
-        doc = fitz.open(stream=file_bytes, filetype="pdf")
-        for page in doc:
-            # Add watermark text diagonally
-            page.insert_text(
-                (50, 50),
-                watermark_text,
-                fontsize=50,
-                color=(0.8, 0.8, 0.8),
-                fill_opacity=0.3,
-                rotate=45
-            )
-        output = io.BytesIO()
-        doc.save(output)
-        doc.close()
-        output.seek(0)
+        with _open_upload(file_stream) as upload:
+            pdf = upload.open_pikepdf()
+            _watermark_pdf(pdf, text=text, image=image, **options)
+            output = _save_pdf(pdf)
         return output
+    except ValueError:
+        raise
     except Exception as e:
         raise RuntimeError(f"Watermarking failed: {str(e)}")
 
 
+# ======== Pipelines ========
+# step -> accepted parameters. decrypt may only come first and encrypt last,
+# since they belong to opening and saving the document.
+PIPELINE_STEPS = {
+    "decrypt": {"password"},
+    "rearrange": {"order"},
+    "rotate": {"degree"},
+    "watermark": {"text", "opacity", "position", "angle", "font_size", "color", "pages"},
+    "compress": {"preset"},
+    "encrypt": {"password"},
+}
+
+
+def parse_pipeline_steps(raw):
+    """
+    Parse a JSON list of steps such as [{"op": "rotate", "degree": 90}] into
+    [(op, params)], raising ValueError for anything malformed.
+    """
+    try:
+        steps = json.loads(raw or "")
+    except ValueError:
+        raise ValueError("Steps must be a JSON list")
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("Steps must be a non-empty JSON list")
+
+    parsed = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get("op") not in PIPELINE_STEPS:
+            raise ValueError(f"Step {index + 1}: op must be one of {', '.join(PIPELINE_STEPS)}")
+        op = step["op"]
+        params = {name: value for name, value in step.items() if name != "op"}
+        unknown = set(params) - PIPELINE_STEPS[op]
+        if unknown:
+            raise ValueError(f"Step {index + 1}: unknown parameter {sorted(unknown)[0]} for {op}")
+
+        if op == "decrypt" and index != 0:
+            raise ValueError("decrypt must be the first step")
+        if op == "encrypt" and index != len(steps) - 1:
+            raise ValueError("encrypt must be the last step")
+        if op in ("decrypt", "encrypt") and not isinstance(params.get("password"), str):
+            raise ValueError(f"Step {index + 1}: {op} needs a password")
+        if op == "encrypt" and not params["password"]:
+            raise ValueError(f"Step {index + 1}: encrypt needs a password")
+        if op == "rearrange" and not isinstance(params.get("order"), str):
+            raise ValueError(f"Step {index + 1}: rearrange needs an order such as \"3,1,2\"")
+        if op == "rotate":
+            degree = params.get("degree")
+            if not isinstance(degree, int) or isinstance(degree, bool) or not degree or degree % 90:
+                raise ValueError(f"Step {index + 1}: rotate needs a non-zero multiple of 90 degrees")
+        if op == "watermark":
+            if not (isinstance(params.get("text"), str) and params["text"]):
+                raise ValueError(f"Step {index + 1}: watermark needs text")
+            options = {name: value for name, value in params.items() if name != "text"}
+            try:
+                params = {"text": params["text"], **_watermark_options(**options)}
+            except ValueError as e:
+                raise ValueError(f"Step {index + 1}: {e}")
+        if op == "compress" and params.get("preset") not in (None, *COMPRESSION_PRESETS):
+            raise ValueError(f"Step {index + 1}: preset must be one of screen, ebook or print")
+        parsed.append((op, params))
+    return parsed
+
+
+class _PipelineDocument:
+    """
+    The working document of a pipeline. It is live in either pikepdf or
+    PyMuPDF, and is only handed to the other library (one in-memory save and
+    open) when a step needs it.
+    """
+
+    def __init__(self, upload, password=None):
+        if password is not None:
+            self._pdf = upload.open_pikepdf(password=password)
+        else:
+            self._pdf = upload.open_pikepdf()
+        self._doc = None
+        self._handles = []
+
+    def _pdf_bytes(self):
+        # Streams are copied as they are: no decoding, no recompression.
+        output = io.BytesIO()
+        self._pdf.save(output, compress_streams=False, stream_decode_level=StreamDecodeLevel.none)
+        return output.getvalue()
+
+    def _open_pdf(self, data):
+        self._pdf = Pdf.open(io.BytesIO(data))
+        self._handles.append(self._pdf)
+
+    def _open_doc(self, data):
+        self._doc = fitz.open(stream=data, filetype="pdf")
+        self._handles.append(self._doc)
+
+    def pikepdf(self):
+        """Return the document as a pikepdf Pdf, for steps that change it."""
+        if self._pdf is None:
+            self._open_pdf(self._doc.tobytes())
+        self._doc = None
+        return self._pdf
+
+    def fitz(self):
+        """Return the document as a PyMuPDF Document, for steps that change it."""
+        if self._doc is None:
+            self._open_doc(self._pdf_bytes())
+        self._pdf = None
+        return self._doc
+
+    def replace(self, pdf):
+        """Make a new pikepdf Pdf built from the current one the live document."""
+        self._handles.append(pdf)
+        self._pdf = pdf
+        self._doc = None
+
+    def aligned(self):
+        """
+        Return (pdf, doc, data): the document reopened from data in both
+        libraries, so pikepdf object numbers and PyMuPDF xrefs agree. The Pdf
+        stays live; the Document is read-only.
+        """
+        data = self._pdf_bytes() if self._pdf is not None else self._doc.tobytes()
+        self._open_pdf(data)
+        self._open_doc(data)
+        return self._pdf, self._doc, data
+
+    def save(self, output, encryption=None, compact=False):
+        if self._pdf is None and encryption is None:
+            self._doc.save(output, garbage=3 if compact else 0, deflate=True)
+            return
+        pdf = self.pikepdf()
+        options = {"compress_streams": True, "object_stream_mode": 2} if compact else {}
+        if encryption is not None:
+            options["encryption"] = encryption
+        pdf.save(output, **options)
+
+    def close(self):
+        for handle in reversed(self._handles):
+            try:
+                handle.close()
+            except Exception:
+                pass
+        self._handles = []
+
+
+def run_pipeline(file_stream, steps, timings=None):
+    """
+    Apply parsed pipeline steps to one document, parsing it once and saving
+    it once. Each step works on the document in memory, in whichever library
+    it needs. If timings is a list, it receives {"step", "seconds"} records
+    for loading, every step and saving.
+    """
+    def timed(step, started):
+        if timings is not None:
+            timings.append({"step": step, "seconds": round(time.perf_counter() - started, 4)})
+
+    started = time.perf_counter()
+    decrypt = steps[0][1]["password"] if steps[0][0] == "decrypt" else None
+    encrypt = steps[-1][1]["password"] if steps[-1][0] == "encrypt" else None
+    with _open_upload(file_stream) as upload:
+        try:
+            state = _PipelineDocument(upload, password=decrypt)
+        except (PdfError, PasswordError):
+            raise PdfError("Incorrect password or invalid PDF.")
+        try:
+            timed("load", started)
+            compact = False
+            for index, (op, params) in enumerate(steps):
+                started = time.perf_counter()
+                if op in ("decrypt", "encrypt"):
+                    continue  # part of loading and saving
+                if op == "rearrange":
+                    state.replace(_rearranged(state.pikepdf(), params["order"]))
+                elif op == "rotate":
+                    _rotate_pages(state.pikepdf(), params["degree"])
+                elif op == "watermark":
+                    _watermark_pdf(state.pikepdf(), **params)
+                elif op == "compress":
+                    preset = params.get("preset")
+                    if preset is not None:
+                        pdf, doc, data = state.aligned()
+                        _apply_compression_preset(pdf, doc, data, preset)
+                    state.pikepdf().remove_unreferenced_resources()
+                    if preset is not None and _fonttools_available():
+                        state.fitz().subset_fonts()
+                    compact = True
+                timed(op, started)
+                report_progress(index + 1, len(steps))
+
+            started = time.perf_counter()
+            encryption = None
+            if encrypt is not None:
+                encryption = Encryption(owner=encrypt, user=encrypt, allow=Permissions(extract=True))
+            output = _save_pdf(state, encryption=encryption, compact=compact)
+            timed("save", started)
+        finally:
+            state.close()
+    return output
+
+
+# ======== Sandboxed execution ========
+_in_sandbox = False
+
+
+def _sandboxed_call(settings, func, source, kwargs):
+    """
+    Runs in a sandbox worker: call func on a stream over an Upload's spool
+    path or bytes, with the settings of the app that sent it. Returns the
+    result and the dict and list arguments, which func may have filled in.
+    """
+    global _in_sandbox
+    _in_sandbox = True
+    app.config.update(settings)
+    with app.app_context(), (open(source, "rb") if isinstance(source, str) else io.BytesIO(source)) as stream:
+        result = func(stream, **kwargs)
+    return result, {name: value for name, value in kwargs.items() if isinstance(value, (dict, list))}
+
+
+def _sandboxed_iter(settings, func, source, kwargs):
+    """Like _sandboxed_call, for a func returning a generator."""
+    global _in_sandbox
+    _in_sandbox = True
+    app.config.update(settings)
+    with app.app_context(), (open(source, "rb") if isinstance(source, str) else io.BytesIO(source)) as stream:
+        yield from func(stream, **kwargs)
+
+
+def _sandbox():
+    """The sandbox of the current app, or None to run operations in-process."""
+    if _in_sandbox or not has_app_context():
+        return None
+    return current_app.extensions["pdftoolkit"]["sandbox"]
+
+
+def _isolated(func, file_stream, **kwargs):
+    """
+    Call func(file_stream, **kwargs), in a sandbox worker when SANDBOX is on.
+    Breaking the sandbox's limits raises sandbox.LimitExceeded.
+    """
+    box = _sandbox()
+    if box is None:
+        return func(file_stream, **kwargs)
+    settings = {name: current_app.config[name] for name in default_config()}
+    with _open_upload(file_stream) as upload:
+        result, filled = box.call(_sandboxed_call, settings, func, upload.path or upload.data, kwargs)
+    for name, value in filled.items():
+        if isinstance(value, dict):
+            kwargs[name].update(value)
+        else:
+            kwargs[name][:] = value
+    return result
+
+
+def _isolated_iter(func, file_stream, **kwargs):
+    """Like _isolated, for a func returning a generator; items are streamed back."""
+    box = _sandbox()
+    if box is None:
+        return func(file_stream, **kwargs)
+    settings = {name: current_app.config[name] for name in default_config()}
+    upload = _open_upload(file_stream)
+
+    def items():
+        try:
+            yield from box.iterate(_sandboxed_iter, settings, func, upload.path or upload.data, kwargs)
+        finally:
+            upload.close()
+
+    return items()
+
+
+def _split_stream(file_stream, ranges):
+    """split_pdf_entries as one generator: the part count, then the entries."""
+    part_count, entries = split_pdf_entries(file_stream, ranges)
+    yield part_count
+    yield from entries
+
+
 # ======== Routes ========
-@app.route("/")
+bp = Blueprint("pdftoolkit", __name__)
+
+
+def _result_cache() -> ResultCache:
+    return current_app.extensions["pdftoolkit"]["result_cache"]
+
+
+def _job_store() -> JobStore:
+    return current_app.extensions["pdftoolkit"]["job_store"]
+
+
+def _document_store() -> DocumentStore:
+    return current_app.extensions["pdftoolkit"]["document_store"]
+
+
+def _admission() -> admission.Admission:
+    return current_app.extensions["pdftoolkit"]["admission"]
+
+
+@bp.before_app_request
+def _track_request():
+    """Name the request for metrics by its route and time reading the form."""
+    if request.url_rule is not None:
+        metrics.set_operation(request.url_rule.rule)
+    if request.method == "POST":
+        with metrics.stage("upload"):
+            request.files
+
+
+def _failure(message, error, status):
+    """
+    Count a failed request by exception type and build its error response.
+    Inputs that broke the sandbox's limits are refused with 422, and requests
+    that found no free sandbox worker with 429.
+    """
+    metrics.count_error(error)
+    if isinstance(error, sandbox.LimitExceeded):
+        status = 422
+    if isinstance(error, sandbox.Busy):
+        retry_after = max(1, math.ceil(error.retry_after))
+        return f"Server busy: {str(error)}, retry in {retry_after}s", 429, {"Retry-After": str(retry_after)}
+    return f"{message}: {str(error)}", status
+
+
+def _result_key(operation, file_stream, **params):
+    return _result_cache().key(operation, stream_digest(file_stream), params)
+
+
+def _cached_response(key, download_name, mimetype=None):
+    """
+    Serve a cached result straight from its cache file, or return None on a miss.
+    """
+    path = _result_cache().get(key)
+    if path is None:
+        return None
+    response = send_file(path, download_name=download_name, as_attachment=True, mimetype=mimetype)
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+
+def _send_result(key, compute, download_name, mimetype=None, stats=None):
+    """
+    Serve the cached result for key, or compute it, cache it and send it.
+    A key of None means the result must not be cached: it is computed and
+    sent from memory. If stats is a dict for compute to fill, it is cached
+    with the result and filled from the cache on hits.
+    """
+    if key is None:
+        return send_file(compute(), download_name=download_name, as_attachment=True, mimetype=mimetype)
+    saved = _result_cache().get_meta(key) if stats is not None else None
+    if stats is None or saved is not None:
+        cached = _cached_response(key, download_name, mimetype)
+        if cached is not None:
+            if saved is not None:
+                stats.update(saved)
+            return cached
+    output = compute()
+    path = _result_cache().put(key, output)
+    if path is not None and stats is not None:
+        _result_cache().put_meta(key, stats)
+    response = send_file(path or output, download_name=download_name, as_attachment=True, mimetype=mimetype)
+    response.headers["X-Cache"] = "MISS"
+    return response
+
+
+def _stream_response(chunks, download_name, mimetype, cache_key=None):
+    """
+    Stream chunks to the client as an attachment. The first chunk is produced
+    before the response is returned, so errors on it still reach the route's
+    handlers. With a cache_key the body is also written to the result cache.
+    """
+    if cache_key is not None:
+        chunks = _result_cache().tee(cache_key, chunks)
+    first = next(chunks, b"")
+    response = Response(
+        stream_with_context(chain([first], chunks)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={download_name}"},
+    )
+    if cache_key is not None:
+        response.headers["X-Cache"] = "MISS"
+    return response
+
+
+def _zip_response(entries, download_name, cache_key=None):
+    """
+    Stream a ZIP of entries to the client, one entry at a time.
+    """
+    return _stream_response(iter_zip(entries), download_name, "application/zip", cache_key)
+
+
+def _pdf_uploads(files):
+    """
+    Return the non-empty uploads, or an error response if any is not a PDF.
+    """
+    uploads = [f for f in files if f.filename]
+    for file in uploads:
+        if not file.filename.lower().endswith(".pdf"):
+            return None, (f"Invalid file type: {file.filename}. Only PDFs are allowed.", 400)
+    if not uploads:
+        return None, ("No valid PDF files found", 400)
+    return uploads, None
+
+
+def _detach_uploads(files):
+    """
+    Return (filename, stream) pairs for the uploads and take the streams away
+    from the request. Flask closes request files when the view returns, which
+    is before a streamed response body has been consumed.
+    """
+    uploads = []
+    for file in files:
+        uploads.append((file.filename, file.stream))
+        file.stream = io.BytesIO()
+    return uploads
+
+
+def _batch_worker(operation, source, password):
+    """
+    Encrypt or decrypt one PDF given as a spool path or raw bytes.
+    Returns (pdf_bytes, None) or (None, error message) for PDF errors.
+    """
+    func = encrypt_pdf if operation == "encrypt" else decrypt_pdf
+    with (open(source, "rb") if isinstance(source, str) else io.BytesIO(source)) as stream:
+        try:
+            return func(stream, password).getvalue(), None
+        except PdfError as e:
+            return None, str(e)
+
+
+def _batch_entries(operation, uploads, password):
+    """
+    Yield ZIP entries for an encrypt/decrypt batch in upload order, running the
+    per-file work on up to BATCH_WORKERS processes. PDF errors become
+    error_<name>.txt entries.
+    """
+    opened = deque()
+
+    def sources():
+        for filename, stream in uploads:
+            upload = _open_upload(stream)
+            opened.append((filename, upload))
+            yield operation, upload.path or upload.data, password
+
+    prefix = {"encrypt": "encrypted_", "decrypt": "decrypted_"}[operation]
+    workers = min(_setting("BATCH_WORKERS"), len(uploads))
+    try:
+        for pdf_bytes, error in _ordered_map(_batch_worker, sources(), workers):
+            filename, upload = opened.popleft()
+            upload.close()
+            if error is None:
+                yield f"{prefix}{filename}", pdf_bytes
+            else:
+                yield f"error_{filename}.txt", error.encode("utf-8")
+    finally:
+        for _, upload in opened:
+            upload.close()
+        for _, stream in uploads:
+            stream.close()
+
+
+@bp.route("/")
 def home():
     return render_template("index.html")
 
 
-@app.route("/encrypt", methods=["POST"])
+@bp.route("/encrypt", methods=["POST"])
 def handle_encrypt():
     try:
         password = request.form.get("password")
@@ -359,32 +1921,19 @@ def handle_encrypt():
         if not password:
             return "Password is required", 400
 
-        zip_buffer = io.BytesIO()
-        pdf_count = 0
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for file in files:
-                if not file.filename:
-                    continue
-                if file.filename.lower().endswith(".pdf"):
-                    encrypted = encrypt_pdf(file.stream, password)
-                    zip_file.writestr(f"encrypted_{file.filename}", encrypted.read())
-                    pdf_count += 1
-                else:
-                    return f"Invalid file type: {file.filename}. Only PDFs are allowed.", 400
-
-        if pdf_count == 0:
-            return "No valid PDF files found", 400
+        uploads, error = _pdf_uploads(files)
+        if error:
+            return error
 
-        zip_buffer.seek(0)
-        return send_file(zip_buffer, download_name="encrypted_files.zip", as_attachment=True)
+        return _zip_response(_batch_entries("encrypt", _detach_uploads(uploads), password), "encrypted_files.zip")
 
     except PdfError as e:
-        return f"PDF Error: {str(e)}", 400
+        return _failure("PDF Error", e, 400)
     except Exception as e:
-        return f"Unexpected error: {str(e)}", 500
+        return _failure("Unexpected error", e, 500)
 
 
-@app.route("/decrypt", methods=["POST"])
+@bp.route("/decrypt", methods=["POST"])
 def handle_decrypt():
     try:
         password = request.form.get("password")
@@ -395,35 +1944,19 @@ def handle_decrypt():
         if not password:
             return "Password is required", 400
 
-        zip_buffer = io.BytesIO()
-        pdf_count = 0
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for file in files:
-                if not file.filename:
-                    continue
-                if file.filename.lower().endswith(".pdf"):
-                    try:
-                        decrypted = decrypt_pdf(file.stream, password)
-                        zip_file.writestr(f"decrypted_{file.filename}", decrypted.read())
-                        pdf_count += 1
-                    except PdfError as e:
-                        zip_file.writestr(f"error_{file.filename}.txt", str(e))
-                else:
-                    return f"Invalid file type: {file.filename}. Only PDFs are allowed.", 400
-
-        if pdf_count == 0:
-            return "No valid PDF files found", 400
-
-        zip_buffer.seek(0)
-        return send_file(zip_buffer, download_name="decrypted_files.zip", as_attachment=True)
+        uploads, error = _pdf_uploads(files)
+        if error:
+            return error
+
+        return _zip_response(_batch_entries("decrypt", _detach_uploads(uploads), password), "decrypted_files.zip")
 
     except PdfError as e:
-        return f"Decryption failed: {str(e)}", 400
+        return _failure("Decryption failed", e, 400)
     except Exception as e:
-        return f"Unexpected error: {str(e)}", 500
+        return _failure("Unexpected error", e, 500)
 
 
-@app.route("/merge", methods=["POST"])
+@bp.route("/merge", methods=["POST"])
 def handle_merge():
     try:
         files = request.files.getlist("pdfs")
@@ -434,16 +1967,20 @@ def handle_merge():
         if len(valid_files) < 2:
             return "Please upload at least 2 PDF files to merge", 400
 
-        merged = merge_pdfs(valid_files)
+        merged = merge_pdfs(
+            valid_files,
+            dedupe=request.form.get("dedupe") in ("1", "true", "on"),
+            bookmarks=request.form.get("bookmarks") in ("1", "true", "on"),
+        )
         return send_file(merged, download_name="merged.pdf", as_attachment=True)
 
     except PdfError as e:
-        return f"Merge failed: {str(e)}", 400
+        return _failure("Merge failed", e, 400)
     except Exception as e:
-        return f"Merge error: {str(e)}", 500
+        return _failure("Merge error", e, 500)
 
 
-@app.route("/split", methods=["POST"])
+@bp.route("/split", methods=["POST"])
 def handle_split():
     try:
         file = request.files.get("pdf")
@@ -456,18 +1993,40 @@ def handle_split():
         if not ranges:
             return "Missing page ranges", 400
 
-        buf, download_name, mimetype = split_pdf(file.stream, ranges)
-        return send_file(buf, download_name=download_name, as_attachment=True, mimetype=mimetype)
+        key = _result_key("split", file.stream, pages="".join(ranges.lower().split()))
+        path = _result_cache().get(key)
+        if path is not None:
+            with open(path, "rb") as f:
+                is_zip = f.read(2) == b"PK"
+            if is_zip:
+                return _cached_response(key, "split_files.zip", "application/zip")
+            return _cached_response(key, "split.pdf", "application/pdf")
+
+        entries = _isolated_iter(_split_stream, file.stream, ranges=ranges)
+        part_count = next(entries)
+        if part_count > 1:
+            return _zip_response(entries, "split_files.zip", cache_key=key)
+        pdf_bytes = next(entries)[1]
+        next(entries, None)  # run the generator to its end, which frees its worker
+        return _send_result(key, lambda: io.BytesIO(pdf_bytes), "split.pdf", "application/pdf")
 
     except ValueError as e:
-        return f"Invalid input: {str(e)}", 400
+        return _failure("Invalid input", e, 400)
     except PdfError as e:
-        return f"PDF Error: {str(e)}", 400
+        return _failure("PDF Error", e, 400)
     except Exception as e:
-        return f"Unexpected error: {str(e)}", 500
+        return _failure("Unexpected error", e, 500)
+
 
+def _form_preset():
+    """The compression preset named in the request form, or None; raises ValueError."""
+    preset = request.form.get("preset") or None
+    if preset is not None and preset not in COMPRESSION_PRESETS:
+        raise ValueError("Preset must be one of screen, ebook or print")
+    return preset
 
-@app.route("/compress", methods=["POST"])
+
+@bp.route("/compress", methods=["POST"])
 def handle_compress():
     try:
         file = request.files.get("pdf")
@@ -476,13 +2035,24 @@ def handle_compress():
         if not file.filename.lower().endswith(".pdf"):
             return "Invalid file type. Only PDFs are allowed.", 400
 
-        compressed = compress_pdf(file.stream)
-        return send_file(compressed, download_name="compressed.pdf", as_attachment=True)
+        try:
+            preset = _form_preset()
+        except ValueError as e:
+            return str(e), 400
+
+        key = _result_key("compress", file.stream, preset=preset)
+        stats = {} if preset else None
+        response = _send_result(
+            key, lambda: _isolated(compress_pdf, file.stream, preset=preset, stats=stats), "compressed.pdf", stats=stats
+        )
+        if stats:
+            response.headers["X-Compression-Stats"] = json.dumps(stats)
+        return response
     except Exception as e:
-        return f"Compression failed: {str(e)}", 500
+        return _failure("Compression failed", e, 500)
 
 
-@app.route("/extract_text", methods=["POST"])
+@bp.route("/extract_text", methods=["POST"])
 def handle_extract_text():
     try:
         file = request.files.get("pdf")
@@ -491,18 +2061,27 @@ def handle_extract_text():
         if not file.filename.lower().endswith(".pdf"):
             return "Invalid file type. Only PDFs are allowed.", 400
 
-        text_output = extract_text_from_pdf(file.stream)
-        return send_file(
-            text_output,
-            download_name="extracted_text.txt",
-            as_attachment=True,
-            mimetype="text/plain",
-        )
+        fmt = request.form.get("format", "text").lower()
+        detail = request.form.get("detail") or None
+        if fmt not in TEXT_FORMATS:
+            return "Format must be one of text, ndjson or json", 400
+        if detail not in (None, "blocks", "words"):
+            return "Detail must be blocks or words", 400
+        options = {"pages": "".join(request.form.get("pages", "").split()), "fmt": fmt, "detail": detail}
+        download_name, mimetype = TEXT_FORMATS[fmt]
+
+        key = _result_key("extract_text", file.stream, **options)
+        cached = _cached_response(key, download_name, mimetype)
+        if cached is not None:
+            return cached
+        return _stream_response(_isolated_iter(extract_text_chunks, file.stream, **options), download_name, mimetype, cache_key=key)
+    except ValueError as e:
+        return _failure("Invalid input", e, 400)
     except Exception as e:
-        return f"Text extraction failed: {str(e)}", 500
+        return _failure("Text extraction failed", e, 500)
 
 
-@app.route("/extract_images", methods=["POST"])
+@bp.route("/extract_images", methods=["POST"])
 def handle_extract_images():
     try:
         file = request.files.get("pdf")
@@ -511,18 +2090,22 @@ def handle_extract_images():
         if not file.filename.lower().endswith(".pdf"):
             return "Invalid file type. Only PDFs are allowed.", 400
 
-        images_zip = extract_images_from_pdf(file.stream)
-        return send_file(
-            images_zip,
-            download_name="extracted_images.zip",
-            as_attachment=True,
-            mimetype="application/zip",
+        min_size = request.form.get("min_size", 0, type=int)
+        if min_size < 0:
+            return "Minimum size must not be negative", 400
+
+        key = _result_key("extract_images", file.stream, min_size=min_size)
+        cached = _cached_response(key, "extracted_images.zip", "application/zip")
+        if cached is not None:
+            return cached
+        return _zip_response(
+            _isolated_iter(extract_image_entries, file.stream, min_size=min_size), "extracted_images.zip", cache_key=key
         )
     except Exception as e:
-        return f"Image extraction failed: {str(e)}", 500
+        return _failure("Image extraction failed", e, 500)
 
 
-@app.route("/ocr", methods=["POST"])
+@bp.route("/ocr", methods=["POST"])
 def handle_ocr():
     try:
         file = request.files.get("pdf")
@@ -530,19 +2113,28 @@ def handle_ocr():
             return "No file uploaded", 400
         if not file.filename.lower().endswith(".pdf"):
             return "Invalid file type. Only PDFs are allowed.", 400
-
-        ocr_output = ocr_pdf(file.stream)
-        return send_file(
-            ocr_output,
-            download_name="ocr_processed.pdf",
-            as_attachment=True,
-            mimetype="application/pdf",
+        dpi = request.form.get("dpi", type=int)
+        if dpi is not None and not 36 <= dpi <= 600:
+            return "DPI must be between 36 and 600", 400
+        skip_text = request.form.get("skip_text", "").lower() in ("1", "true", "on")
+
+        key = _result_key("ocr", file.stream, dpi=dpi or _setting("OCR_DPI"), skip_text=skip_text)
+        stats = {}
+        response = _send_result(
+            key,
+            lambda: _isolated(ocr_pdf, file.stream, dpi=dpi, skip_text=skip_text, stats=stats),
+            "ocr_processed.pdf",
+            "application/pdf",
+            stats=stats,
         )
+        if stats:
+            response.headers["X-OCR-Stats"] = json.dumps(stats)
+        return response
     except Exception as e:
-        return f"OCR processing failed: {str(e)}", 500
+        return _failure("OCR processing failed", e, 500)
 
 
-@app.route("/rearrange", methods=["POST"])
+@bp.route("/rearrange", methods=["POST"])
 def handle_rearrange():
     try:
         file = request.files.get("pdf")
@@ -555,16 +2147,18 @@ def handle_rearrange():
         if not order:
             return "Missing page order", 400
 
-        rearranged = rearrange_pdf_pages(file.stream, order)
-        return send_file(rearranged, download_name="rearranged.pdf", as_attachment=True, mimetype="application/pdf")
+        key = _result_key("rearrange", file.stream, order="".join(order.split()))
+        return _send_result(
+            key, lambda: _isolated(rearrange_pdf_pages, file.stream, order=order), "rearranged.pdf", "application/pdf"
+        )
 
     except ValueError as e:
-        return f"Invalid input: {str(e)}", 400
+        return _failure("Invalid input", e, 400)
     except Exception as e:
-        return f"Rearrangement failed: {str(e)}", 500
+        return _failure("Rearrangement failed", e, 500)
 
 
-@app.route("/rotate", methods=["POST"])
+@bp.route("/rotate", methods=["POST"])
 def handle_rotate():
     try:
         file = request.files.get("pdf")
@@ -573,49 +2167,650 @@ def handle_rotate():
             return "No file uploaded", 400
         if not degree:
             return "Rotation degree required", 400
-        rotated = rotate_pdf(file.stream, degree)
-        return send_file(rotated, download_name="rotated.pdf", as_attachment=True)
+        key = _result_key("rotate", file.stream, degree=degree)
+        return _send_result(key, lambda: _isolated(rotate_pdf, file.stream, degree=degree), "rotated.pdf")
     except Exception as e:
-        return f"Rotation failed: {str(e)}", 500
-
-
-@app.route("/pdf_to_images", methods=["POST"])
+        return _failure("Rotation failed", e, 500)
+
+
+def _form_image_options():
+    """pdf_to_image_entries options from the request form; raises ValueError."""
+    dpi = request.form.get("dpi", 72, type=int)
+    fmt = request.form.get("format", "png").lower()
+    quality = request.form.get("quality", 85, type=int)
+    if not 18 <= dpi <= 600:
+        raise ValueError("DPI must be between 18 and 600")
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError("Format must be one of png, jpeg or webp")
+    if not 1 <= quality <= 95:
+        raise ValueError("Quality must be between 1 and 95")
+    return {
+        "dpi": dpi,
+        "fmt": fmt,
+        "quality": quality,
+        "pages": "".join(request.form.get("pages", "").split()),
+        "grayscale": request.form.get("colorspace", "rgb").lower() in ("gray", "grey", "grayscale"),
+    }
+
+
+@bp.route("/pdf_to_images", methods=["POST"])
 def handle_pdf_to_images():
     try:
         file = request.files.get("pdf")
         if not file or not file.filename:
             return "No file uploaded", 400
-        images_zip = pdf_to_images(file.stream)
-        return send_file(images_zip, download_name="pdf_images.zip", as_attachment=True)
+        try:
+            options = _form_image_options()
+        except ValueError as e:
+            return str(e), 400
+
+        key = _result_key("pdf_to_images", file.stream, **options)
+        cached = _cached_response(key, "pdf_images.zip", "application/zip")
+        if cached is not None:
+            return cached
+        return _zip_response(_isolated_iter(pdf_to_image_entries, file.stream, **options), "pdf_images.zip", cache_key=key)
+    except ValueError as e:
+        return _failure("Invalid input", e, 400)
     except Exception as e:
-        return f"Conversion failed: {str(e)}", 500
+        return _failure("Conversion failed", e, 500)
 
 
-@app.route("/images_to_pdf", methods=["POST"])
+@bp.route("/images_to_pdf", methods=["POST"])
 def handle_images_to_pdf():
     try:
-        files = request.files.getlist("images")
-        if not files or not any(f.filename for f in files):
+        files = [f for f in request.files.getlist("images") if f.filename]
+        if not files:
             return "No images uploaded", 400
-        pdf_output = images_to_pdf(files)
+        page_size = request.form.get("page_size", "image").lower()
+        orientation = request.form.get("orientation", "auto").lower()
+        fit = request.form.get("fit", "contain").lower()
+        margin = request.form.get("margin", 0, type=float)
+        if page_size != "image" and page_size not in PAGE_SIZES:
+            return f"Page size must be image or one of {', '.join(PAGE_SIZES)}", 400
+        if orientation not in ("auto", "portrait", "landscape"):
+            return "Orientation must be auto, portrait or landscape", 400
+        if fit not in IMAGE_FITS:
+            return f"Fit must be one of {', '.join(IMAGE_FITS)}", 400
+        if not 0 <= margin <= 144:
+            return "Margin must be between 0 and 144 points", 400
+
+        pdf_output = images_to_pdf(files, page_size=page_size, orientation=orientation, fit=fit, margin=margin)
         return send_file(pdf_output, download_name="images_to.pdf", as_attachment=True)
+    except ValueError as e:
+        return _failure("Invalid input", e, 400)
     except Exception as e:
-        return f"Conversion failed: {str(e)}", 500
+        return _failure("Conversion failed", e, 500)
 
 
-@app.route("/watermark", methods=["POST"])
+@bp.route("/watermark", methods=["POST"])
 def handle_watermark():
     try:
         file = request.files.get("pdf")
         text = request.form.get("text")
+        image = request.files.get("image")
         if not file or not file.filename:
             return "No file uploaded", 400
-        if not text:
-            return "Watermark text required", 400
-        watermarked = add_watermark(file.stream, text)
-        return send_file(watermarked, download_name="watermarked.pdf", as_attachment=True)
+        image_bytes = image.read() if image and image.filename else None
+        if not text and not image_bytes:
+            return "Watermark text or image required", 400
+        if text and image_bytes:
+            return "Give either watermark text or an image, not both", 400
+        options = _watermark_options(
+            opacity=request.form.get("opacity", 0.3, type=float),
+            position=request.form.get("position") or "center",
+            angle=request.form.get("angle", type=float),
+            font_size=request.form.get("font_size", 50, type=float),
+            color=request.form.get("color") or "#cccccc",
+            scale=request.form.get("scale", 0.5, type=float),
+            pages=request.form.get("pages"),
+        )
+
+        image_digest = hashlib.sha256(image_bytes).hexdigest() if image_bytes else None
+        key = _result_key("watermark", file.stream, text=text, image=image_digest, **options)
+        return _send_result(
+            key, lambda: _isolated(add_watermark, file.stream, text=text, image=image_bytes, **options), "watermarked.pdf"
+        )
+    except ValueError as e:
+        return _failure("Invalid input", e, 400)
+    except Exception as e:
+        return _failure("Watermarking failed", e, 500)
+
+
+@bp.route("/pipeline", methods=["POST"])
+def handle_pipeline():
+    try:
+        file = request.files.get("pdf")
+        if not file or not file.filename:
+            return "No file uploaded", 400
+        if not file.filename.lower().endswith(".pdf"):
+            return "Invalid file type. Only PDFs are allowed.", 400
+        steps = parse_pipeline_steps(request.form.get("steps"))
+
+        # Flattened so that passwords are keyed by HMAC like everywhere else.
+        params = {
+            f"step{index}_{name}": value
+            for index, (op, step_params) in enumerate(steps)
+            for name, value in [("op", op), *sorted(step_params.items())]
+        }
+        # Like /decrypt, a result left decrypted is never written to disk.
+        decrypted = any(op == "decrypt" for op, _ in steps) and steps[-1][0] != "encrypt"
+        key = None if decrypted else _result_key("pipeline", file.stream, **params)
+        timings = []
+        response = _send_result(
+            key, lambda: _isolated(run_pipeline, file.stream, steps=steps, timings=timings), "processed.pdf", "application/pdf"
+        )
+        if timings:
+            response.headers["X-Pipeline-Timings"] = json.dumps(timings)
+        return response
+    except ValueError as e:
+        return _failure("Invalid input", e, 400)
+    except PdfError as e:
+        return _failure("PDF Error", e, 400)
+    except Exception as e:
+        return _failure("Pipeline failed", e, 500)
+
+
+@bp.route("/inspect", methods=["POST"])
+def handle_inspect():
+    """
+    Report on a PDF without rendering it: pages, encryption, page sizes,
+    images, text layers, and the estimated cost of each operation on it
+    against the server's limits, so clients can plan their requests.
+    """
+    try:
+        file = request.files.get("pdf")
+        if not file or not file.filename:
+            return "No file uploaded", 400
+        if not file.filename.lower().endswith(".pdf"):
+            return "Invalid file type. Only PDFs are allowed.", 400
+        password = request.form.get("password")
+
+        with _open_upload(file.stream) as upload:
+            try:
+                pdf = upload.open_pikepdf(password=password) if password else upload.open_pikepdf()
+            except PasswordError:
+                report = {"pages": None, "encrypted": True, "needs_password": True}
+            else:
+                with metrics.stage("parse"):
+                    report = preflight.inspect_pdf(pdf)
+            size = upload.size
+
+        pages = report["pages"] or 0
+        report = {"filename": file.filename, "size": size, **report}
+        report["cost"] = {
+            operation: admission.estimate_cost(operation, size, pages)
+            for operation in admission.OPERATIONS
+            if operation not in ("documents", "inspect")
+        }
+        report["limits"] = {
+            "max_pages": _setting("MAX_PAGES"),
+            "max_request_cost": _setting("MAX_REQUEST_COST"),
+            "max_upload_bytes": _setting("MAX_CONTENT_LENGTH"),
+        }
+        return jsonify(report)
+    except PdfError as e:
+        return _failure("PDF Error", e, 400)
+    except Exception as e:
+        return _failure("Inspection failed", e, 500)
+
+
+@bp.route("/cache/stats", methods=["GET"])
+def handle_cache_stats():
+    return jsonify(_result_cache().stats())
+
+
+@bp.route("/metrics", methods=["GET"])
+def handle_metrics():
+    return Response(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ======== Background jobs ========
+def _tracked_job(job_app, operation, body, paths):
+    """
+    Run a job body in its app's context, with its metrics recorded under
+    "job <operation>".
+    """
+    with job_app.app_context(), metrics.track(f"job {operation}"):
+        return body(paths)
+
+
+def _run_on_paths(func, paths, **kwargs):
+    """
+    Job body for single-file operations: open the saved upload and run func.
+    Jobs are already queued, so they keep waiting while the sandbox is busy.
+    """
+    with open(paths[0], "rb") as f:
+        while True:
+            try:
+                return _isolated(func, f, **kwargs)
+            except sandbox.Busy:
+                f.seek(0)
+
+
+def _run_merge(paths):
+    files = [open(path, "rb") for path in paths]
+    try:
+        return merge_pdfs(files)
+    finally:
+        for f in files:
+            f.close()
+
+
+# operation -> (job body, download name, mimetype)
+JOB_OPERATIONS = {
+    "ocr": (ocr_pdf, "ocr_processed.pdf", "application/pdf"),
+    "pdf_to_images": (pdf_to_images, "pdf_images.zip", "application/zip"),
+    "compress": (compress_pdf, "compressed.pdf", "application/pdf"),
+    "extract_text": (extract_text_from_pdf, "extracted_text.txt", "text/plain"),
+    "merge": (_run_merge, "merged.pdf", "application/pdf"),
+}
+
+
+@bp.route("/jobs/<operation>", methods=["POST"])
+def handle_job_submit(operation):
+    try:
+        if operation not in JOB_OPERATIONS:
+            return f"Unsupported job operation: {operation}", 404
+        func, download_name, mimetype = JOB_OPERATIONS[operation]
+
+        if operation == "merge":
+            files = request.files.getlist("pdfs")
+            valid_files = [f for f in files if f.filename and f.filename.lower().endswith(".pdf")]
+            if len(valid_files) < 2:
+                return "Please upload at least 2 PDF files to merge", 400
+            body = func
+        else:
+            file = request.files.get("pdf")
+            if not file or not file.filename:
+                return "No file uploaded", 400
+            if not file.filename.lower().endswith(".pdf"):
+                return "Invalid file type. Only PDFs are allowed.", 400
+            valid_files = [file]
+            kwargs = {}
+            if operation == "ocr":
+                dpi = request.form.get("dpi", type=int)
+                if dpi is not None and not 36 <= dpi <= 600:
+                    return "DPI must be between 36 and 600", 400
+                kwargs["dpi"] = dpi
+                kwargs["skip_text"] = request.form.get("skip_text", "").lower() in ("1", "true", "on")
+            try:
+                # The same options as the synchronous routes.
+                if operation == "compress":
+                    kwargs["preset"] = _form_preset()
+                elif operation == "pdf_to_images":
+                    kwargs.update(_form_image_options())
+            except ValueError as e:
+                return str(e), 400
+            body = partial(_run_on_paths, func, **kwargs)
+
+        job_id = _job_store().submit(
+            operation,
+            partial(_tracked_job, current_app._get_current_object(), operation, body),
+            [(f.filename, f.stream) for f in valid_files],
+            download_name,
+            mimetype,
+        )
+        return jsonify({"job_id": job_id, "status_url": url_for(".handle_job_status", job_id=job_id)}), 202
     except Exception as e:
-        return f"Watermarking failed: {str(e)}", 500
+        return _failure("Job submission failed", e, 500)
+
+
+@bp.route("/jobs/<job_id>", methods=["GET"])
+def handle_job_status(job_id):
+    meta = _job_store().status(job_id)
+    if meta is None:
+        return "Job not found", 404
+    status = {key: meta[key] for key in ("job_id", "operation", "status", "progress", "error")}
+    if meta["status"] == "done":
+        status["result_url"] = url_for(".handle_job_result", job_id=job_id)
+    return jsonify(status)
+
+
+@bp.route("/jobs/<job_id>/result", methods=["GET"])
+def handle_job_result(job_id):
+    path = _job_store().result_path(job_id)
+    if path is None:
+        return "Job result not available", 404
+    meta = _job_store().status(job_id)
+    return send_file(path, download_name=meta["download_name"], as_attachment=True, mimetype=meta["mimetype"])
+
+
+# ======== Document sessions ========
+# Single-file operations that can also run on a stored document, as
+# POST /documents/<document_id>/<operation>, with the same form fields minus
+# the upload. The values say how the document may be used: "read" operations
+# never modify the handles they open, so they reuse its parsed handles; "save"
+# operations produce a PDF that can replace the document (save=1).
+DOCUMENT_OPERATIONS = {
+    "split": (handle_split, ("read",)),
+    "compress": (handle_compress, ("save",)),
+    "extract_text": (handle_extract_text, ("read",)),
+    "extract_images": (handle_extract_images, ("read",)),
+    "ocr": (handle_ocr, ("read", "save")),  # renders the pages, and returns a new PDF
+    "rearrange": (handle_rearrange, ("save",)),
+    "rotate": (handle_rotate, ("save",)),
+    "pdf_to_images": (handle_pdf_to_images, ("read",)),
+    "watermark": (handle_watermark, ("save",)),
+    "pipeline": (handle_pipeline, ("save",)),
+    "inspect": (handle_inspect, ("read",)),
+}
+for _name, (_view, _) in DOCUMENT_OPERATIONS.items():
+    bp.add_url_rule(f"/documents/<document_id>/{_name}", view_func=_view, methods=["POST"])
+
+
+def _document_info(meta):
+    info = {key: meta[key] for key in ("document_id", "filename", "size", "pages", "version")}
+    info["expires_in"] = _document_store().ttl
+    info["download_url"] = url_for(".handle_document_download", document_id=meta["document_id"])
+    return info
+
+
+def _save_requested():
+    return request.values.get("save", "").lower() in ("1", "true", "on")
+
+
+@bp.url_value_preprocessor
+def _pull_document_id(endpoint, values):
+    """Take the document id off stored-document operation URLs."""
+    g.document_operation = None
+    if values and request.url_rule is not None and request.url_rule.rule.startswith("/documents/<document_id>/"):
+        operation = request.url_rule.rule.rsplit("/", 1)[1]
+        if operation in DOCUMENT_OPERATIONS:
+            g.document_operation = operation
+            g.document_id = values.pop("document_id")
+
+
+@bp.before_request
+def _load_document():
+    """
+    Hand a stored document to the operation as its "pdf" upload. The file is
+    closed with the request's other files.
+    """
+    operation = g.document_operation
+    if operation is None:
+        return None
+    if _save_requested() and "save" not in DOCUMENT_OPERATIONS[operation][1]:
+        return f"The result of {operation} cannot replace the document", 400
+    meta = _document_store().get(g.document_id)
+    if meta is None:
+        return "Document not found", 404
+    g.document = meta
+    stream = _document_store().open(meta, reuse_handles="read" in DOCUMENT_OPERATIONS[operation][1])
+    files = request.files.copy()
+    files["pdf"] = FileStorage(stream, filename=meta["filename"], name="pdf", content_type="application/pdf")
+    request.files = ImmutableMultiDict(files)
+    return None
+
+
+@bp.after_request
+def _save_document(response):
+    """Make a PDF result the document's new version when save=1 was asked for."""
+    if g.get("document_operation") is None or not _save_requested() or response.status_code != 200:
+        return response
+    if response.mimetype != "application/pdf":
+        response.close()
+        return make_response((f"The result of {g.document_operation} cannot replace the document", 400))
+    try:
+        meta = _document_store().replace(g.document_id, response.iter_encoded())
+    except PdfError as e:
+        return make_response(_failure("Result is not a valid PDF", e, 500))
+    finally:
+        response.close()
+    if meta is None:
+        return make_response(("Document not found", 404))
+    return jsonify(_document_info(meta))
+
+
+@bp.route("/documents", methods=["POST"])
+def handle_document_create():
+    try:
+        file = request.files.get("pdf")
+        if not file or not file.filename:
+            return "No file uploaded", 400
+        if not file.filename.lower().endswith(".pdf"):
+            return "Invalid file type. Only PDFs are allowed.", 400
+
+        with metrics.stage("upload"):
+            meta = _document_store().create(file.stream, file.filename)
+        return jsonify(_document_info(meta)), 201
+    except PdfError as e:
+        return _failure("PDF Error", e, 400)
+    except Exception as e:
+        return _failure("Document upload failed", e, 500)
+
+
+@bp.route("/documents/<document_id>", methods=["GET"])
+def handle_document_status(document_id):
+    meta = _document_store().get(document_id)
+    if meta is None:
+        return "Document not found", 404
+    return jsonify(_document_info(meta))
+
+
+@bp.route("/documents/<document_id>/download", methods=["GET"])
+def handle_document_download(document_id):
+    meta = _document_store().get(document_id)
+    if meta is None:
+        return "Document not found", 404
+    return send_file(
+        _document_store().path(meta), download_name=meta["filename"], as_attachment=True, mimetype="application/pdf"
+    )
+
+
+@bp.route("/documents/<document_id>", methods=["DELETE"])
+def handle_document_delete(document_id):
+    if not _document_store().delete(document_id):
+        return "Document not found", 404
+    return "", 204
+
+
+# ======== Admission control ========
+def _admission_operation():
+    """
+    The operation a request runs, for admission, and whether it is only
+    queued (a background job). None for requests that run no operation.
+    """
+    if request.endpoint == "pdftoolkit.handle_job_submit":
+        return request.view_args.get("operation"), True
+    if request.endpoint == "pdftoolkit.handle_document_create":
+        return "documents", False
+    operation = (request.endpoint or "").rpartition(".handle_")[2]
+    if request.method == "POST" and operation in admission.OPERATIONS:
+        return operation, False
+    return None, False
+
+
+def _count_pages(file_stream):
+    """Page count of an upload, or 0 if it cannot be read; the operation reports that."""
+    try:
+        return preflight.quick_check(file_stream)["pages"] or 0
+    except PdfError:
+        return 0
+
+
+def _charged_as(operation):
+    """
+    The operation whose class and per-page cost a request is charged at:
+    its own, except for a pipeline with a compress preset, which recompresses
+    images like /compress does.
+    """
+    if operation != "pipeline":
+        return operation
+    try:
+        steps = parse_pipeline_steps(request.form.get("steps"))
+    except ValueError:
+        return operation  # refused by the route
+    if any(op == "compress" and params.get("preset") for op, params in steps):
+        return "compress"
+    return operation
+
+
+def _over_limits(operation, queued, size, pages, charged_as):
+    """
+    Estimate the request's cost. Returns (cost, None), or (cost, error
+    response) when the request is over MAX_PAGES or, unless it is a
+    background job, MAX_REQUEST_COST.
+    """
+    cost = admission.estimate_cost(charged_as, size, pages)
+    if operation == "inspect":
+        return cost, None
+    if pages > _setting("MAX_PAGES"):
+        admission.REJECTED.inc(operation=operation, reason="page limit")
+        return cost, (f"Too many pages: {pages} (limit {_setting('MAX_PAGES')})", 413)
+    if not queued and cost > _setting("MAX_REQUEST_COST"):
+        admission.REJECTED.inc(operation=operation, reason="cost limit")
+        message = f"Request too expensive: estimated cost {cost} (limit {_setting('MAX_REQUEST_COST')})"
+        if operation in JOB_OPERATIONS:
+            message += f"; submit it as a background job with POST /jobs/{operation}"
+        return cost, (message, 413)
+    return cost, None
+
+
+def _preflight(operation, queued, charged_as):
+    """
+    Validate a request's uploads before it is admitted: a single PDF upload
+    that is unreadable or needs a password is refused with 400, and requests
+    over the page or cost limits with 413. Reading only the cross-reference
+    table and page tree, this takes milliseconds. Returns (cost, None) or
+    (None, error response). Background jobs report unreadable files through
+    their status instead, and /inspect reports on any file.
+    """
+    document = g.get("document")
+    if document is not None:
+        return _over_limits(operation, queued, document["size"], document["pages"], charged_as)
+    size = request.content_length or 0
+    if operation == "images_to_pdf":
+        return _over_limits(operation, queued, size, len(request.files.getlist("images")), charged_as)
+    if operation == "documents":
+        return _over_limits(operation, queued, size, 0, charged_as)
+
+    files = [f for f in request.files.getlist("pdf") + request.files.getlist("pdfs") if f.filename]
+    if len(files) != 1 or "pdf" not in request.files or operation == "inspect":
+        return _over_limits(operation, queued, size, sum(_count_pages(f.stream) for f in files), charged_as)
+    try:
+        check = preflight.quick_check(files[0].stream)
+    except PdfError as e:
+        if queued:
+            return _over_limits(operation, queued, size, 0, charged_as)
+        return None, _failure("PDF Error", e, 400)
+    if check["needs_password"] and operation != "pipeline":
+        return None, ("PDF is password protected; decrypt it first", 400)
+    return _over_limits(operation, queued, size, check["pages"] or 0, charged_as)
+
+
+@bp.before_request
+def _admit_request():
+    """
+    Validate the request, charge the client for its estimated cost and wait
+    for a slot of its operation class. Refused requests get 400 or 413, or
+    429 when the server or the client's budget is busy.
+    """
+    operation, queued = _admission_operation()
+    if operation is None:
+        return None
+    charged_as = _charged_as(operation)
+    cost, error = _preflight(operation, queued, charged_as)
+    if error is not None:
+        return make_response(error)
+    try:
+        g.admission_ticket = _admission().admit(operation, request.remote_addr, cost, queued, charged_as=charged_as)
+    except admission.Rejected as e:
+        message = "Rate limit exceeded" if e.reason == "client budget" else f"Server busy ({e.reason})"
+        response = make_response((f"{message}, retry in {e.retry_after}s", 429))
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response
+    return None
+
+
+@bp.after_request
+def _hold_admission(response):
+    """
+    Keep the request's slot until a streamed body has been produced. Files
+    from send_file are already computed, so their slot is freed now.
+    """
+    ticket = g.pop("admission_ticket", None)
+    if ticket is None:
+        return response
+    if response.direct_passthrough or not response.is_streamed:
+        _admission().release(ticket)
+    else:
+        response.response = _release_when_done(response.response, partial(_admission().release, ticket))
+    return response
+
+
+def _release_when_done(body, release):
+    # The finally clause runs when the body is exhausted or closed.
+    try:
+        yield from body
+    finally:
+        release()
+
+
+@bp.teardown_request
+def _release_admission(error):
+    # Only still set when the request failed before _hold_admission ran.
+    ticket = g.pop("admission_ticket", None)
+    if ticket is not None:
+        _admission().release(ticket)
+
+
+# ======== App factory ========
+def create_app(config=None):
+    """
+    Build the web app. Settings come from the environment (default_config),
+    with config applied on top. Every app gets its own job store, result
+    cache, document store and admission limits. PDF and image backends load on first use, so
+    this is cheap.
+    """
+    new_app = Flask(__name__)
+    new_app.config.update(default_config())
+    new_app.config.update(config or {})
+    new_app.wsgi_app = metrics.WSGIMiddleware(profiling.ProfilingMiddleware(new_app.wsgi_app, new_app.config))
+    new_app.extensions["pdftoolkit"] = {
+        "job_store": JobStore(
+            new_app.config["JOBS_DIR"],
+            workers=new_app.config["JOB_WORKERS"],
+            ttl=new_app.config["JOB_TTL"],
+            timeout=new_app.config["JOB_TIMEOUT"],
+        ),
+        "result_cache": ResultCache(
+            new_app.config["RESULT_CACHE_DIR"],
+            new_app.config["RESULT_CACHE_MAX_BYTES"],
+            secret=(new_app.config["SECRET_KEY"] or "").encode("utf-8") or None,
+        ),
+        "ocr_cache": ResultCache(new_app.config["OCR_CACHE_DIR"], new_app.config["OCR_CACHE_MAX_BYTES"]),
+        "document_store": DocumentStore(
+            new_app.config["DOCUMENTS_DIR"],
+            ttl=new_app.config["DOCUMENT_TTL"],
+            cache_bytes=new_app.config["DOCUMENT_CACHE_MAX_BYTES"],
+        ),
+        "sandbox": sandbox.Sandbox(
+            workers=new_app.config["SANDBOX_WORKERS"],
+            max_tasks=new_app.config["SANDBOX_MAX_TASKS"],
+            memory_bytes=new_app.config["SANDBOX_MEMORY_MB"] * 1024 * 1024,
+            cpu_seconds=new_app.config["SANDBOX_CPU_SECONDS"],
+            timeout=new_app.config["SANDBOX_TIMEOUT"],
+            wait_seconds=new_app.config["SANDBOX_QUEUE_SECONDS"],
+        ) if new_app.config["SANDBOX"] else None,
+        "admission": admission.Admission(
+            heavy_slots=new_app.config["ADMISSION_HEAVY_SLOTS"],
+            light_slots=new_app.config["ADMISSION_LIGHT_SLOTS"],
+            max_waiting=new_app.config["ADMISSION_MAX_QUEUE"],
+            wait_seconds=new_app.config["ADMISSION_QUEUE_SECONDS"],
+            client_per_minute=new_app.config["CLIENT_COST_PER_MINUTE"],
+            client_burst=new_app.config["CLIENT_COST_BURST"],
+        ),
+    }
+    new_app.register_blueprint(bp)
+    return new_app
+
+
+# The default app, for "gunicorn flask_app:app" and for operations called
+# outside a request.
+app = create_app()
+job_store = app.extensions["pdftoolkit"]["job_store"]
+result_cache = app.extensions["pdftoolkit"]["result_cache"]
+document_store = app.extensions["pdftoolkit"]["document_store"]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+"""
+Upload ingestion for PDF operations.
+
+An Upload copies the incoming stream once, in chunks. Small uploads stay in
+memory; anything above the spool threshold goes to a named temp file that
+pikepdf maps with AccessMode.mmap and PyMuPDF opens by path, so large files
+cost page cache rather than Python heap. Every handle opened through an
+Upload is closed, and its temp file removed, when the Upload is closed.
+Opening is timed as the "parse" stage, and the first handle opened counts the
+document's pages, for the request metrics.
+
+A stream with a parsed_handles pool (a stored document, see sessions.py)
+lends already-parsed handles: plain opens borrow from the pool when it has
+one, and closing the Upload returns borrowed handles instead of closing them.
+"""
+import io
+import os
+import shutil
+import tempfile
+
+from pikepdf import Pdf, AccessMode
+
+import metrics
+from backends import fitz  # PyMuPDF
+
+SPOOL_THRESHOLD = 4 * 1024 * 1024  # 4MB
+_CHUNK_SIZE = 1024 * 1024
+
+
+class Upload:
+    def __init__(self, file_stream, spool_threshold=SPOOL_THRESHOLD, spool_dir=None):
+        self.path = None
+        self.data = None
+        self._owns_path = False
+        self._handles = []
+        self._pages_counted = False
+        self._pool = getattr(file_stream, "parsed_handles", None)
+        self._borrowed = []
+
+        existing = getattr(file_stream, "name", None)
+        if isinstance(file_stream, io.IOBase) and isinstance(existing, str) and os.path.isfile(existing):
+            # Already a file on disk (job inputs, CLI): use it in place.
+            self.path = existing
+            self.size = os.path.getsize(existing)
+        else:
+            self._spool(file_stream, spool_threshold, spool_dir)
+
+        if not self.size:
+            self.close()
+            raise ValueError("Empty upload or unreadable file stream")
+
+    def _spool(self, file_stream, spool_threshold, spool_dir):
+        head = file_stream.read(spool_threshold + 1)
+        if len(head) <= spool_threshold:
+            self.data = head
+            self.size = len(head)
+            return
+
+        fd, self.path = tempfile.mkstemp(suffix=".pdf", prefix="upload_", dir=spool_dir)
+        self._owns_path = True
+        with os.fdopen(fd, "wb") as f:
+            f.write(head)
+            del head
+            shutil.copyfileobj(file_stream, f, _CHUNK_SIZE)
+        self.size = os.path.getsize(self.path)
+
+    def open_pikepdf(self, **kwargs):
+        """
+        Open the upload with pikepdf. The handle is closed with the Upload.
+        """
+        if not kwargs:
+            pdf = self._borrow("pikepdf")
+            if pdf is not None:
+                self._count_pages(len(pdf.pages))
+                return pdf
+        with metrics.stage("parse"):
+            if self.path is not None:
+                pdf = Pdf.open(self.path, access_mode=AccessMode.mmap, **kwargs)
+            else:
+                pdf = Pdf.open(io.BytesIO(self.data), **kwargs)
+        self._keep("pikepdf" if not kwargs else None, pdf)
+        self._count_pages(len(pdf.pages))
+        return pdf
+
+    def open_fitz(self):
+        """
+        Open the upload with PyMuPDF. The document is closed with the Upload.
+        """
+        doc = self._borrow("fitz")
+        if doc is not None:
+            self._count_pages(doc.page_count)
+            return doc
+        with metrics.stage("parse"):
+            if self.path is not None:
+                doc = fitz.open(self.path, filetype="pdf")
+            else:
+                doc = fitz.open(stream=self.data, filetype="pdf")
+        self._keep("fitz", doc)
+        self._count_pages(doc.page_count)
+        return doc
+
+    def _borrow(self, kind):
+        if self._pool is None:
+            return None
+        handle = self._pool.checkout(kind)
+        if handle is not None:
+            self._borrowed.append((kind, handle))
+        return handle
+
+    def _keep(self, kind, handle):
+        # Handles opened for a pool go back to it on close, like borrowed ones.
+        if self._pool is not None and kind is not None:
+            self._borrowed.append((kind, handle))
+        else:
+            self._handles.append(handle)
+
+    def _count_pages(self, pages):
+        if not self._pages_counted:
+            self._pages_counted = True
+            metrics.count_pages(pages)
+
+    def close(self):
+        for handle in reversed(self._handles):
+            try:
+                handle.close()
+            except Exception:
+                pass
+        self._handles = []
+        for kind, handle in self._borrowed:
+            self._pool.checkin(kind, handle)
+        self._borrowed = []
+        self.data = None
+        if self._owns_path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self._owns_path = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
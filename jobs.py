@@ -0,0 +1,162 @@
+"""
+Background job queue for long-running PDF operations.
+
+Jobs run on a local thread pool. Every job gets its own directory under the
+store root holding the uploaded inputs, the result file and a small
+job.json with status and progress, so any web worker can answer a poll.
+Finished jobs are purged once they are older than the configured TTL. A job
+still queued or running with no sign of life for the TTL plus the job
+timeout (its worker crashed, or the pool was killed) is marked failed and
+its inputs are removed, and it is purged a TTL later like any other.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+_current = threading.local()
+
+
+def report_progress(done, total):
+    """
+    Record progress (done out of total) for the job running on this thread.
+    Does nothing when called outside of a job, so operations can call it freely.
+    """
+    job = getattr(_current, "job", None)
+    if job is not None:
+        job.store._update(job.job_id, progress={"done": done, "total": total})
+
+
+class _RunningJob:
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+
+
+class JobStore:
+    def __init__(self, root, workers=2, ttl=3600, timeout=3600):
+        self.root = root
+        self.ttl = ttl
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdfjob")
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _job_dir(self, job_id):
+        # Job ids are uuid4 hex strings; anything else never maps to a path.
+        if not job_id or len(job_id) != 32 or not job_id.isalnum():
+            return None
+        return os.path.join(self.root, job_id)
+
+    def _write_meta(self, job_id, meta):
+        job_dir = self._job_dir(job_id)
+        tmp_path = os.path.join(job_dir, "job.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(job_dir, "job.json"))
+
+    def _update(self, job_id, **changes):
+        with self._lock:
+            meta = self.status(job_id)
+            if meta is None:
+                return
+            meta.update(changes)
+            meta["updated"] = time.time()
+            self._write_meta(job_id, meta)
+
+    def submit(self, operation, func, inputs, download_name, mimetype):
+        """
+        Queue func(paths) -> file-like result and return the new job id.
+        inputs is a list of (filename, stream) pairs saved into the job directory
+        before this returns, so the request can finish immediately.
+        """
+        self.purge_expired()
+
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.root, job_id)
+        os.makedirs(job_dir)
+
+        paths = []
+        for index, (filename, stream) in enumerate(inputs):
+            path = os.path.join(job_dir, f"input_{index}{os.path.splitext(filename)[1]}")
+            with open(path, "wb") as f:
+                shutil.copyfileobj(stream, f)
+            paths.append(path)
+
+        now = time.time()
+        self._write_meta(job_id, {
+            "job_id": job_id,
+            "operation": operation,
+            "status": "queued",
+            "progress": {"done": 0, "total": None},
+            "error": None,
+            "download_name": download_name,
+            "mimetype": mimetype,
+            "created": now,
+            "updated": now,
+        })
+        self._executor.submit(self._run, job_id, func, paths)
+        return job_id
+
+    def _run(self, job_id, func, paths):
+        self._update(job_id, status="running")
+        _current.job = _RunningJob(self, job_id)
+        try:
+            result = func(paths)
+            with open(os.path.join(self._job_dir(job_id), "result"), "wb") as f:
+                shutil.copyfileobj(result, f)
+        except Exception as e:
+            self._update(job_id, status="failed", error=str(e))
+        else:
+            self._update(job_id, status="done")
+        finally:
+            _current.job = None
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def status(self, job_id):
+        job_dir = self._job_dir(job_id)
+        if job_dir is None:
+            return None
+        try:
+            with open(os.path.join(job_dir, "job.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def result_path(self, job_id):
+        """
+        Return the result file path for a finished job, or None.
+        """
+        meta = self.status(job_id)
+        if meta is None or meta["status"] != "done":
+            return None
+        return os.path.join(self._job_dir(job_id), "result")
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        for job_id in os.listdir(self.root):
+            meta = self.status(job_id)
+            if meta is None:
+                continue
+            if meta["status"] in ("done", "failed"):
+                if meta["updated"] < cutoff:
+                    shutil.rmtree(os.path.join(self.root, job_id), ignore_errors=True)
+            elif meta["updated"] < cutoff - self.timeout:
+                self._abandon(job_id)
+
+    def _abandon(self, job_id):
+        self._update(job_id, status="failed", error="Job did not finish in time")
+        job_dir = self._job_dir(job_id)
+        for name in os.listdir(job_dir):
+            if name != "job.json":
+                try:
+                    os.remove(os.path.join(job_dir, name))
+                except OSError:
+                    pass
@@ -0,0 +1,312 @@
+"""
+In-process metrics in the Prometheus text format.
+
+A small registry of counters, gauges and histograms, plus the request
+tracking the app exposes on /metrics. Every request (and background job) is
+tracked on its own thread: code anywhere below it marks explicit stages with
+stage("parse"), stage("serialize") and so on, and when the request finishes
+the time not spent in those is split into "process" (the view and the
+generation of a streamed body) and "response" (handing the body to the
+client). Metrics live in the process that records them, so with several
+server workers each worker reports its own; work done in pool processes is
+counted against the request that started it.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** n for n in range(11))  # 1KB .. 1GB
+
+# Explicitly timed stages; "process" and "response" are what is left over.
+STAGES = ("upload", "parse", "serialize")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = [
+            f"{self.name}_bucket{_format_labels(self.labels, key, [('le', _format_value(bound))])} {count}"
+            for bound, count in zip(self.buckets, counts)
+        ]
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(float(total))}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.counter("pdftoolkit_requests_total", "Finished requests.", ("route", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "pdftoolkit_request_seconds", "Request duration, including sending the body.", ("route",)
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "pdftoolkit_stage_seconds", "Time per operation stage (upload, parse, process, serialize, response).",
+    ("operation", "stage"),
+)
+IN_FLIGHT = REGISTRY.gauge("pdftoolkit_in_flight", "Requests and jobs currently running.", ("operation",))
+BYTES_IN = REGISTRY.histogram("pdftoolkit_request_bytes", "Request body size.", ("route",), SIZE_BUCKETS)
+BYTES_OUT = REGISTRY.histogram("pdftoolkit_response_bytes", "Response body size.", ("route",), SIZE_BUCKETS)
+PAGES = REGISTRY.counter("pdftoolkit_pages_processed_total", "Pages in documents opened.", ("operation",))
+ERRORS = REGISTRY.counter("pdftoolkit_errors_total", "Failed operations by exception type.", ("route", "exception"))
+
+_current = threading.local()
+
+
+class _Tracker:
+    def __init__(self, operation=None):
+        self.operation = None
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.started = time.perf_counter()
+        if operation is not None:
+            self.set_operation(operation)
+
+    def set_operation(self, operation):
+        if self.operation is None:
+            self.operation = operation
+            IN_FLIGHT.inc(operation=operation)
+
+    def finish(self, process_seconds, response_seconds=None):
+        operation = self.operation or "unmatched"
+        if self.operation is not None:
+            IN_FLIGHT.dec(operation=operation)
+        for name, seconds in self.stages.items():
+            if seconds:
+                STAGE_SECONDS.observe(seconds, operation=operation, stage=name)
+        STAGE_SECONDS.observe(max(0.0, process_seconds - sum(self.stages.values())), operation=operation, stage="process")
+        if response_seconds is not None:
+            STAGE_SECONDS.observe(max(0.0, response_seconds), operation=operation, stage="response")
+        return operation
+
+
+def set_operation(operation):
+    """Label the work on this thread, e.g. with the matched route."""
+    tracker = getattr(_current, "tracker", None)
+    if tracker is not None:
+        tracker.set_operation(operation)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one of STAGES for the work on this thread, if any."""
+    tracker = getattr(_current, "tracker", None)
+    if tracker is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        tracker.stages[name] += time.perf_counter() - started
+
+
+def count_pages(pages):
+    tracker = getattr(_current, "tracker", None)
+    if tracker is not None and tracker.operation is not None:
+        PAGES.inc(pages, operation=tracker.operation)
+
+
+def count_error(error):
+    tracker = getattr(_current, "tracker", None)
+    operation = tracker.operation if tracker is not None and tracker.operation else "unmatched"
+    ERRORS.inc(route=operation, exception=type(error).__name__)
+
+
+@contextmanager
+def track(operation):
+    """Track work done outside a request, such as a background job."""
+    tracker = _Tracker(operation)
+    previous, _current.tracker = getattr(_current, "tracker", None), tracker
+    try:
+        yield tracker
+    except Exception as e:
+        count_error(e)
+        raise
+    finally:
+        _current.tracker = previous
+        tracker.finish(time.perf_counter() - tracker.started)
+
+
+class _TrackedBody:
+    """Wraps a WSGI response body to time its generation and count its bytes."""
+
+    def __init__(self, body, view_seconds, finish):
+        self._body = body
+        self._generate_seconds = view_seconds
+        self._finish = finish
+        self._bytes = 0
+        self._closed = False
+
+    def __iter__(self):
+        iterator = iter(self._body)
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                self._generate_seconds += time.perf_counter() - started
+                return
+            self._generate_seconds += time.perf_counter() - started
+            self._bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        started = time.perf_counter()
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            self._generate_seconds += time.perf_counter() - started
+            self._finish(self._generate_seconds, self._bytes)
+
+
+class WSGIMiddleware:
+    """
+    Track every request through a WSGI app. The app names the request with
+    set_operation() (the Flask app uses its URL rule); anything unnamed is
+    reported as "unmatched".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        tracker = _Tracker()
+        _current.tracker = tracker
+        status = ["500"]
+
+        def tracking_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(" ", 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def finish(generate_seconds, bytes_out):
+            total = time.perf_counter() - tracker.started
+            if getattr(_current, "tracker", None) is tracker:
+                _current.tracker = None
+            route = tracker.finish(generate_seconds, total - generate_seconds)
+            REQUESTS.inc(route=route, method=environ.get("REQUEST_METHOD", ""), status=status[0])
+            REQUEST_SECONDS.observe(total, route=route)
+            BYTES_IN.observe(int(environ.get("CONTENT_LENGTH") or 0), route=route)
+            BYTES_OUT.observe(bytes_out, route=route)
+
+        try:
+            body = self.app(environ, tracking_start_response)
+        except Exception as e:
+            count_error(e)
+            finish(time.perf_counter() - tracker.started, 0)
+            raise
+        return _TrackedBody(body, time.perf_counter() - tracker.started, finish)
@@ -0,0 +1,195 @@
+"""
+Raster images as PDF image XObjects.
+
+sniff_image() recognises data a PDF can carry as it is: baseline and
+progressive JPEG (DCTDecode), JPEG 2000 (JPXDecode), and non-interlaced PNG
+without transparency, whose zlib data already is FlateDecode with the PNG
+predictor. Anything else goes through decode_image(), which decodes the
+image with Pillow, applies its EXIF orientation and stores the pixels
+losslessly, with any alpha channel as a soft mask. Both return a plain,
+picklable spec dict, so decoding can run in worker processes, and
+image_xobject() turns a spec into an image stream.
+"""
+import io
+import struct
+import zlib
+
+from pikepdf import Array, Dictionary, Name, Stream
+
+from backends import Image, ImageOps
+
+_JP2_SIGNATURE = b"\x00\x00\x00\x0cjP  \r\n\x87\n"
+_J2K_SIGNATURE = b"\xff\x4f\xff\x51"
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# EXIF orientations that are pure rotations can be applied when the image is
+# placed; mirrored ones need the pixels flipped, so those images are decoded.
+PLACEABLE_ORIENTATIONS = (1, 3, 6, 8)
+
+
+def _spec(width, height, data, filter, colorspace=None, bits=8, dpi=None, **extra):
+    spec = {
+        "width": width,
+        "height": height,
+        "data": data,
+        "filter": filter,
+        "colorspace": colorspace,
+        "bits": bits,
+        "dpi": dpi,
+        "orientation": 1,
+        "decode": None,
+        "decode_parms": None,
+        "palette": None,
+        "smask": None,
+    }
+    spec.update(extra)
+    return spec
+
+
+def _sane_dpi(dpi):
+    if dpi and len(dpi) == 2 and all(1 <= float(v) <= 10000 for v in dpi):
+        return float(dpi[0]), float(dpi[1])
+    return None
+
+
+def _sniff_png(data):
+    pos = len(_PNG_SIGNATURE)
+    idat = []
+    header = palette = dpi = None
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos : pos + 8])
+        body = data[pos + 8 : pos + 8 + length]
+        pos += 12 + length
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", body)
+        elif chunk_type == b"PLTE":
+            palette = body
+        elif chunk_type == b"tRNS":
+            return None
+        elif chunk_type == b"pHYs" and body[8] == 1:
+            x, y = struct.unpack(">II", body[:8])
+            dpi = _sane_dpi((x * 0.0254, y * 0.0254))
+        elif chunk_type == b"IDAT":
+            idat.append(body)
+        elif chunk_type == b"IEND":
+            break
+    if header is None or not idat:
+        return None
+
+    width, height, bits, color_type, _, _, interlace = header
+    if interlace or color_type not in (0, 2, 3) or (color_type == 3 and not palette):
+        return None
+    colors = 3 if color_type == 2 else 1
+    parms = {"Predictor": 15, "Colors": colors, "BitsPerComponent": bits, "Columns": width}
+    if color_type == 3:
+        colorspace = "indexed"
+    else:
+        colorspace = "rgb" if color_type == 2 else "gray"
+    return _spec(
+        width, height, b"".join(idat), "/FlateDecode", colorspace, bits, dpi, decode_parms=parms, palette=palette
+    )
+
+
+def sniff_image(data):
+    """
+    Return a spec embedding data unchanged, or None if the image has to be
+    decoded first. The type is taken from the data, not the file name.
+    """
+    if data.startswith(_PNG_SIGNATURE):
+        return _sniff_png(data)
+
+    is_jpeg = data.startswith(b"\xff\xd8\xff")
+    if not (is_jpeg or data.startswith(_JP2_SIGNATURE) or data.startswith(_J2K_SIGNATURE)):
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))  # reads the header only
+    except (Image.UnidentifiedImageError, OSError):
+        return None
+    dpi = _sane_dpi(img.info.get("dpi"))
+
+    if not is_jpeg:
+        return _spec(img.width, img.height, data, "/JPXDecode", dpi=dpi)
+
+    orientation = img.getexif().get(0x0112, 1)
+    if orientation not in PLACEABLE_ORIENTATIONS:
+        return None
+    if img.mode == "CMYK":
+        # Adobe CMYK JPEGs store inverted values.
+        decode = [1, 0] * 4 if "adobe" in img.info else None
+        return _spec(img.width, img.height, data, "/DCTDecode", "cmyk", dpi=dpi, orientation=orientation, decode=decode)
+    if img.mode not in ("L", "RGB"):
+        return None
+    colorspace = "gray" if img.mode == "L" else "rgb"
+    return _spec(img.width, img.height, data, "/DCTDecode", colorspace, dpi=dpi, orientation=orientation)
+
+
+def decode_image(data):
+    """
+    Decode any image Pillow can read into a lossless, upright spec.
+    Raises ValueError if the data is not a readable image.
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        dpi = _sane_dpi(img.info.get("dpi"))
+        img = ImageOps.exif_transpose(img)
+        has_alpha = "A" in img.getbands() or "transparency" in img.info
+        if img.mode not in ("L", "RGB") or has_alpha:
+            img = img.convert("RGBA" if has_alpha else "RGB")
+    except (Image.UnidentifiedImageError, OSError, ValueError):
+        raise ValueError("Unreadable image")
+
+    smask = None
+    if has_alpha:
+        smask = zlib.compress(img.getchannel("A").tobytes())
+        img = img.convert("RGB")
+    colorspace = "gray" if img.mode == "L" else "rgb"
+    return _spec(img.width, img.height, zlib.compress(img.tobytes()), "/FlateDecode", colorspace, dpi=dpi, smask=smask)
+
+
+def image_xobject(pdf, spec):
+    """
+    Return an indirect image XObject in pdf for spec.
+    """
+    image = Stream(pdf, spec["data"])
+    image.Type = Name.XObject
+    image.Subtype = Name.Image
+    image.Width = spec["width"]
+    image.Height = spec["height"]
+    image.Filter = Name(spec["filter"])
+    if spec["filter"] != "/JPXDecode":
+        image.BitsPerComponent = spec["bits"]
+        if spec["colorspace"] == "indexed":
+            palette = spec["palette"]
+            image.ColorSpace = Array([Name.Indexed, Name.DeviceRGB, len(palette) // 3 - 1, palette])
+        else:
+            image.ColorSpace = {"gray": Name.DeviceGray, "rgb": Name.DeviceRGB, "cmyk": Name.DeviceCMYK}[
+                spec["colorspace"]
+            ]
+    if spec["decode"]:
+        image.Decode = Array(spec["decode"])
+    if spec["decode_parms"]:
+        image.DecodeParms = Dictionary({f"/{key}": value for key, value in spec["decode_parms"].items()})
+    if spec["smask"] is not None:
+        mask = Stream(pdf, spec["smask"])
+        mask.Type = Name.XObject
+        mask.Subtype = Name.Image
+        mask.Width = spec["width"]
+        mask.Height = spec["height"]
+        mask.ColorSpace = Name.DeviceGray
+        mask.BitsPerComponent = 8
+        mask.Filter = Name.FlateDecode
+        image.SMask = pdf.make_indirect(mask)
+    return pdf.make_indirect(image)
+
+
+def placement_matrix(orientation, x, y, width, height):
+    """
+    The cm matrix drawing an image so that it appears upright in the
+    rectangle (x, y, width, height), given its EXIF orientation.
+    """
+    return {
+        1: (width, 0, 0, height, x, y),
+        3: (-width, 0, 0, -height, x + width, y + height),
+        6: (0, -height, width, 0, x, y + height),
+        8: (0, height, -width, 0, x + width, y),
+    }[orientation]
@@ -0,0 +1,167 @@
+"""
+Fast checks of a PDF before any real work is done on it.
+
+quick_check() reads only the cross-reference table and page tree: enough to
+know the page count and whether a password is needed, in milliseconds even
+for large files. inspect_pdf() goes on to walk every page's dictionaries and
+resources: page sizes, image XObjects (counted once each, sized by their
+encoded length) and whether the page has a text layer. Page content is only
+decoded to look for a text object, and Flate-encoded content is inflated in
+chunks only up to the first one found. Nothing is rendered.
+"""
+import re
+import zlib
+
+from pikepdf import Array, Dictionary, Name, Pdf, PasswordError, Stream
+
+# Nested Form XObjects followed when looking for images and text.
+MAX_FORM_DEPTH = 4
+# Decoded bytes inflated at a time when looking for a text object.
+_SCAN_CHUNK = 64 * 1024
+# Content is padded with a space at both ends, so every match is 4 bytes.
+_TEXT_OBJECT = re.compile(rb"[\s\]\)>]BT\s")
+
+
+def quick_check(file_stream):
+    """
+    Return {"pages", "encrypted", "needs_password"} for a PDF stream and
+    rewind it. pages is None when a password is needed. Raises pikepdf's
+    PdfError if the stream is not a readable PDF.
+    """
+    try:
+        with Pdf.open(file_stream) as pdf:
+            return {"pages": len(pdf.pages), "encrypted": pdf.is_encrypted, "needs_password": False}
+    except PasswordError:
+        return {"pages": None, "encrypted": True, "needs_password": True}
+    finally:
+        file_stream.seek(0)
+
+
+def _inherited(page, key):
+    # Resources, MediaBox, CropBox and Rotate may be set on any /Pages ancestor.
+    node, depth = page, 0
+    while node is not None and depth < 64:
+        if key in node:
+            return node[key]
+        node, depth = node.get("/Parent"), depth + 1
+    return None
+
+
+def _page_size(page):
+    box = _inherited(page, "/CropBox") or _inherited(page, "/MediaBox")
+    try:
+        x0, y0, x1, y1 = (float(value) for value in box)
+    except (TypeError, ValueError):
+        x0, y0, x1, y1 = 0, 0, 612, 792  # no usable box: readers assume Letter
+    width, height = round(abs(x1 - x0), 2), round(abs(y1 - y0), 2)
+    rotate = int(_inherited(page, "/Rotate") or 0) % 360
+    if rotate in (90, 270):
+        width, height = height, width
+    return width, height, rotate
+
+
+def _content_streams(contents):
+    if isinstance(contents, Stream):
+        return [contents]
+    if isinstance(contents, Array):
+        return [stream for stream in contents if isinstance(stream, Stream)]
+    return []
+
+
+def _decoded_chunks(stream):
+    # Unfiltered and Flate-encoded content is yielded as it is read; anything
+    # else (other filters, predictors) is decoded whole by pikepdf.
+    filters = stream.get("/Filter")
+    if isinstance(filters, Array) and len(filters) == 1:
+        filters = filters[0]
+    if filters is None:
+        yield stream.read_raw_bytes()
+    elif filters == Name.FlateDecode and stream.get("/DecodeParms") is None:
+        raw = stream.read_raw_bytes()
+        inflater = zlib.decompressobj()
+        data = inflater.decompress(raw, _SCAN_CHUNK)
+        while data:
+            yield data
+            data = inflater.decompress(inflater.unconsumed_tail, _SCAN_CHUNK)
+    else:
+        yield stream.read_bytes()
+
+
+def _draws_text(stream):
+    """Whether a content stream has a text object, stopping at the first."""
+    tail = b" "
+    try:
+        for chunk in _decoded_chunks(stream):
+            # Keep the last 3 bytes, so a BT split between chunks is found.
+            data = tail + chunk
+            if _TEXT_OBJECT.search(data):
+                return True
+            tail = data[-3:]
+    except zlib.error:
+        return False
+    return _TEXT_OBJECT.search(tail + b" ") is not None
+
+
+def _scan(resources, contents, images, depth=0, seen_forms=None):
+    """
+    Add the page's image XObjects to images ({objgen: encoded length}) and
+    return whether it draws any text, following nested forms.
+    """
+    seen_forms = set() if seen_forms is None else seen_forms
+    resources = resources if isinstance(resources, Dictionary) else Dictionary()
+    fonts = resources.get("/Font")
+    has_text = False
+    if isinstance(fonts, Dictionary) and len(fonts):
+        has_text = any(_draws_text(stream) for stream in contents)
+
+    xobjects = resources.get("/XObject")
+    if not isinstance(xobjects, Dictionary):
+        return has_text
+    for xobject in xobjects.values():
+        if not isinstance(xobject, Stream):
+            continue
+        subtype = xobject.get("/Subtype")
+        if subtype == Name.Image:
+            images[xobject.objgen] = int(xobject.get("/Length", 0))
+        elif subtype == Name.Form and depth < MAX_FORM_DEPTH and xobject.objgen not in seen_forms:
+            seen_forms.add(xobject.objgen)
+            form_text = _scan(xobject.get("/Resources"), [xobject], images, depth + 1, seen_forms)
+            has_text = has_text or form_text
+    return has_text
+
+
+def inspect_pdf(pdf):
+    """
+    Describe an open pikepdf Pdf: pages (size, rotation, image count, text
+    layer), distinct page sizes, and unique images with their total
+    encoded size.
+    """
+    pages = []
+    sizes = {}
+    images = {}
+    for number, page in enumerate(pdf.pages, start=1):
+        obj = page.obj
+        page_images = {}
+        has_text = _scan(_inherited(obj, "/Resources"), _content_streams(obj.get("/Contents")), page_images)
+        images.update(page_images)
+        width, height, rotate = _page_size(obj)
+        sizes[(width, height)] = sizes.get((width, height), 0) + 1
+        pages.append({
+            "page": number,
+            "width": width,
+            "height": height,
+            "rotate": rotate,
+            "images": len(page_images),
+            "has_text": has_text,
+        })
+    return {
+        "pages": len(pages),
+        "encrypted": pdf.is_encrypted,
+        "needs_password": False,
+        "page_sizes": [
+            {"width": width, "height": height, "pages": count} for (width, height), count in sizes.items()
+        ],
+        "text_pages": sum(page["has_text"] for page in pages),
+        "images": {"count": len(images), "bytes": sum(images.values())},
+        "page_details": pages,
+    }
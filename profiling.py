@@ -0,0 +1,242 @@
+"""
+Opt-in profiling of single requests.
+
+When PROFILE_TOKEN is configured, a request carrying the header
+"X-Profile: <token>" runs under cProfile and tracemalloc, from the moment the
+app is called until its (possibly streamed) body is closed. The capture is
+written to the profile directory as <id>.pstats, <id>.snapshot (a
+tracemalloc snapshot) and <id>.json (route, status, duration, peak traced
+memory), and the id is returned in an X-Profile-Id response header. The
+directory keeps only the most recent captures.
+
+Only one request is profiled at a time; a second one asking while a capture
+is running is served normally. Work done in pool processes or in Tesseract
+shows up as time spent waiting for them. tracemalloc sees allocations from
+every thread, so a capture taken under concurrent load includes other
+requests' memory.
+
+Without a token, or without the header, the only cost is a dictionary lookup
+per request.
+
+Run this module to summarize captured profiles:
+
+    python profiling.py [directory] [--route /ocr] [--top 25] [--sort cumulative]
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from hmac import compare_digest
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), "pdftoolkit_profiles")
+TRACEMALLOC_FRAMES = 10
+
+_capture_lock = threading.Lock()
+
+
+class _Capture:
+    def __init__(self, environ):
+        self.capture_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.meta = {
+            "id": self.capture_id,
+            "method": environ.get("REQUEST_METHOD", ""),
+            "path": environ.get("PATH_INFO", ""),
+            "status": None,
+            "started": time.time(),
+        }
+        self.profile = cProfile.Profile()
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        else:
+            tracemalloc.reset_peak()
+        self._started = time.perf_counter()
+        self.profile.enable()
+
+    def finish(self, root, max_captures):
+        self.profile.disable()
+        self.meta["seconds"] = round(time.perf_counter() - self._started, 6)
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            self.meta["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+
+        os.makedirs(root, exist_ok=True)
+        base = os.path.join(root, self.capture_id)
+        self.profile.dump_stats(base + ".pstats")
+        snapshot.dump(base + ".snapshot")
+        # The .json is written last: its presence marks a complete capture.
+        with open(base + ".json", "w") as f:
+            json.dump(self.meta, f)
+        prune(root, max_captures)
+
+
+def prune(root, max_captures):
+    """Remove the oldest captures beyond max_captures."""
+    captures = sorted(list_captures(root), key=lambda meta: meta["started"])
+    for meta in captures[: max(0, len(captures) - max_captures)]:
+        for ext in (".json", ".pstats", ".snapshot"):
+            try:
+                os.remove(os.path.join(root, meta["id"] + ext))
+            except OSError:
+                pass
+
+
+def list_captures(root):
+    """Return the metadata of every complete capture in root."""
+    captures = []
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return captures
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(root, name)) as f:
+                captures.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return captures
+
+
+class ProfilingMiddleware:
+    """
+    Profile requests through a WSGI app on demand. config is read on every
+    request for PROFILE_TOKEN, PROFILE_DIR and PROFILE_MAX_CAPTURES.
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+
+    def __call__(self, environ, start_response):
+        token = self.config.get("PROFILE_TOKEN")
+        if not token or PROFILE_HEADER not in environ:
+            return self.app(environ, start_response)
+        if not compare_digest(environ[PROFILE_HEADER].encode("utf-8"), token.encode("utf-8")):
+            return self.app(environ, start_response)
+        if not _capture_lock.acquire(blocking=False):
+            return self.app(environ, start_response)
+
+        try:
+            capture = _Capture(environ)
+        except Exception:
+            _capture_lock.release()
+            raise
+
+        def profiling_start_response(status_line, headers, exc_info=None):
+            capture.meta["status"] = int(status_line.split(" ", 1)[0])
+            headers = [*headers, ("X-Profile-Id", capture.capture_id)]
+            return start_response(status_line, headers, exc_info)
+
+        def finish():
+            try:
+                capture.finish(
+                    self.config.get("PROFILE_DIR") or DEFAULT_DIR, self.config.get("PROFILE_MAX_CAPTURES", 20)
+                )
+            finally:
+                _capture_lock.release()
+
+        try:
+            body = self.app(environ, profiling_start_response)
+        except Exception:
+            finish()
+            raise
+        return _ProfiledBody(body, finish)
+
+
+class _ProfiledBody:
+    def __init__(self, body, finish):
+        self._body = body
+        self._finish = finish
+        self._closed = False
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            self._finish()
+
+
+# ======== Summary ========
+_WORKER_WAITS = re.compile(r"_thread\.lock|\{method 'acquire'|select\.|selectors|\{method 'poll'|waitpid|communicate")
+
+
+def summarize(root, route=None, top=25, sort="cumulative", memory_lines=10):
+    """
+    Return a text report over the captures in root, optionally only those for
+    one route path: the slowest captures, the top functions of their merged
+    profile, and the biggest allocation sites of the latest snapshot.
+    """
+    captures = sorted(list_captures(root), key=lambda meta: meta["started"])
+    if route is not None:
+        captures = [meta for meta in captures if meta["path"] == route]
+    if not captures:
+        return "No profiles captured" + (f" for {route}" if route else "") + f" in {root}\n"
+
+    lines = [f"{len(captures)} capture(s) in {root}", ""]
+    lines.append(f"{'id':<26} {'method':<6} {'status':>6} {'seconds':>9} {'peak MB':>8}  path")
+    for meta in sorted(captures, key=lambda meta: meta.get("seconds", 0), reverse=True)[:top]:
+        lines.append(
+            f"{meta['id']:<26} {meta['method']:<6} {str(meta['status']):>6} {meta.get('seconds', 0):>9.3f} "
+            f"{meta.get('peak_traced_bytes', 0) / (1024 * 1024):>8.1f}  {meta['path']}"
+        )
+
+    paths = [os.path.join(root, meta["id"] + ".pstats") for meta in captures]
+    paths = [path for path in paths if os.path.exists(path)]
+    if paths:
+        stream = io.StringIO()
+        stats = pstats.Stats(*paths, stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+        lines += ["", stream.getvalue().strip("\n")]
+        waits = [
+            (func, entry[3]) for func, entry in stats.stats.items() if _WORKER_WAITS.search(pstats.func_std_string(func))
+        ]
+        waited = sum(seconds for _, seconds in waits)
+        if waited >= 0.01:
+            lines += ["", f"{waited:.3f}s spent waiting on locks, pipes and child processes "
+                          "(pool workers, Tesseract); their own work is not in this profile."]
+
+    latest = os.path.join(root, captures[-1]["id"] + ".snapshot")
+    if os.path.exists(latest):
+        snapshot = tracemalloc.Snapshot.load(latest).filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+        )
+        lines += ["", f"Largest allocations still live when {captures[-1]['id']} finished:"]
+        for stat in snapshot.statistics("lineno")[:memory_lines]:
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size / 1024:>10.1f} KiB {stat.count:>7} blocks  {frame.filename}:{frame.lineno}")
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize captured request profiles.")
+    parser.add_argument("directory", nargs="?", default=os.environ.get("PROFILE_DIR") or DEFAULT_DIR)
+    parser.add_argument("--route", help="only captures for this path, e.g. /ocr")
+    parser.add_argument("--top", type=int, default=25, help="functions and captures to list")
+    parser.add_argument("--sort", default="cumulative", choices=("cumulative", "tottime", "ncalls"))
+    args = parser.parse_args(argv)
+    print(summarize(args.directory, route=args.route, top=args.top, sort=args.sort), end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Content-addressed cache for the results of pure PDF operations.
+
+Results are stored as files named after a SHA-256 key over the input bytes,
+the operation name and its normalized parameters. Password parameters are
+folded in as an HMAC, so neither keys nor files reveal them; its key is the
+configured secret or, without one, a random key kept in the cache directory,
+so that every worker and restart using the directory computes the same keys.
+The cache is capped by total size; hits refresh a file's mtime and eviction
+removes the least recently used files first. The directory is only scanned
+when the running total of writes passes the cap, or every few hundred writes.
+A result may carry a small JSON sidecar (<key>.json) with stats reported
+while computing it, removed along with it. Everything is on disk, so worker
+processes share one cache.
+"""
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+_CHUNK_SIZE = 1024 * 1024
+# Eviction brings the cache down to this share of max_bytes, so the writes
+# that follow do not each trigger another directory scan.
+_LOW_WATER = 0.9
+# Rescan after this many writes even below the cap, to notice what other
+# processes sharing the directory have written.
+_RESCAN_WRITES = 256
+_SECRET_FILE = ".secret"
+
+
+def stream_digest(file_stream):
+    """
+    Return the SHA-256 hex digest of a seekable stream and rewind it.
+    """
+    digest = hashlib.sha256()
+    file_stream.seek(0)
+    for chunk in iter(lambda: file_stream.read(_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    file_stream.seek(0)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, root, max_bytes, secret=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = None  # size at the last scan plus this process's writes since
+        self._writes = 0
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
+        self._shared_secret = not secret and self.enabled
+        self._secret = secret or (self._load_secret(os.urandom(32)) if self.enabled else os.urandom(32))
+
+    def _load_secret(self, candidate):
+        # Publish candidate as the directory's key unless another process
+        # already has (a hard link never replaces an existing file), then
+        # use whichever key is there.
+        path = self._path(_SECRET_FILE)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(candidate)
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+        finally:
+            os.remove(tmp_path)
+        with open(path, "rb") as f:
+            return f.read()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, operation, input_digest, params=None):
+        normalized = {}
+        for name, value in (params or {}).items():
+            if "password" in name and value is not None:
+                value = hmac.new(self._secret, str(value).encode("utf-8"), hashlib.sha256).hexdigest()
+            normalized[name] = value
+        payload = json.dumps([operation, input_digest, normalized], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """
+        Return the cached result path for key, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def get_meta(self, key):
+        """
+        Return the metadata stored with key's result by put_meta(), or None.
+        """
+        if not self.enabled:
+            return None
+        try:
+            with open(self._path(key) + ".json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_meta(self, key, meta):
+        """
+        Store a JSON-serializable dict beside key's result, such as the stats
+        an operation reported while computing it. It is evicted with the result.
+        """
+        if not self.enabled:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._path(key) + ".json")
+
+    def put(self, key, file_obj):
+        """
+        Copy a file-like result into the cache and return its path, or None
+        when the cache is disabled or the result alone exceeds the size cap.
+        The source is rewound either way, so it can still be served.
+        """
+        if not self.enabled:
+            return None
+        file_obj.seek(0)
+        path = self._write(key, iter(lambda: file_obj.read(_CHUNK_SIZE), b""))
+        file_obj.seek(0)
+        return path
+
+    def tee(self, key, chunks):
+        """
+        Pass chunks through unchanged while writing them to the cache. The
+        entry is only committed if the iterator is consumed to the end.
+        """
+        if not self.enabled:
+            yield from chunks
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_")
+        committed = False
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            committed = self._commit(key, tmp_path)
+        finally:
+            if not committed:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def _write(self, key, chunks):
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp_")
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        if self._commit(key, tmp_path):
+            return self._path(key)
+        os.remove(tmp_path)
+        return None
+
+    def _commit(self, key, tmp_path):
+        size = os.path.getsize(tmp_path)
+        if size > self.max_bytes:
+            return False
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._writes += 1
+            if self._bytes is not None:
+                self._bytes += size
+            scan = self._bytes is None or self._bytes > self.max_bytes or self._writes % _RESCAN_WRITES == 0
+        if scan:
+            self._evict()
+        return True
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if entry.name.startswith(".") or entry.name.endswith(".json") or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        target = self.max_bytes if total <= self.max_bytes else self.max_bytes * _LOW_WATER
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            try:
+                os.remove(path + ".json")
+            except OSError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+        with self._lock:
+            self._bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def clear(self):
+        if self.enabled:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root, exist_ok=True)
+            if self._shared_secret:
+                self._secret = self._load_secret(self._secret)
+            with self._lock:
+                self._bytes = 0
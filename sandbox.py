@@ -0,0 +1,235 @@
+"""
+Run operations on untrusted PDFs in limited worker processes.
+
+A Sandbox keeps a small pool of worker processes, started with the "spawn"
+method so they share no locks or threads with the web worker. Each runs one
+call at a time under an address-space limit (RLIMIT_AS) and a CPU-time limit
+(RLIMIT_CPU) for that call, and the caller waits at most a wall-clock
+timeout for it. A call that finds every worker busy waits at most
+wait_seconds for one, then raises Busy. A worker is replaced after max_tasks
+calls, after running out of memory, and whenever it is killed. Every worker
+leads its own process group, so any pools it started are killed along with
+it.
+
+Calls whose function returns a generator stream its items back one at a time.
+A call that breaks a limit raises LimitExceeded in the caller; any other
+exception raised by the function is re-raised as is, or as a RuntimeError
+with the same message when it cannot be pickled.
+"""
+import atexit
+import inspect
+import multiprocessing
+import multiprocessing.util  # registers its exit handler (joining children) before ours
+import os
+import pickle
+import resource
+import signal
+import threading
+import time
+
+
+class LimitExceeded(Exception):
+    """An operation ran past the sandbox's time or memory limits."""
+
+
+class Busy(Exception):
+    """No worker became free within the sandbox's wait_seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _portable(error):
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _serve(conn, memory_bytes, cpu_seconds):
+    """Worker process main loop: run calls sent over conn until it closes."""
+    os.setpgid(0, 0)
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    while True:
+        try:
+            func, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        if cpu_seconds:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            limit = int(usage.ru_utime + usage.ru_stime + cpu_seconds) + 1
+            if cpu_hard != resource.RLIM_INFINITY:
+                limit = min(limit, cpu_hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, cpu_hard))
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isgenerator(result):
+                for item in result:
+                    conn.send(("item", item))
+                conn.send(("done", None))
+            else:
+                conn.send(("result", result))
+        except MemoryError:
+            conn.send(("memory", None))
+            return  # the heap may be fragmented or half-freed; start over
+        except BaseException as e:
+            conn.send(("error", _portable(e)))
+
+
+class _Worker:
+    def __init__(self, context, memory_bytes, cpu_seconds):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child_conn, memory_bytes, cpu_seconds), daemon=False)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class Sandbox:
+    def __init__(
+        self, workers=2, max_tasks=50, memory_bytes=1024 * 1024 * 1024, cpu_seconds=120, timeout=300, wait_seconds=30
+    ):
+        self.workers = workers
+        self.wait_seconds = wait_seconds
+        self.max_tasks = max_tasks
+        self.memory_bytes = memory_bytes
+        self.cpu_seconds = cpu_seconds
+        self.timeout = timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._busy = set()
+        self._running = 0
+        self._cond = threading.Condition()
+        # Workers are not daemonic (they may start pools of their own), so
+        # they must be gone before multiprocessing joins them at exit.
+        atexit.register(self.close)
+
+    def _checkout(self):
+        deadline = time.monotonic() + self.wait_seconds
+        with self._cond:
+            while not self._idle and self._running >= self.workers:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Busy(f"No sandbox worker became free within {self.wait_seconds} seconds", self.wait_seconds)
+                self._cond.wait(remaining)
+            self._running += 1
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            try:
+                worker = _Worker(self._context, self.memory_bytes, self.cpu_seconds)
+            except Exception:
+                self._checkin(None)
+                raise
+        with self._cond:
+            self._busy.add(worker)
+        return worker
+
+    def _checkin(self, worker, healthy=True):
+        """Return a worker after a call, retiring it if it is used up."""
+        if worker is not None:
+            with self._cond:
+                self._busy.discard(worker)
+            worker.tasks += 1
+            if not healthy:
+                worker.kill()
+            elif worker.tasks >= self.max_tasks:
+                worker.stop()
+            else:
+                with self._cond:
+                    self._idle.append(worker)
+        with self._cond:
+            self._running -= 1
+            self._cond.notify()
+
+    def _receive(self, worker, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not worker.conn.poll(remaining):
+            raise LimitExceeded(f"Operation took longer than {self.timeout} seconds")
+        try:
+            status, payload = worker.conn.recv()
+        except EOFError:
+            worker.process.join(timeout=5)
+            raise LimitExceeded(self._describe_exit(worker.process.exitcode))
+        if status == "memory":
+            raise LimitExceeded(f"Operation needed more than {self.memory_bytes // (1024 * 1024)}MB of memory")
+        return status, payload
+
+    def _describe_exit(self, exitcode):
+        if exitcode == -signal.SIGXCPU:
+            return f"Operation used more than {self.cpu_seconds} seconds of CPU time"
+        if exitcode == -signal.SIGKILL:
+            return "Operation was killed, most likely for running out of memory"
+        return f"Operation's worker process exited unexpectedly (code {exitcode})"
+
+    def call(self, func, *args, **kwargs):
+        """Return func(*args, **kwargs), run in a worker process."""
+        worker = self._checkout()
+        healthy = False  # unless the call finishes, the worker is killed
+        try:
+            worker.conn.send((func, args, kwargs))
+            status, payload = self._receive(worker, time.monotonic() + self.timeout)
+            if status == "item":
+                raise TypeError(f"{func.__name__} returned a generator; use iterate()")
+            healthy = True
+            if status == "error":
+                raise payload
+            return payload
+        finally:
+            self._checkin(worker, healthy)
+
+    def iterate(self, func, *args, **kwargs):
+        """
+        Yield the items of the generator func(*args, **kwargs), run in a worker
+        process. The timeout covers the time spent waiting for items, not the
+        time the caller holds them, so a slow consumer (a client reading a
+        streamed response) is not cut off. Closing this generator early kills
+        the worker, which would still be producing.
+        """
+        worker = self._checkout()
+        healthy = False
+        try:
+            worker.conn.send((func, args, kwargs))
+            remaining = self.timeout
+            while True:
+                started = time.monotonic()
+                status, payload = self._receive(worker, started + remaining)
+                remaining -= time.monotonic() - started
+                if status == "item":
+                    yield payload
+                    continue
+                healthy = True
+                if status == "error":
+                    raise payload
+                if status == "result":
+                    raise TypeError(f"{func.__name__} did not return a generator; use call()")
+                return
+        finally:
+            self._checkin(worker, healthy)
+
+    def close(self):
+        """Stop idle workers and kill busy ones."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            busy, self._busy = self._busy, set()
+        for worker in idle:
+            worker.stop()
+        for worker in busy:
+            worker.kill()
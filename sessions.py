@@ -0,0 +1,267 @@
+"""
+Upload-once document sessions.
+
+A DocumentStore keeps each uploaded PDF on disk under <root>/<document_id>/
+with a small document.json, so any web worker can run operations on it.
+Operations that only read a document can also reuse parsed pikepdf and
+PyMuPDF handles. Those live in a per-process ParsedCache: an LRU bounded by
+an estimate of their memory, taken to be the document's size on disk per
+handle. A handle is checked out for exclusive use and returned when the
+operation's Upload is closed, so no two requests ever share one. When an
+operation's result replaces a document, the version number goes up and
+handles for older versions are never handed out again. Documents expire once
+they have not been used for the TTL.
+"""
+import io
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from pikepdf import Pdf
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+class ParsedCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (document_id, version, kind) -> (handle, weight)
+        self._bytes = 0
+        self._versions = {}  # document_id -> newest version seen by this process
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def checkout(self, key):
+        """Take the idle handle for key out of the cache, or return None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._bytes -= entry[1]
+            self.hits += 1
+            return entry[0]
+
+    def checkin(self, key, handle, weight):
+        """Return a handle after use; it is closed if it cannot be kept."""
+        document_id, version, _ = key
+        evicted = []
+        with self._lock:
+            keep = (
+                weight <= self.max_bytes
+                and key not in self._entries
+                and version >= self._versions.get(document_id, version)
+            )
+            if keep:
+                self._versions[document_id] = version
+                self._entries[key] = (handle, weight)
+                self._bytes += weight
+                while self._bytes > self.max_bytes:
+                    _, (old, old_weight) = self._entries.popitem(last=False)
+                    self._bytes -= old_weight
+                    evicted.append(old)
+        for old in evicted if keep else [handle]:
+            _close(old)
+
+    def discard(self, document_id, newer_than=None):
+        """Close the idle handles of a document, or those older than a version."""
+        closed = []
+        with self._lock:
+            if newer_than is not None:
+                self._versions[document_id] = newer_than
+            else:
+                self._versions.pop(document_id, None)
+            for key in [key for key in self._entries if key[0] == document_id]:
+                if newer_than is None or key[1] < newer_than:
+                    handle, weight = self._entries.pop(key)
+                    self._bytes -= weight
+                    closed.append(handle)
+        for handle in closed:
+            _close(handle)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "handles": len(self._entries), "bytes": self._bytes}
+
+
+def _close(handle):
+    try:
+        handle.close()
+    except Exception:
+        pass
+
+
+class DocumentHandles:
+    """Lends the parsed handles of one document version to an Upload."""
+
+    def __init__(self, cache, document_id, version, weight):
+        self._cache = cache
+        self._key = (document_id, version)
+        self._weight = weight
+
+    def checkout(self, kind):
+        return self._cache.checkout((*self._key, kind))
+
+    def checkin(self, kind, handle):
+        self._cache.checkin((*self._key, kind), handle, self._weight)
+
+
+class DocumentStream(io.BufferedReader):
+    """
+    A stored document opened for reading. Upload uses the file in place and,
+    when parsed_handles is set, borrows parsed handles from it.
+    """
+
+    parsed_handles = None
+
+
+class DocumentStore:
+    def __init__(self, root, ttl=1800, cache_bytes=256 * 1024 * 1024):
+        self.root = root
+        self.ttl = ttl
+        self.parsed = ParsedCache(cache_bytes)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _document_dir(self, document_id):
+        # Document ids are uuid4 hex strings; anything else never maps to a path.
+        if not document_id or len(document_id) != 32 or not document_id.isalnum():
+            return None
+        return os.path.join(self.root, document_id)
+
+    def _write_meta(self, meta):
+        document_dir = self._document_dir(meta["document_id"])
+        tmp_path = os.path.join(document_dir, f"document.json.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, os.path.join(document_dir, "document.json"))
+
+    def _read_meta(self, document_id):
+        document_dir = self._document_dir(document_id)
+        if document_dir is None:
+            return None
+        try:
+            with open(os.path.join(document_dir, "document.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store_pdf(self, document_dir, chunks):
+        """
+        Write chunks to a temp file in document_dir and check it is a PDF.
+        Returns (tmp_path, size, pages).
+        """
+        tmp_path = os.path.join(document_dir, f"document.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        try:
+            with Pdf.open(tmp_path) as pdf:
+                pages = len(pdf.pages)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, os.path.getsize(tmp_path), pages
+
+    def create(self, file_stream, filename):
+        """
+        Store an uploaded PDF and return its metadata. Raises pikepdf's
+        PdfError, and keeps nothing, if the upload is not a readable PDF.
+        """
+        self.purge_expired()
+
+        document_id = uuid.uuid4().hex
+        document_dir = os.path.join(self.root, document_id)
+        os.makedirs(document_dir)
+        try:
+            chunks = iter(lambda: file_stream.read(_CHUNK_SIZE), b"")
+            tmp_path, size, pages = self._store_pdf(document_dir, chunks)
+        except Exception:
+            shutil.rmtree(document_dir, ignore_errors=True)
+            raise
+        os.replace(tmp_path, os.path.join(document_dir, "document.pdf"))
+
+        now = time.time()
+        meta = {
+            "document_id": document_id,
+            "filename": filename,
+            "size": size,
+            "pages": pages,
+            "version": 1,
+            "created": now,
+            "accessed": now,
+        }
+        self._write_meta(meta)
+        return meta
+
+    def get(self, document_id):
+        """
+        Return a document's metadata and refresh its expiry, or None if it
+        does not exist or has expired.
+        """
+        with self._lock:
+            meta = self._read_meta(document_id)
+            if meta is None:
+                return None
+            if meta["accessed"] < time.time() - self.ttl:
+                self._remove(document_id)
+                return None
+            meta["accessed"] = time.time()
+            self._write_meta(meta)
+            return meta
+
+    def path(self, meta):
+        return os.path.join(self._document_dir(meta["document_id"]), "document.pdf")
+
+    def open(self, meta, reuse_handles=False):
+        """
+        Open a document for an operation. With reuse_handles, the Upload made
+        from the stream borrows cached parsed handles; only operations that
+        never modify the document they open may ask for that.
+        """
+        stream = DocumentStream(io.FileIO(self.path(meta), "rb"))
+        if reuse_handles:
+            stream.parsed_handles = DocumentHandles(self.parsed, meta["document_id"], meta["version"], meta["size"])
+        return stream
+
+    def replace(self, document_id, chunks):
+        """
+        Make chunks (the bytes of a PDF) the new content of a document and
+        return the updated metadata, or None if the document is gone.
+        """
+        document_dir = self._document_dir(document_id)
+        tmp_path, size, pages = self._store_pdf(document_dir, chunks)
+        with self._lock:
+            meta = self._read_meta(document_id)
+            if meta is None:
+                os.remove(tmp_path)
+                return None
+            os.replace(tmp_path, os.path.join(document_dir, "document.pdf"))
+            meta.update(size=size, pages=pages, version=meta["version"] + 1, accessed=time.time())
+            self._write_meta(meta)
+        self.parsed.discard(document_id, newer_than=meta["version"])
+        return meta
+
+    def delete(self, document_id):
+        with self._lock:
+            if self._read_meta(document_id) is None:
+                return False
+            self._remove(document_id)
+            return True
+
+    def _remove(self, document_id):
+        shutil.rmtree(self._document_dir(document_id), ignore_errors=True)
+        self.parsed.discard(document_id)
+
+    def purge_expired(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for document_id in os.listdir(self.root):
+                meta = self._read_meta(document_id)
+                if meta is not None and meta["accessed"] < cutoff:
+                    self._remove(document_id)
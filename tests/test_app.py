@@ -1,6 +1,62 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
 import io
+import zipfile
+import zlib
+from unittest import mock
+
+import fitz
+import pikepdf
+from PIL import Image
+
+import admission
+import flask_app
+import metrics
+import preflight
+import profiling
+import sandbox
 from flask_app import app
+from ingest import Upload
+from result_cache import ResultCache
+
+
+def make_pdf(pages=3):
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {i + 1}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def make_image_pdf(pages=2):
+    doc = fitz.open()
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 200, 200), False)
+    pix.set_rect(pix.irect, (10, 120, 200))
+    png = pix.tobytes("png")
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_image(fitz.Rect(50, 50, 250, 250), stream=png)
+        page.insert_text((72, 400), f"Page {i + 1}")
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def count_up(n):
+    yield from range(n)
+
+
+def fake_tesseract(image_bytes):
+    digest = hashlib.md5(image_bytes).hexdigest()
+    return {"text": digest, "words": [[50, 100, 200, 25, digest]]}
+
 
 class TestPDFToolkit(unittest.TestCase):
     def setUp(self):
@@ -48,5 +104,1244 @@ class TestPDFToolkit(unittest.TestCase):
         response = self.client.post('/images_to_pdf', data={})
         self.assertEqual(response.status_code, 400)
 
+    def test_ocr_invalid_dpi(self):
+        response = self.client.post('/ocr', data={
+            'pdf': (io.BytesIO(make_pdf()), 'test.pdf'),
+            'dpi': 5000
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class TestZipResponses(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_encrypt_streams_one_entry_per_file(self):
+        response = self.client.post('/encrypt', data={
+            'pdfs': [(io.BytesIO(make_pdf()), 'a.pdf'), (io.BytesIO(make_pdf()), 'b.pdf')],
+            'password': 'test123'
+        })
+        self.assertEqual(response.status_code, 200)
+        names = zipfile.ZipFile(io.BytesIO(response.data)).namelist()
+        self.assertEqual(names, ['encrypted_a.pdf', 'encrypted_b.pdf'])
+
+    def test_decrypt_invalid_pdf_writes_error_entry(self):
+        encrypted = flask_app.encrypt_pdf(io.BytesIO(make_pdf()), 'test123')
+        response = self.client.post('/decrypt', data={
+            'pdfs': [(encrypted, 'a.pdf'), (io.BytesIO(b"not a pdf"), 'b.pdf')],
+            'password': 'test123'
+        })
+        names = zipfile.ZipFile(io.BytesIO(response.data)).namelist()
+        self.assertEqual(names, ['decrypted_a.pdf', 'error_b.pdf.txt'])
+
+    def test_batch_on_process_pool_keeps_order(self):
+        files = [(io.BytesIO(make_pdf(i + 1)), f'{i}.pdf') for i in range(5)]
+        files.insert(2, (io.BytesIO(b"not a pdf"), 'bad.pdf'))
+        with mock.patch.dict(app.config, {'BATCH_WORKERS': 2}):
+            response = self.client.post('/encrypt', data={'pdfs': files, 'password': 'test123'})
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), [
+            'encrypted_0.pdf', 'encrypted_1.pdf', 'error_bad.pdf.txt',
+            'encrypted_2.pdf', 'encrypted_3.pdf', 'encrypted_4.pdf',
+        ])
+        pdf = fitz.open(stream=archive.read('encrypted_4.pdf'), filetype="pdf")
+        self.assertTrue(pdf.needs_pass)
+        pdf.authenticate('test123')
+        self.assertEqual(len(pdf), 5)
+
+    def test_split_every_page(self):
+        response = self.client.post('/split', data={
+            'pdf': (io.BytesIO(make_pdf(3)), 'test.pdf'),
+            'pages': 'every 1 pages'
+        })
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['split_1-1.pdf', 'split_2-2.pdf', 'split_3-3.pdf'])
+        self.assertIsNone(archive.testzip())
+
+    def split(self, spec, data=None):
+        response = self.client.post('/split', data={
+            'pdf': (io.BytesIO(data or make_pdf(5)), 'test.pdf'),
+            'pages': spec
+        })
+        self.assertEqual(response.status_code, 200)
+        return zipfile.ZipFile(io.BytesIO(response.data))
+
+    def test_split_parts_are_stored_and_parallel_matches_serial(self):
+        with mock.patch.dict(app.config, {'SPLIT_WORKERS': 2}):
+            archive = self.split('every 2 pages')
+        self.assertEqual(archive.namelist(), ['split_1-2.pdf', 'split_3-4.pdf', 'split_5-5.pdf'])
+        self.assertTrue(all(info.compress_type == zipfile.ZIP_STORED for info in archive.infolist()))
+        last = fitz.open(stream=archive.read('split_5-5.pdf'), filetype="pdf")
+        self.assertEqual(last[0].get_text().strip(), "Page 5")
+
+    def test_split_odd_even(self):
+        archive = self.split('odd, even')
+        odd = fitz.open(stream=archive.read('split_odd.pdf'), filetype="pdf")
+        even = fitz.open(stream=archive.read('split_even.pdf'), filetype="pdf")
+        self.assertEqual([p.get_text().strip() for p in odd], ["Page 1", "Page 3", "Page 5"])
+        self.assertEqual(len(even), 2)
+
+    def test_split_by_bookmarks(self):
+        doc = fitz.open(stream=make_pdf(5), filetype="pdf")
+        doc.set_toc([[1, "Intro", 2], [1, "Part Two", 4]])
+        archive = self.split('bookmarks', doc.tobytes())
+        self.assertEqual(archive.namelist(), ['split_front.pdf', 'split_01_Intro.pdf', 'split_02_Part_Two.pdf'])
+        self.assertEqual(len(fitz.open(stream=archive.read('split_01_Intro.pdf'), filetype="pdf")), 2)
+
+    def test_split_by_size(self):
+        archive = self.split('size 0.01 MB', make_image_pdf(4))
+        self.assertEqual(len(archive.namelist()), 4)
+
+    def test_split_bad_ranges(self):
+        for spec in ('3-9', 'every 0 pages', 'size 0 MB', 'bookmarks'):
+            response = self.client.post('/split', data={'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'pages': spec})
+            self.assertEqual(response.status_code, 400, spec)
+            self.assertNotIn(b'Unexpected error', response.data)
+
+    def test_pdf_to_images(self):
+        response = self.client.post('/pdf_to_images', data={
+            'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf')
+        })
+        self.assertEqual(response.status_code, 200)
+        names = zipfile.ZipFile(io.BytesIO(response.data)).namelist()
+        self.assertEqual(names, ['page_1.png', 'page_2.png'])
+
+    def test_pdf_to_images_options_on_pool(self):
+        with mock.patch.dict(app.config, {'RENDER_WORKERS': 2, 'RENDER_CHUNK_PAGES': 1}):
+            response = self.client.post('/pdf_to_images', data={
+                'pdf': (io.BytesIO(make_pdf(5)), 'test.pdf'),
+                'dpi': 36,
+                'format': 'jpeg',
+                'quality': 50,
+                'pages': '2-4',
+                'colorspace': 'gray',
+            })
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['page_2.jpg', 'page_3.jpg', 'page_4.jpg'])
+        image = Image.open(io.BytesIO(archive.read('page_2.jpg')))
+        self.assertEqual((image.format, image.mode, image.width), ('JPEG', 'L', 298))
+
+    def test_pdf_to_images_bad_range(self):
+        response = self.client.post('/pdf_to_images', data={
+            'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'),
+            'pages': '3-9',
+        })
+        self.assertEqual(response.status_code, 400)
+
+    def test_extract_images_dedupes_with_manifest(self):
+        with mock.patch.dict(app.config, {'EXTRACT_WORKERS': 2}):
+            response = self.client.post('/extract_images', data={
+                'pdf': (io.BytesIO(make_image_pdf(3)), 'test.pdf')
+            })
+        archive = zipfile.ZipFile(io.BytesIO(response.data))
+        self.assertEqual(archive.namelist(), ['image_1_1.png', 'manifest.json'])
+        self.assertEqual(archive.getinfo('image_1_1.png').compress_type, zipfile.ZIP_STORED)
+        manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual(manifest['images'][0]['pages'], [1, 2, 3])
+
+    def test_extract_images_min_size(self):
+        response = self.client.post('/extract_images', data={
+            'pdf': (io.BytesIO(make_image_pdf(1)), 'test.pdf'),
+            'min_size': 500,
+        })
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(response.data)).namelist(), ['README.txt'])
+
+
+class TestExtractText(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def extract(self, **form):
+        form['pdf'] = (io.BytesIO(make_pdf(4)), 'test.pdf')
+        return self.client.post('/extract_text', data=form)
+
+    def test_plain_text_page_range(self):
+        response = self.extract(pages='2-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode().split(), ['Page', '2', 'Page', '3'])
+
+    def test_ndjson_with_words(self):
+        response = self.extract(format='ndjson', detail='words', pages='4, 1')
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([r['page'] for r in records], [4, 1])
+        self.assertEqual([w['text'] for w in records[0]['words']], ['Page', '4'])
+        self.assertEqual(len(records[0]['words'][0]['bbox']), 4)
+
+    def test_json_document(self):
+        response = self.extract(format='json', detail='blocks')
+        document = json.loads(response.data)
+        self.assertEqual(len(document['pages']), 4)
+        self.assertEqual(document['pages'][0]['blocks'][0]['text'].strip(), 'Page 1')
+
+    def test_invalid_format(self):
+        self.assertEqual(self.extract(format='xml').status_code, 400)
+
+
+class TestCompress(unittest.TestCase):
+    def make_scan(self):
+        noise = Image.frombytes("L", (600, 800), os.urandom(600 * 800)).convert("RGB")
+        png = io.BytesIO()
+        noise.save(png, "PNG")
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_image(fitz.Rect(0, 0, 150, 200), stream=png.getvalue())
+        page.insert_text((72, 400), "Scanned")
+        return doc.tobytes()
+
+    def test_preset_downsamples_and_reports_stats(self):
+        client = app.test_client()
+        response = client.post('/compress', data={
+            'pdf': (io.BytesIO(self.make_scan()), 'scan.pdf'),
+            'preset': 'screen'
+        })
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.headers['X-Compression-Stats'])
+        self.assertLess(stats['images']['after'], stats['images']['before'] / 10)
+        self.assertEqual(stats['total']['after'], len(response.data))
+
+        doc = fitz.open(stream=response.data, filetype="pdf")
+        image = doc.extract_image(doc[0].get_images()[0][0])
+        self.assertEqual((image['width'], image['colorspace']), (150, 1))
+        self.assertEqual(doc[0].get_text().strip(), "Scanned")
+
+    def test_preset_handles_nonzero_generations(self):
+        data = self.make_scan()
+        xref = fitz.open(stream=data, filetype="pdf")[0].get_images()[0][0]
+        # As after an incremental update that reused the object number.
+        data = data.replace(b'\n%d 0 obj' % xref, b'\n%d 1 obj' % xref).replace(b' %d 0 R' % xref, b' %d 1 R' % xref)
+        table = data.rindex(b'\nxref\n')
+        entry = data.index(b'\n', table + 6) + 1 + 20 * xref  # entries are 20 bytes
+        data = data[:entry + 11] + b'00001' + data[entry + 16:]
+        with pikepdf.open(io.BytesIO(data)) as pdf:
+            self.assertIn((xref, 1), [image.objgen for image in pdf.pages[0].Resources.XObject.values()])
+        for workers in (1, 2):
+            with mock.patch.dict(app.config, {'COMPRESS_WORKERS': workers}):
+                output = flask_app.compress_pdf(io.BytesIO(data), preset='screen')
+            with pikepdf.open(output) as pdf:
+                (image,) = pdf.pages[0].Resources.XObject.values()
+                self.assertEqual((int(image.Width), image.Filter), (150, pikepdf.Name.DCTDecode))
+
+    def test_font_subsetting_keeps_object_streams(self):
+        with mock.patch.object(flask_app, '_fonttools_available', return_value=True), \
+                mock.patch.object(fitz.Document, 'subset_fonts'):
+            output = flask_app.compress_pdf(io.BytesIO(self.make_scan()), preset='screen').getvalue()
+        self.assertIn(b'/ObjStm', output)
+
+    def test_stats_on_cache_hit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            client = flask_app.create_app({'TESTING': True, 'RESULT_CACHE_DIR': tmp}).test_client()
+            data = self.make_scan()
+            responses = [
+                client.post('/compress', data={'pdf': (io.BytesIO(data), 'scan.pdf'), 'preset': 'screen'})
+                for _ in range(2)
+            ]
+            self.assertEqual([r.headers['X-Cache'] for r in responses], ['MISS', 'HIT'])
+            self.assertEqual(*[json.loads(r.headers['X-Compression-Stats']) for r in responses])
+            for response in responses:
+                response.close()
+
+    def test_unknown_preset(self):
+        client = app.test_client()
+        response = client.post('/compress', data={
+            'pdf': (io.BytesIO(make_pdf()), 'a.pdf'),
+            'preset': 'tiny'
+        })
+        self.assertEqual(response.status_code, 400)
+
+
+class TestMerge(unittest.TestCase):
+    def test_dedupe_shares_resources_across_sources(self):
+        data = make_image_pdf()
+        plain = flask_app.merge_pdfs([io.BytesIO(data) for _ in range(4)])
+        deduped = flask_app.merge_pdfs([io.BytesIO(data) for _ in range(4)], dedupe=True, max_open=2)
+        self.assertLess(len(deduped.getvalue()), len(plain.getvalue()))
+
+        doc = fitz.open(stream=deduped.read(), filetype="pdf")
+        self.assertEqual(len(doc), 8)
+        self.assertEqual(len({img[0] for page in doc for img in page.get_images()}), 1)
+        self.assertEqual(doc[7].get_text().strip(), "Page 2")
+
+    def test_dedupe_keeps_annotations_per_page(self):
+        output = io.BytesIO()
+        with pikepdf.open(io.BytesIO(make_pdf(1))) as pdf:
+            link = pikepdf.Dictionary(
+                Subtype=pikepdf.Name.Link, Rect=[72, 60, 200, 80], Border=[0, 0, 0],
+                A=pikepdf.Dictionary(S=pikepdf.Name.URI, URI=pikepdf.String('https://example.com')),
+            )
+            pdf.pages[0].Annots = pdf.make_indirect(pikepdf.Array([pdf.make_indirect(link)]))
+            pdf.save(output)
+        merged = flask_app.merge_pdfs([io.BytesIO(output.getvalue()) for _ in range(2)], dedupe=True)
+        with pikepdf.open(merged) as pdf:
+            annots = [page.Annots[0].objgen for page in pdf.pages]
+        self.assertEqual(len(set(annots)), 2)
+
+    def test_bookmarks_per_source(self):
+        client = app.test_client()
+        response = client.post('/merge', data={
+            'pdfs': [(io.BytesIO(make_pdf(2)), 'first.pdf'), (io.BytesIO(make_pdf(3)), 'second.pdf')],
+            'bookmarks': 'on'
+        })
+        doc = fitz.open(stream=response.data, filetype="pdf")
+        self.assertEqual(doc.get_toc(), [[1, 'first', 1], [1, 'second', 3]])
+
+
+class TestImagesToPdf(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def convert(self, images, **options):
+        response = self.client.post('/images_to_pdf', data={
+            'images': [(io.BytesIO(data), name) for name, data in images], **options
+        })
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def image(self, fmt, mode='RGB', size=(80, 40), **kwargs):
+        img = Image.new(mode, size, 'red')
+        output = io.BytesIO()
+        img.save(output, fmt, **kwargs)
+        return output.getvalue()
+
+    def test_jpeg_and_png_embedded_unchanged(self):
+        jpeg, png = self.image('JPEG'), self.image('PNG')
+        data = self.convert([('photo.jpg', jpeg), ('misnamed.jpg', png), ('scan.bmp', self.image('BMP'))])
+        with pikepdf.Pdf.open(io.BytesIO(data)) as pdf:
+            images = [page.Resources.XObject.Im0 for page in pdf.pages]
+            self.assertEqual(images[0].read_raw_bytes(), jpeg)
+            self.assertEqual([str(image.Filter) for image in images], ['/DCTDecode', '/FlateDecode', '/FlateDecode'])
+            self.assertIn('/DecodeParms', images[1])
+
+    def test_exif_rotation_without_reencoding(self):
+        with mock.patch.dict(app.config, {'IMAGE_WORKERS': 2}):
+            img = Image.new('RGB', (80, 40), 'red')
+            exif = img.getexif()
+            exif[0x0112] = 6
+            jpeg = self.image('JPEG', exif=exif)
+            data = self.convert([('portrait.jpg', jpeg), ('flat.gif', self.image('GIF'))])
+        doc = fitz.open(stream=data, filetype="pdf")
+        self.assertEqual([tuple(page.rect)[2:] for page in doc], [(40, 80), (80, 40)])
+
+    def test_page_size_and_fit(self):
+        data = self.convert([('photo.jpg', self.image('JPEG'))], page_size='a4', fit='contain', margin=36)
+        page = fitz.open(stream=data, filetype="pdf")[0]
+        self.assertEqual(tuple(page.rect)[2:], (842, 595))
+        bbox = page.get_image_info()[0]['bbox']
+        self.assertAlmostEqual(bbox[2] - bbox[0], 770, places=0)
+
+    def test_pool_only_for_several_decodes(self):
+        jpeg, bmp = self.image('JPEG'), self.image('BMP')
+        for images, pools in (([jpeg], 0), ([jpeg, bmp, jpeg], 0), ([bmp, jpeg, bmp, bmp], 1)):
+            with mock.patch.dict(app.config, {'IMAGE_WORKERS': 2}), \
+                    mock.patch.object(flask_app, 'ProcessPoolExecutor', wraps=flask_app.ProcessPoolExecutor) as pool:
+                data = self.convert([(f'{i}.img', image) for i, image in enumerate(images)])
+            self.assertEqual(pool.call_count, pools)
+            self.assertEqual(len(fitz.open(stream=data, filetype="pdf")), len(images))
+
+    def test_unreadable_image(self):
+        response = self.client.post('/images_to_pdf', data={'images': [(io.BytesIO(b'nope'), 'x.png')]})
+        self.assertEqual(response.status_code, 400)
+
+
+class TestWatermark(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_one_shared_xobject_for_all_pages(self):
+        response = self.client.post('/watermark', data={
+            'pdf': (io.BytesIO(make_pdf(50)), 'test.pdf'),
+            'text': 'CONFIDENTIAL',
+        })
+        self.assertEqual(response.status_code, 200)
+        with pikepdf.Pdf.open(io.BytesIO(response.data)) as pdf:
+            forms = {page.Resources.XObject.Wm0.objgen for page in pdf.pages}
+            stamps = {page.Contents[-1].objgen for page in pdf.pages}
+        self.assertEqual((len(forms), len(stamps)), (1, 1))
+
+    def test_position_follows_page_rotation(self):
+        doc = fitz.open()
+        for rotation in (0, 90, 180, 270):
+            doc.new_page(width=300, height=500).set_rotation(rotation)
+        response = self.client.post('/watermark', data={
+            'pdf': (io.BytesIO(doc.tobytes()), 'test.pdf'),
+            'text': 'TOP LEFT',
+            'position': 'top-left',
+            'angle': 0,
+            'font_size': 20,
+            'opacity': 1,
+            'color': '#000000',
+        })
+        result = fitz.open(stream=response.data, filetype="pdf")
+        for page in result:
+            pix = page.get_pixmap(dpi=72, colorspace=fitz.csGRAY)
+            ink = Image.frombytes('L', (pix.width, pix.height), pix.samples).point(lambda v: 255 - v).getbbox()
+            self.assertLess(ink[3], pix.height / 4)
+            self.assertLess(ink[2], pix.width / 2)
+            self.assertGreater(ink[2] - ink[0], ink[3] - ink[1])
+
+    def test_tiled_image_on_page_range(self):
+        logo = io.BytesIO()
+        Image.new('RGBA', (40, 20), (255, 0, 0, 128)).save(logo, 'PNG')
+        response = self.client.post('/watermark', data={
+            'pdf': (io.BytesIO(make_pdf(3)), 'test.pdf'),
+            'image': (io.BytesIO(logo.getvalue()), 'logo.png'),
+            'position': 'tile',
+            'scale': 0.2,
+            'pages': '2-3',
+        })
+        self.assertEqual(response.status_code, 200)
+        doc = fitz.open(stream=response.data, filetype="pdf")
+        self.assertEqual([len(page.get_images()) for page in doc], [0, 1, 1])
+
+    def test_invalid_options(self):
+        for options in ({'opacity': 2}, {'position': 'middle'}, {'pages': '9'}):
+            response = self.client.post('/watermark', data={
+                'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'text': 'x', **options
+            })
+            self.assertEqual(response.status_code, 400)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def run_steps(self, data, steps):
+        return self.client.post('/pipeline', data={
+            'pdf': (io.BytesIO(data), 'test.pdf'),
+            'steps': json.dumps(steps),
+        })
+
+    def test_decrypt_to_encrypt_in_one_pass(self):
+        encrypted = io.BytesIO()
+        with pikepdf.Pdf.open(io.BytesIO(make_image_pdf(3))) as pdf:
+            pdf.save(encrypted, encryption=pikepdf.Encryption(owner='old', user='old'))
+        response = self.run_steps(encrypted.getvalue(), [
+            {'op': 'decrypt', 'password': 'old'},
+            {'op': 'rearrange', 'order': '3,1,2'},
+            {'op': 'rotate', 'degree': 90},
+            {'op': 'watermark', 'text': 'DRAFT', 'position': 'bottom'},
+            {'op': 'compress', 'preset': 'screen'},
+            {'op': 'encrypt', 'password': 'new'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        timings = json.loads(response.headers['X-Pipeline-Timings'])
+        self.assertEqual([t['step'] for t in timings], ['load', 'rearrange', 'rotate', 'watermark', 'compress', 'save'])
+
+        doc = fitz.open(stream=response.data, filetype="pdf")
+        self.assertTrue(doc.needs_pass)
+        self.assertTrue(doc.authenticate('new'))
+        self.assertEqual([page.get_text().split() for page in doc], [["Page", str(n), "DRAFT"] for n in (3, 1, 2)])
+        self.assertEqual([page.rotation for page in doc], [90, 90, 90])
+
+    def test_decrypted_result_is_not_cached(self):
+        encrypted = io.BytesIO()
+        with pikepdf.Pdf.open(io.BytesIO(make_pdf(2))) as pdf:
+            pdf.save(encrypted, encryption=pikepdf.Encryption(owner='old', user='old'))
+        with tempfile.TemporaryDirectory() as tmp:
+            self.client = flask_app.create_app({'TESTING': True, 'RESULT_CACHE_DIR': tmp}).test_client()
+            for _ in range(2):
+                response = self.run_steps(encrypted.getvalue(), [
+                    {'op': 'decrypt', 'password': 'old'}, {'op': 'rotate', 'degree': 90},
+                ])
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn('X-Cache', response.headers)
+                self.assertFalse(fitz.open(stream=response.data, filetype="pdf").needs_pass)
+            self.assertEqual(os.listdir(tmp), ['.secret'])  # only the cache's HMAC key
+
+            response = self.run_steps(encrypted.getvalue(), [
+                {'op': 'decrypt', 'password': 'old'}, {'op': 'encrypt', 'password': 'new'},
+            ])
+            self.assertEqual(response.headers['X-Cache'], 'MISS')
+            self.assertEqual(len(os.listdir(tmp)), 2)
+
+    def test_invalid_steps(self):
+        for steps in ([], [{'op': 'encrypt', 'password': 'x'}, {'op': 'rotate', 'degree': 90}],
+                      [{'op': 'rotate', 'degree': 45}], [{'op': 'shred'}]):
+            self.assertEqual(self.run_steps(make_pdf(2), steps).status_code, 400)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_corpus_is_deterministic(self):
+        from benchmarks import corpus
+        first, second = corpus.build('many', 'small'), corpus.build('many', 'small')
+        self.assertEqual(first, second)
+        self.assertEqual(len(fitz.open(stream=first, filetype="pdf")), 40)
+
+    def test_runs_case_and_flags_regressions(self):
+        from benchmarks import run
+        with tempfile.TemporaryDirectory() as tmp:
+            report = run.run(('small',), 'rotate_pdf[text', repeat=1, warmup=0, corpus_dir=tmp, isolate=False)
+        result = report['results']['rotate_pdf[text-small]']
+        self.assertEqual(result['pages'], 4)
+        self.assertGreater(result['output_bytes'], 0)
+
+        slower = {'results': {'rotate_pdf[text-small]': dict(result, seconds=result['seconds'] * 3 + 1)}}
+        regressed = {row[1] for row in run.compare(slower, report) if row[5]}
+        self.assertEqual(regressed, {'seconds'})
+        self.assertFalse(any(row[5] for row in run.compare(report, report)))
+
+    def test_routes_and_ocr_skip_limits_and_caches(self):
+        from benchmarks import run
+        page_caches = []
+        strict = {'CLIENT_COST_PER_MINUTE': 1, 'CLIENT_COST_BURST': 1, 'MAX_REQUEST_COST': 1}
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(app.config, strict), \
+                mock.patch.object(run, '_app', None):
+            report = run.run(
+                ('small',), 'POST /', repeat=2, warmup=1, corpus_dir=tmp, isolate=False,
+                log=lambda case, result: page_caches.append(flask_app._ocr_page_cache()),
+            )
+        errors = {case: result['error'] for case, result in report['results'].items() if 'error' in result}
+        self.assertEqual(errors, {})
+        self.assertEqual(len(report['results']), len(run.ROUTES))
+        self.assertEqual(set(page_caches), {None})
+        self.assertGreater(app.config['OCR_CACHE_MAX_BYTES'], 0)
+
+    def test_startup_loads_no_backends_for_structural_routes(self):
+        from benchmarks import startup
+        for route in ('GET /', 'POST /rotate'):
+            result = startup.sample(route)
+            self.assertEqual(result['status'], 200)
+            self.assertEqual(result['backends_loaded'], [])
+
+
+class TestAppFactory(unittest.TestCase):
+    def test_apps_have_their_own_settings_and_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            other = flask_app.create_app({
+                'TESTING': True, 'RESULT_CACHE_DIR': tmp, 'JOBS_DIR': os.path.join(tmp, 'jobs'), 'OCR_DPI': 99
+            })
+            self.assertIsNot(other.extensions['pdftoolkit']['result_cache'], flask_app.result_cache)
+            with other.app_context():
+                self.assertEqual(flask_app._setting('OCR_DPI'), 99)
+            self.assertEqual(flask_app._setting('OCR_DPI'), app.config['OCR_DPI'])
+
+            response = other.test_client().post('/rotate', data={
+                'pdf': (io.BytesIO(make_pdf(1)), 'test.pdf'), 'degree': '90'
+            })
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(other.extensions['pdftoolkit']['result_cache'].stats()['misses'], 1)
+            self.assertEqual(len(os.listdir(tmp)), 3)  # the cached result, its HMAC key and the jobs directory
+
+    def test_tesseract_probe_runs_once(self):
+        import pytesseract
+        flask_app._tesseract_version.cache_clear()
+        try:
+            with mock.patch.object(pytesseract, 'get_tesseract_version', return_value='5.3.0') as probe:
+                flask_app._ensure_tesseract_available()
+                flask_app._ensure_tesseract_available()
+            self.assertEqual(probe.call_count, 1)
+        finally:
+            flask_app._tesseract_version.cache_clear()
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_histogram_rendering(self):
+        registry = metrics.Registry()
+        seconds = registry.histogram('op_seconds', 'Op time.', ('op',), buckets=(1, 5))
+        seconds.observe(0.5, op='a"b')
+        seconds.observe(3, op='a"b')
+        text = registry.render()
+        self.assertIn('# TYPE op_seconds histogram', text)
+        self.assertIn('op_seconds_bucket{op="a\\"b",le="1"} 1', text)
+        self.assertIn('op_seconds_bucket{op="a\\"b",le="+Inf"} 2', text)
+        self.assertIn('op_seconds_sum{op="a\\"b"} 3.5', text)
+
+    def test_request_stages_pages_and_errors(self):
+        stage_count = lambda stage: (metrics.STAGE_SECONDS.value(operation='/rotate', stage=stage) or ([0], 0))[0][-1]
+        before = {stage: stage_count(stage) for stage in ('upload', 'parse', 'process', 'serialize', 'response')}
+        pages_before = metrics.PAGES.value(operation='/rotate') or 0
+        with mock.patch.object(flask_app.result_cache, 'get', return_value=None):
+            response = self.client.post('/rotate', data={
+                'pdf': (io.BytesIO(make_pdf(3)), 'test.pdf'), 'degree': '90'
+            })
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        for stage, count in before.items():
+            self.assertEqual(stage_count(stage), count + 1, stage)
+        self.assertEqual(metrics.PAGES.value(operation='/rotate'), pages_before + 3)
+
+        errors_before = metrics.ERRORS.value(route='/rotate', exception='PdfError') or 0
+        response = self.client.post('/rotate', data={
+            'pdf': (io.BytesIO(b"not a pdf"), 'test.pdf'), 'degree': '90'
+        })
+        self.assertEqual(response.status_code, 400)
+        response.close()
+        self.assertEqual(metrics.ERRORS.value(route='/rotate', exception='PdfError'), errors_before + 1)
+
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('pdftoolkit_requests_total{route="/rotate",method="POST",status="400"}', text)
+        self.assertIn('pdftoolkit_in_flight{operation="/metrics"} 1', text)
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.tmp = tempfile.mkdtemp()
+
+    def rotate(self, headers):
+        with mock.patch.dict(app.config, {
+            'PROFILE_TOKEN': 'secret', 'PROFILE_DIR': self.tmp, 'PROFILE_MAX_CAPTURES': 2
+        }), mock.patch.object(flask_app.result_cache, 'get', return_value=None):
+            response = self.client.post('/rotate', data={
+                'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'degree': '90'
+            }, headers=headers)
+            response.close()
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_capture_only_with_token_and_capped(self):
+        self.assertNotIn('X-Profile-Id', self.rotate({}).headers)
+        self.assertNotIn('X-Profile-Id', self.rotate({'X-Profile': 'wrong'}).headers)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+        ids = [self.rotate({'X-Profile': 'secret'}).headers['X-Profile-Id'] for _ in range(3)]
+        self.assertEqual(sorted(meta['id'] for meta in profiling.list_captures(self.tmp)), sorted(ids[1:]))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, ids[2] + '.pstats')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, ids[2] + '.snapshot')))
+
+        summary = profiling.summarize(self.tmp, route='/rotate')
+        self.assertIn('2 capture(s)', summary)
+        self.assertIn('handle_rotate', summary)
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.inputs = os.path.join(self.tmp.name, 'in')
+        os.makedirs(os.path.join(self.inputs, 'sub'))
+        for name in ('a.pdf', os.path.join('sub', 'b.pdf')):
+            with open(os.path.join(self.inputs, name), 'wb') as f:
+                f.write(make_pdf(2))
+        with open(os.path.join(self.inputs, 'sub', 'bad.pdf'), 'wb') as f:
+            f.write(b"not a pdf")
+
+    def test_mirrored_outputs_and_resume(self):
+        import batch
+
+        output_dir = os.path.join(self.tmp.name, 'out')
+        log = []
+        counts = batch.run('rotate', [self.inputs], {'degree': 90}, output_dir=output_dir, workers=2, log=log.append)
+        self.assertEqual(counts, {'done': 2, 'skipped': 0, 'failed': 1})
+        self.assertTrue(any('FAILED' in line and 'bad.pdf' in line for line in log))
+        with pikepdf.open(os.path.join(output_dir, 'sub', 'b.pdf')) as pdf:
+            self.assertEqual(pdf.pages[0].Rotate, 90)
+        self.assertEqual(sorted(os.listdir(os.path.join(output_dir, 'sub'))), ['b.pdf'])  # no partial files
+
+        counts = batch.run('rotate', [self.inputs], {'degree': 90}, output_dir=output_dir, log=log.append)
+        self.assertEqual(counts, {'done': 0, 'skipped': 2, 'failed': 1})
+
+    def test_side_by_side_outputs_from_glob(self):
+        import batch
+
+        pattern = os.path.join(self.inputs, '**', '[ab].pdf')
+        self.assertEqual(batch.main(['extract_text', pattern, '-o', 'fmt=ndjson', '--workers', '1']), 0)
+        with open(os.path.join(self.inputs, 'sub', 'b.extract_text.ndjson')) as f:
+            self.assertEqual(json.loads(f.readline())['text'].strip(), 'Page 1')
+        with self.assertRaises(SystemExit):
+            batch.main(['rotate', self.inputs, '-o', 'angle=90'])
+
+    def test_option_values_checked_before_processing(self):
+        import batch
+
+        for operation, option in (('compress', 'preset=bogus'), ('extract_text', 'fmt=xml'),
+                                  ('pdf_to_images', 'fmt=bmp'), ('watermark', 'position=moon')):
+            with mock.patch.object(batch, 'run') as run, mock.patch('sys.stderr', io.StringIO()), \
+                    self.assertRaises(SystemExit):
+                batch.main([operation, self.inputs, '-o', option])
+            run.assert_not_called()
+        self.assertEqual(batch.parse_options('extract_text', ['fmt=json', 'detail=words']), {
+            'fmt': 'json', 'detail': 'words'
+        })
+
+
+class TestIngest(unittest.TestCase):
+    def test_small_upload_stays_in_memory(self):
+        with Upload(io.BytesIO(make_pdf()), spool_threshold=1024 * 1024) as upload:
+            self.assertIsNone(upload.path)
+            self.assertEqual(len(upload.open_pikepdf().pages), 3)
+
+    def test_large_upload_spools_and_cleans_up(self):
+        upload = Upload(io.BytesIO(make_pdf()), spool_threshold=64)
+        self.assertTrue(os.path.exists(upload.path))
+        self.assertEqual(len(upload.open_pikepdf().pages), 3)
+        self.assertEqual(len(upload.open_fitz()), 3)
+        upload.close()
+        self.assertFalse(os.path.exists(upload.path))
+
+    def test_empty_upload(self):
+        with self.assertRaises(ValueError):
+            Upload(io.BytesIO(b""))
+
+    def test_operations_use_spooled_uploads(self):
+        with mock.patch.dict(app.config, {'UPLOAD_SPOOL_THRESHOLD': 64}):
+            rotated = flask_app.rotate_pdf(io.BytesIO(make_pdf()), 90)
+        doc = fitz.open(stream=rotated.read(), filetype="pdf")
+        self.assertEqual(doc[0].rotation, 90)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.tmp.name, max_bytes=100)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_password_never_in_key_material(self):
+        key = self.cache.key('decrypt', 'digest', {'password': 'hunter2'})
+        self.assertNotEqual(key, self.cache.key('decrypt', 'digest', {'password': 'other'}))
+        self.assertNotIn('hunter2', key)
+
+    def test_lru_eviction(self):
+        self.cache.put('a', io.BytesIO(b'a' * 40))
+        self.cache.put('b', io.BytesIO(b'b' * 40))
+        os.utime(os.path.join(self.tmp.name, 'a'), (0, 0))
+        self.cache.put('c', io.BytesIO(b'c' * 40))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 1})
+
+    def test_eviction_scans_are_incremental(self):
+        cache = ResultCache(self.tmp.name, max_bytes=1000)
+        with mock.patch('result_cache.os.scandir', wraps=os.scandir) as scandir:
+            for n in range(100):
+                cache.put(f'entry{n}', io.BytesIO(b'x' * 50))
+        self.assertLessEqual(sum(entry.stat().st_size for entry in os.scandir(self.tmp.name)), 1000)
+        self.assertLess(scandir.call_count, 50)
+        self.assertIsNotNone(cache.get('entry99'))
+
+    def test_password_keys_shared_without_a_secret(self):
+        first, second = ResultCache(self.tmp.name, max_bytes=100), ResultCache(self.tmp.name, max_bytes=100)
+        key = first.key('encrypt', 'digest', {'password': 'pw'})
+        self.assertEqual(key, second.key('encrypt', 'digest', {'password': 'pw'}))
+        self.assertNotIn('pw', key)
+        self.assertNotEqual(key, ResultCache(self.tmp.name, 100, secret=b'other').key('encrypt', 'digest', {'password': 'pw'}))
+        first.put('a', io.BytesIO(b'x' * 90))
+        first.put('b', io.BytesIO(b'x' * 90))  # evicts a, never the key
+        first.clear()
+        self.assertEqual(key, ResultCache(self.tmp.name, max_bytes=100).key('encrypt', 'digest', {'password': 'pw'}))
+
+    def test_tee_commits_only_when_complete(self):
+        chunks = self.cache.tee('partial', iter([b'x', b'y']))
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(self.cache.get('partial'))
+        self.assertEqual(b''.join(self.cache.tee('full', iter([b'x', b'y']))), b'xy')
+        self.assertIsNotNone(self.cache.get('full'))
+
+    def test_route_serves_hit_from_cache(self):
+        client = app.test_client()
+        pdf = make_pdf()
+        with mock.patch.object(flask_app, 'result_cache', self.cache), \
+                mock.patch.object(self.cache, 'max_bytes', 10 * 1024 * 1024):
+            first = client.post('/compress', data={'pdf': (io.BytesIO(pdf), 'a.pdf')})
+            with mock.patch.object(flask_app, 'compress_pdf') as compress:
+                second = client.post('/compress', data={'pdf': (io.BytesIO(pdf), 'b.pdf')})
+                compress.assert_not_called()
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+
+
+class TestSandbox(unittest.TestCase):
+    def test_limits_raise_and_workers_are_replaced(self):
+        box = sandbox.Sandbox(workers=1, max_tasks=2, memory_bytes=512 << 20, timeout=5)
+        try:
+            self.assertEqual(box.call(len, b'abc'), 3)
+            with self.assertRaises(sandbox.LimitExceeded):
+                box.call(bytearray, 1 << 30)
+            with self.assertRaises(ValueError):
+                box.call(int, 'x')
+            self.assertEqual(box.call(sum, [1, 2]), 3)
+            self.assertEqual(box._idle, [])  # retired after max_tasks calls
+
+            box.timeout = 0.5
+            with self.assertRaises(sandbox.LimitExceeded):
+                box.call(time.sleep, 5)
+        finally:
+            box.close()
+
+    def test_slow_consumer_and_busy_workers(self):
+        box = sandbox.Sandbox(workers=1, timeout=1, wait_seconds=0.2)
+        try:
+            items = box.iterate(count_up, 3)
+            self.assertEqual(next(items), 0)
+            with self.assertRaises(sandbox.Busy):
+                box.call(len, b'abc')  # the only worker is still lent to items
+            time.sleep(1.2)  # longer than the timeout, but spent holding an item
+            self.assertEqual(list(items), [1, 2])
+            self.assertEqual(box.call(len, b'abc'), 3)
+        finally:
+            box.close()
+
+    def test_routes_run_in_sandbox(self):
+        other = flask_app.create_app({'TESTING': True, 'SANDBOX': True, 'RESULT_CACHE_MAX_BYTES': 0})
+        client = other.test_client()
+        try:
+            response = client.post('/rotate', data={'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'degree': '90'})
+            self.assertEqual(response.status_code, 200)
+            with pikepdf.open(io.BytesIO(response.data)) as pdf:
+                self.assertEqual(pdf.pages[0].Rotate, 90)
+
+            response = client.post('/extract_text', data={'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf')})
+            self.assertIn(b'Page 2', response.data)
+
+            box = other.extensions['pdftoolkit']['sandbox']
+            box.close()
+            box.timeout = 0.01  # less than a new worker takes to start
+            response = client.post('/rotate', data={'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'degree': '180'})
+            self.assertEqual(response.status_code, 422)
+
+            box.timeout, box.wait_seconds, box.workers = 300, 0.1, 1
+            held = client.post('/split', data={'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'pages': '1,2'})
+            self.assertEqual(held.status_code, 200)
+            response = client.post('/rotate', data={'pdf': (io.BytesIO(make_pdf(2)), 'test.pdf'), 'degree': '90'})
+            self.assertEqual(response.status_code, 429)
+            self.assertIn('Retry-After', response.headers)
+            held.close()
+        finally:
+            other.extensions['pdftoolkit']['sandbox'].close()
+
+
+class TestAdmission(unittest.TestCase):
+    def make_app(self, **config):
+        return flask_app.create_app({'TESTING': True, 'RESULT_CACHE_MAX_BYTES': 0, **config})
+
+    def test_cost_grows_with_pages_size_and_operation(self):
+        self.assertLess(admission.estimate_cost('rotate', 0, 10), admission.estimate_cost('rotate', 0, 100))
+        self.assertLess(admission.estimate_cost('rotate', 0, 10), admission.estimate_cost('rotate', 50 << 20, 10))
+        self.assertLess(admission.estimate_cost('rotate', 0, 10), admission.estimate_cost('ocr', 0, 10))
+
+    def test_full_heavy_class_refuses_but_light_runs(self):
+        other = self.make_app(ADMISSION_HEAVY_SLOTS=1, ADMISSION_MAX_QUEUE=0)
+        heavy = other.extensions['pdftoolkit']['admission'].limiters[admission.HEAVY]
+        client = other.test_client()
+        heavy.acquire()
+        try:
+            response = client.post('/pdf_to_images', data={'pdf': (io.BytesIO(make_pdf(1)), 'test.pdf')})
+            self.assertEqual(response.status_code, 429)
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+
+            response = client.post('/rotate', data={'pdf': (io.BytesIO(make_pdf(1)), 'test.pdf'), 'degree': '90'})
+            self.assertEqual(response.status_code, 200)
+        finally:
+            heavy.release(0)
+        response = client.post('/pdf_to_images', data={'pdf': (io.BytesIO(make_pdf(1)), 'test.pdf')})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        self.assertEqual(heavy.running, 0)
+
+    def test_pipeline_with_compress_preset_is_heavy(self):
+        other = self.make_app(ADMISSION_HEAVY_SLOTS=1, ADMISSION_MAX_QUEUE=0)
+        heavy = other.extensions['pdftoolkit']['admission'].limiters[admission.HEAVY]
+        client = other.test_client()
+        heavy.acquire()
+        try:
+            for steps, status in (([{'op': 'compress', 'preset': 'screen'}], 429), ([{'op': 'compress'}], 200)):
+                response = client.post('/pipeline', data={
+                    'pdf': (io.BytesIO(make_pdf(1)), 'test.pdf'), 'steps': json.dumps(steps)
+                })
+                self.assertEqual(response.status_code, status)
+        finally:
+            heavy.release(0)
+
+    def test_queued_request_gets_slot_when_freed(self):
+        limiter = admission.ClassLimiter(1, max_waiting=1, wait_seconds=5)
+        limiter.acquire()
+        threading.Timer(0.05, limiter.release, (0.05,)).start()
+        self.assertGreater(limiter.acquire(), 0.01)
+        with self.assertRaises(admission.Rejected):
+            admission.ClassLimiter(0, max_waiting=1, wait_seconds=0.01).acquire()
+
+    def test_client_budget_is_cost_weighted(self):
+        client = self.make_app(CLIENT_COST_PER_MINUTE=60, CLIENT_COST_BURST=40).test_client()
+        for _ in range(3):
+            response = client.post('/rotate', data={'pdf': (io.BytesIO(make_pdf(3)), 'test.pdf'), 'degree': '90'})
+            self.assertEqual(response.status_code, 200)
+        response = client.post('/extract_text', data={'pdf': (io.BytesIO(make_pdf(40)), 'test.pdf')})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+
+class TestInspect(unittest.TestCase):
+    def make_app(self, **config):
+        return flask_app.create_app({'TESTING': True, 'RESULT_CACHE_MAX_BYTES': 0, **config})
+
+    def encrypted_pdf(self):
+        output = io.BytesIO()
+        with pikepdf.open(io.BytesIO(make_pdf(2))) as pdf:
+            pdf.save(output, encryption=pikepdf.Encryption(owner='secret', user='secret'))
+        return output.getvalue()
+
+    def test_report(self):
+        client = self.make_app().test_client()
+        response = client.post('/inspect', data={'pdf': (io.BytesIO(make_image_pdf(2)), 'test.pdf')})
+        self.assertEqual(response.status_code, 200)
+        report = response.get_json()
+        self.assertEqual(report['pages'], 2)
+        self.assertFalse(report['encrypted'])
+        self.assertEqual(report['page_sizes'], [{'width': 595.0, 'height': 842.0, 'pages': 2}])
+        self.assertEqual(report['text_pages'], 2)
+        self.assertEqual(report['images']['count'], 1)  # the same image on both pages
+        self.assertGreater(report['images']['bytes'], 0)
+        self.assertTrue(all(page['has_text'] and page['images'] == 1 for page in report['page_details']))
+        self.assertGreater(report['cost']['ocr'], report['cost']['rotate'])
+        self.assertEqual(report['limits']['max_pages'], 5000)
+
+        with pikepdf.open(io.BytesIO(make_pdf(1))) as pdf:
+            pdf.add_blank_page()
+            pdf.pages[1].Rotate = 90
+            pdf.pages[1].MediaBox = [0, 0, 800, 400]
+            output = io.BytesIO()
+            pdf.save(output)
+        output.seek(0)
+        details = client.post('/inspect', data={'pdf': (output, 'test.pdf')}).get_json()['page_details']
+        self.assertEqual([page['has_text'] for page in details], [True, False])
+        self.assertEqual((details[1]['width'], details[1]['height'], details[1]['rotate']), (400, 800, 90))
+
+    def test_text_scan_is_incremental(self):
+        pdf = pikepdf.new()
+        filler = b"0 0 m 10 10 l S\n" * 100000
+
+        def has_text(content, compress=True):
+            return preflight._draws_text(pdf.make_stream(zlib.compress(content) if compress else content, {
+                '/Filter': pikepdf.Name.FlateDecode
+            } if compress else {}))
+
+        inflated = []
+        decompressobj = zlib.decompressobj
+
+        def counting_decompressobj():
+            inflater = decompressobj()
+
+            class Counting:
+                unconsumed_tail = property(lambda self: inflater.unconsumed_tail)
+
+                def decompress(self, data, max_length):
+                    out = inflater.decompress(data, max_length)
+                    inflated.append(len(out))
+                    return out
+            return Counting()
+
+        with mock.patch.object(preflight.zlib, 'decompressobj', counting_decompressobj), \
+                mock.patch.object(preflight, '_SCAN_CHUNK', 1000):
+            self.assertTrue(has_text(b"q " + b"x" * 995 + b" BT /F1 9 Tf ET Q\n" + filler))
+            self.assertLessEqual(sum(inflated), 2000)  # stopped after the chunk with the BT split across it
+            self.assertFalse(has_text(filler + b"BTX xBT"))
+            self.assertTrue(has_text(filler + b"ET\nBT"))
+        self.assertTrue(has_text(b"BT ET", compress=False))
+        self.assertFalse(has_text(b"garbage", compress=False))
+        self.assertFalse(preflight._draws_text(pdf.make_stream(b"not zlib", {'/Filter': pikepdf.Name.FlateDecode})))
+
+    def test_encrypted(self):
+        client = self.make_app().test_client()
+        report = client.post('/inspect', data={'pdf': (io.BytesIO(self.encrypted_pdf()), 'test.pdf')}).get_json()
+        self.assertEqual((report['pages'], report['encrypted'], report['needs_password']), (None, True, True))
+        report = client.post('/inspect', data={
+            'pdf': (io.BytesIO(self.encrypted_pdf()), 'test.pdf'), 'password': 'secret'
+        }).get_json()
+        self.assertEqual((report['pages'], report['encrypted'], report['needs_password']), (2, True, False))
+
+    def test_early_rejection(self):
+        client = self.make_app(MAX_PAGES=10, MAX_REQUEST_COST=100).test_client()
+        response = client.post('/ocr', data={'pdf': (io.BytesIO(self.encrypted_pdf()), 'test.pdf')})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'password protected', response.data)
+
+        response = client.post('/split', data={'pdf': (io.BytesIO(make_pdf(11)), 'test.pdf')})
+        self.assertEqual(response.status_code, 413)
+
+        with mock.patch.object(flask_app, 'ocr_pdf') as ocr_pdf:
+            response = client.post('/ocr', data={'pdf': (io.BytesIO(make_pdf(6)), 'test.pdf')})
+        self.assertEqual(response.status_code, 413)
+        self.assertIn(b'/jobs/ocr', response.data)
+        ocr_pdf.assert_not_called()
+
+        response = client.post('/jobs/ocr', data={'pdf': (io.BytesIO(make_pdf(6)), 'test.pdf')})
+        self.assertEqual(response.status_code, 202)
+        response = client.post('/inspect', data={'pdf': (io.BytesIO(make_pdf(11)), 'test.pdf')})
+        self.assertEqual(response.status_code, 200)
+
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def wait_for(self, job_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = self.client.get(f'/jobs/{job_id}').get_json()
+            if status['status'] in ('done', 'failed'):
+                return status
+            time.sleep(0.05)
+        self.fail('job did not finish in time')
+
+    def test_compress_job_round_trip(self):
+        response = self.client.post('/jobs/compress', data={
+            'pdf': (io.BytesIO(make_pdf()), 'test.pdf')
+        })
+        self.assertEqual(response.status_code, 202)
+        status = self.wait_for(response.get_json()['job_id'])
+        self.assertEqual(status['status'], 'done')
+
+        result = self.client.get(status['result_url'])
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.data.startswith(b'%PDF'))
+
+    def test_job_options_match_the_synchronous_routes(self):
+        response = self.client.post('/jobs/pdf_to_images', data={
+            'pdf': (io.BytesIO(make_pdf(3)), 'test.pdf'), 'format': 'jpeg', 'quality': '50', 'pages': '2, 3',
+            'colorspace': 'gray', 'dpi': '36',
+        })
+        self.assertEqual(response.status_code, 202)
+        status = self.wait_for(response.get_json()['job_id'])
+        self.assertEqual(status['status'], 'done')
+        with zipfile.ZipFile(io.BytesIO(self.client.get(status['result_url']).data)) as zf:
+            names = zf.namelist()
+            image = Image.open(io.BytesIO(zf.read(names[0])))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(all(name.endswith('.jpg') for name in names))
+        self.assertEqual((image.format, image.mode), ('JPEG', 'L'))
+
+        data = make_image_pdf(1)
+        sizes = []
+        for form in ({}, {'preset': 'screen'}):
+            response = self.client.post('/jobs/compress', data={'pdf': (io.BytesIO(data), 'test.pdf'), **form})
+            status = self.wait_for(response.get_json()['job_id'])
+            sizes.append(len(self.client.get(status['result_url']).data))
+        self.assertLess(sizes[1], sizes[0])  # the preset downsampled the image
+
+        for operation, form in (('compress', {'preset': 'tiny'}), ('pdf_to_images', {'format': 'bmp'}),
+                                ('pdf_to_images', {'dpi': '2000'}), ('pdf_to_images', {'quality': '0'})):
+            response = self.client.post(f'/jobs/{operation}', data={'pdf': (io.BytesIO(make_pdf()), 'test.pdf'), **form})
+            self.assertEqual(response.status_code, 400, form)
+
+    def test_failed_job_reports_error(self):
+        response = self.client.post('/jobs/compress', data={
+            'pdf': (io.BytesIO(b"not a pdf"), 'test.pdf')
+        })
+        status = self.wait_for(response.get_json()['job_id'])
+        self.assertEqual(status['status'], 'failed')
+        self.assertTrue(status['error'])
+
+    def test_stuck_jobs_expire(self):
+        from jobs import JobStore
+        with tempfile.TemporaryDirectory() as tmp:
+            store = JobStore(tmp, workers=1, ttl=10, timeout=20)
+            started = threading.Event()
+            release = threading.Event()
+            running = store.submit('ocr', lambda paths: started.set() or release.wait() or io.BytesIO(),
+                                   [('a.pdf', io.BytesIO(b'%PDF'))], 'a.pdf', 'application/pdf')
+            queued = store.submit('ocr', lambda paths: io.BytesIO(), [('b.pdf', io.BytesIO(b'%PDF'))],
+                                  'b.pdf', 'application/pdf')
+            started.wait(5)
+            # The worker died: nothing has been heard from either job for long enough.
+            for job_id in (running, queued):
+                store._write_meta(job_id, dict(store.status(job_id), updated=time.time() - 31))
+            store.purge_expired()
+            for job_id in (running, queued):
+                self.assertEqual(store.status(job_id)['status'], 'failed')
+                self.assertEqual(os.listdir(os.path.join(tmp, job_id)), ['job.json'])
+            store.ttl = 0
+            store.purge_expired()
+            self.assertEqual(os.listdir(tmp), [])
+            release.set()
+
+    def test_unknown_job(self):
+        self.assertEqual(self.client.get('/jobs/' + 'a' * 32).status_code, 404)
+        self.assertEqual(self.client.get('/jobs/../etc').status_code, 404)
+
+
+class TestDocuments(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = flask_app.create_app({
+            'TESTING': True, 'DOCUMENTS_DIR': self.tmp.name, 'RESULT_CACHE_MAX_BYTES': 0,
+            'EXTRACT_WORKERS': 1, 'SPLIT_WORKERS': 1,
+        })
+        self.client = self.app.test_client()
+        self.store = self.app.extensions['pdftoolkit']['document_store']
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def upload(self, data):
+        return self.client.post('/documents', data={'pdf': (io.BytesIO(data), 'doc.pdf')})
+
+    def test_upload_once_then_edit_and_read(self):
+        response = self.upload(make_pdf(3))
+        self.assertEqual(response.status_code, 201)
+        document = response.get_json()
+        self.assertEqual((document['pages'], document['version']), (3, 1))
+        base = f"/documents/{document['document_id']}"
+
+        response = self.client.post(base + '/rotate', data={'degree': '90', 'save': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['version'], 2)
+
+        for _ in range(2):
+            response = self.client.post(base + '/extract_text')
+            self.assertIn(b'Page 3', response.get_data())
+            response.close()
+        self.assertEqual(self.store.parsed.stats()['hits'], 1)
+
+        response = self.client.post(base + '/split', data={'pages': '2'})
+        self.assertEqual(len(pikepdf.open(io.BytesIO(response.get_data())).pages), 1)
+        response.close()
+
+        response = self.client.get(base + '/download')
+        with pikepdf.open(io.BytesIO(response.get_data())) as pdf:
+            self.assertEqual(pdf.pages[0].Rotate, 90)
+        response.close()
+
+    def test_ocr_reuses_handles_and_can_save(self):
+        base = f"/documents/{self.upload(make_pdf(2)).get_json()['document_id']}"
+        self.app.config.update(OCR_WORKERS=1, OCR_CACHE_MAX_BYTES=0)
+        with mock.patch.object(flask_app, '_ensure_tesseract_available'), \
+                mock.patch.object(flask_app, '_tesseract_recognize', fake_tesseract), \
+                mock.patch.object(self.store, 'open', wraps=self.store.open) as store_open:
+            response = self.client.post(base + '/ocr')
+            response.close()
+            response = self.client.post(base + '/ocr', data={'save': '1'})
+        self.assertEqual(response.get_json()['version'], 2)
+        self.assertEqual([c.kwargs['reuse_handles'] for c in store_open.call_args_list], [True, True])
+        self.assertEqual(self.store.parsed.stats()['hits'], 1)
+
+    def test_save_needs_a_pdf_result(self):
+        base = f"/documents/{self.upload(make_pdf(1)).get_json()['document_id']}"
+        response = self.client.post(base + '/extract_text', data={'save': '1'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_invalid_and_deleted_documents(self):
+        self.assertEqual(self.upload(b'not a pdf').status_code, 400)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+        self.assertEqual(self.client.post('/documents/' + 'a' * 32 + '/rotate').status_code, 404)
+        self.assertEqual(self.client.get('/documents/../etc').status_code, 404)
+
+        document_id = self.upload(make_pdf(1)).get_json()['document_id']
+        self.assertEqual(self.client.delete(f'/documents/{document_id}').status_code, 204)
+        self.assertEqual(self.client.get(f'/documents/{document_id}').status_code, 404)
+
+    def test_idle_documents_expire(self):
+        document_id = self.upload(make_pdf(1)).get_json()['document_id']
+        self.store.ttl = 0
+        time.sleep(0.01)
+        self.assertEqual(self.client.get(f'/documents/{document_id}').status_code, 404)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+
+class TestOCR(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.app = flask_app.create_app({'TESTING': True, 'OCR_CACHE_DIR': self.tmp.name, 'OCR_CACHE_MAX_BYTES': 0})
+
+    def run_ocr(self, workers, data=None, **options):
+        with self.app.app_context(), mock.patch.object(flask_app, '_ensure_tesseract_available'), \
+                mock.patch.object(flask_app, '_tesseract_recognize', fake_tesseract):
+            output = flask_app.ocr_pdf(io.BytesIO(data or make_pdf(5)), workers=workers, dpi=50, **options)
+        return fitz.open(stream=output.read(), filetype="pdf")
+
+    def mixed_pdf(self):
+        # Text, scan, text, the same scan again.
+        scan = fitz.open(stream=make_image_pdf(1), filetype="pdf")
+        scan[0].add_redact_annot(scan[0].rect)
+        scan[0].apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE)
+        doc = fitz.open()
+        for source in (make_pdf(1), scan, make_pdf(1), scan):
+            doc.insert_pdf(source if isinstance(source, fitz.Document) else fitz.open(stream=source, filetype="pdf"))
+        return doc.tobytes()
+
+    def test_skip_text_pages_and_page_cache(self):
+        self.app.config['OCR_CACHE_MAX_BYTES'] = 1 << 20
+        data = self.mixed_pdf()
+        for workers in (1, 2):
+            stats = {}
+            output = self.run_ocr(workers, data, skip_text=True, stats=stats)
+            self.assertEqual([page.get_text().strip() for page in output][::2], ['Page 1', 'Page 1'])
+            self.assertFalse(output[2].get_images())  # copied through, not rasterized
+            self.assertEqual(output[1].get_text(), output[3].get_text())
+            self.assertEqual(stats['pages'], 4)
+            self.assertEqual(stats['skipped'], 2)
+            # The repeated scan is recognized once, then always served from the cache.
+            self.assertEqual((stats['ocr'], stats['cached']), (1, 1) if workers == 1 else (0, 2))
+
+        stats = {}
+        self.run_ocr(1, data, stats=stats)
+        self.assertEqual(stats, {'pages': 4, 'ocr': 1, 'cached': 3, 'skipped': 0})
+
+    def test_skipped_pages_share_resources(self):
+        # Text pages showing the same incompressible image, with blank scans between some.
+        png = Image.frombytes('RGB', (200, 200), os.urandom(200 * 200 * 3))
+        image = io.BytesIO()
+        png.save(image, 'PNG')
+        doc = fitz.open()
+        for i in range(8):
+            page = doc.new_page()
+            if i not in (2, 5):
+                page.insert_image(fitz.Rect(50, 50, 250, 250), stream=image.getvalue())
+                page.insert_text((72, 400), f"Page {i + 1}")
+        mixed = doc.tobytes(garbage=3, deflate=True)
+        all_text = fitz.open(stream=mixed)
+        all_text.delete_pages([2, 5])
+        all_text = all_text.tobytes(garbage=3, deflate=True)
+        with self.app.app_context(), mock.patch.object(flask_app, '_ensure_tesseract_available'), \
+                mock.patch.object(flask_app, '_tesseract_recognize', fake_tesseract):
+            output = flask_app.ocr_pdf(io.BytesIO(all_text), workers=1, dpi=50, skip_text=True).read()
+        self.assertLess(len(output), len(all_text) * 1.1)
+
+        output = self.run_ocr(1, mixed, skip_text=True)
+        shared = {xref for page in output for xref, _, width, *_ in page.get_images() if width == 200}
+        self.assertEqual(len(shared), 1)
+
+    def test_stats_on_result_cache_hit(self):
+        client = flask_app.create_app({
+            'TESTING': True, 'RESULT_CACHE_DIR': os.path.join(self.tmp.name, 'results'), 'OCR_WORKERS': 1,
+            'OCR_CACHE_MAX_BYTES': 0,
+        }).test_client()
+        data = make_pdf(2)
+        with mock.patch.object(flask_app, '_ensure_tesseract_available'), \
+                mock.patch.object(flask_app, '_tesseract_recognize', fake_tesseract):
+            responses = [
+                client.post('/ocr', data={'pdf': (io.BytesIO(data), 'test.pdf'), 'skip_text': '1'})
+                for _ in range(2)
+            ]
+        self.assertEqual([r.headers['X-Cache'] for r in responses], ['MISS', 'HIT'])
+        for response in responses:
+            self.assertEqual(json.loads(response.headers['X-OCR-Stats']), {'pages': 2, 'ocr': 0, 'cached': 0, 'skipped': 2})
+            response.close()
+
+    def test_words_form_an_invisible_text_layer(self):
+        page = self.run_ocr(1, make_pdf(1))[0]
+        (x0, y0, x1, y1, word, *_), = page.get_text('words')
+        # Boxes are in 50 dpi pixels: (50, 100) to (250, 125) is (72, 144) to (360, 180) in points.
+        self.assertEqual(len(word), 32)
+        self.assertAlmostEqual(x0, 72, delta=1)
+        self.assertAlmostEqual(x1, 360, delta=1)
+        self.assertTrue(144 <= y0 < 180 <= y1 < 190)  # on the box's baseline
+        self.assertIn(b'3 Tr', page.read_contents())
+
+    def test_ocr_keeps_page_order_in_pool(self):
+        serial = self.run_ocr(workers=1)
+        parallel = self.run_ocr(workers=2)
+        self.assertEqual(len(parallel), 5)
+        self.assertEqual(
+            [page.get_text() for page in serial],
+            [page.get_text() for page in parallel],
+        )
+        self.assertEqual(len(parallel[0].get_images()), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+"""
+Watermarking with one shared Form XObject.
+
+The watermark (text in Helvetica or an image, with its opacity state) is
+built once as a Form XObject. Every selected page gets a resource entry
+pointing at it, and a short content stream that places it. Placement streams
+are shared by all pages with the same visible box and rotation, so stamping
+thousands of same-sized pages adds a handful of objects rather than a font
+and content stream per page. Positions are worked out in the page's
+displayed orientation, so the watermark lands where the reader expects
+however the page is rotated.
+"""
+import math
+
+from pikepdf import Array, Dictionary, Name, Stream
+
+from backends import fitz  # PyMuPDF, for Helvetica metrics
+from pdfimages import decode_image, image_xobject, sniff_image
+
+POSITIONS = (
+    "center", "top-left", "top", "top-right", "left", "right",
+    "bottom-left", "bottom", "bottom-right", "tile",
+)
+MARGIN = 36  # points between the watermark and the page edge
+TILE_GAP = 72  # points between tiled copies
+
+
+def _num(value):
+    text = f"{value:.4f}".rstrip("0").rstrip(".")
+    return "0" if text in ("", "-0") else text
+
+
+def _form(pdf, content, width, height, resources):
+    form = Stream(pdf, content)
+    form.Type = Name.XObject
+    form.Subtype = Name.Form
+    form.BBox = Array([0, 0, width, height])
+    form.Resources = resources
+    return pdf.make_indirect(form)
+
+
+def _opacity_state(opacity):
+    return Dictionary(Type=Name.ExtGState, ca=opacity, CA=opacity)
+
+
+def text_watermark(pdf, text, font_size=50, color=(0.8, 0.8, 0.8), opacity=0.3):
+    """
+    Build a Form XObject with text set in Helvetica. Returns (form, width, height).
+    Characters outside WinAnsi encoding are replaced by "?".
+    """
+    text = " ".join(text.split())
+    width = fitz.get_text_length(text, fontname="helv", fontsize=font_size)
+    height = font_size * 1.2
+    encoded = text.encode("cp1252", errors="replace")
+    literal = b"(" + encoded.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+    content = (
+        f"/GS0 gs BT /F0 {_num(font_size)} Tf {' '.join(_num(c) for c in color)} rg "
+        f"1 0 0 1 0 {_num(font_size * 0.25)} Tm "
+    ).encode("ascii") + literal + b" Tj ET"
+    font = Dictionary(Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Helvetica, Encoding=Name.WinAnsiEncoding)
+    resources = Dictionary(Font=Dictionary(F0=font), ExtGState=Dictionary(GS0=_opacity_state(opacity)))
+    return _form(pdf, content, width, height, resources), width, height
+
+
+def image_watermark(pdf, image_bytes, opacity=0.3):
+    """
+    Build a Form XObject showing an image at one point per pixel. JPEG,
+    JPEG 2000 and plain PNG data is embedded as it is; other images are
+    decoded by pdfimages. Returns (form, width, height).
+    """
+    spec = sniff_image(image_bytes)
+    if spec is None or spec["orientation"] != 1:
+        spec = decode_image(image_bytes)
+    image = image_xobject(pdf, spec)
+
+    width, height = spec["width"], spec["height"]
+    content = f"/GS0 gs {width} 0 0 {height} 0 0 cm /Im0 Do".encode("ascii")
+    resources = Dictionary(
+        XObject=Dictionary(Im0=image),
+        ExtGState=Dictionary(GS0=_opacity_state(opacity)),
+    )
+    return _form(pdf, content, width, height, resources), width, height
+
+
+def _multiply(m1, m2):
+    """The matrix applying m1, then m2 (PDF's row-vector convention)."""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1 * a2 + b1 * c2, a1 * b2 + b1 * d2,
+        c1 * a2 + d1 * c2, c1 * b2 + d1 * d2,
+        e1 * a2 + f1 * c2 + e2, e1 * b2 + f1 * d2 + f2,
+    )
+
+
+def _display_matrix(box, rotate):
+    """
+    Return (matrix, width, height): the matrix from displayed page space
+    (origin bottom-left of the page as shown) to user space, and the
+    displayed size.
+    """
+    x0, y0, x1, y1 = box
+    w, h = x1 - x0, y1 - y0
+    a, b, c, d, e, f = {
+        0: (1, 0, 0, 1, 0, 0),
+        90: (0, 1, -1, 0, w, 0),
+        180: (-1, 0, 0, -1, w, h),
+        270: (0, -1, 1, 0, 0, h),
+    }[rotate]
+    if rotate in (90, 270):
+        w, h = h, w
+    return (a, b, c, d, e + x0, f + y0), w, h
+
+
+def _anchors(position, page_width, page_height, half_width, half_height):
+    """Centre points, in displayed page space, for every copy of the watermark."""
+    if position == "tile":
+        step_x = 2 * half_width + TILE_GAP
+        step_y = 2 * half_height + TILE_GAP
+        count_x = math.ceil(page_width / 2 / step_x)
+        count_y = math.ceil(page_height / 2 / step_y)
+        return [
+            (page_width / 2 + i * step_x, page_height / 2 + j * step_y)
+            for j in range(-count_y, count_y + 1)
+            for i in range(-count_x, count_x + 1)
+        ]
+
+    vertical, _, horizontal = position.rpartition("-")
+    if position in ("left", "right"):
+        vertical, horizontal = "", position
+    elif position in ("top", "bottom"):
+        vertical, horizontal = position, ""
+    x = {
+        "left": MARGIN + half_width,
+        "right": page_width - MARGIN - half_width,
+    }.get(horizontal, page_width / 2)
+    y = {
+        "top": page_height - MARGIN - half_height,
+        "bottom": MARGIN + half_height,
+    }.get(vertical, page_height / 2)
+    return [(x, y)]
+
+
+def _placement(name, box, rotate, width, height, position, angle, relative_width):
+    """Content stream commands drawing XObject name on one page geometry."""
+    to_user, page_width, page_height = _display_matrix(box, rotate)
+    scale = relative_width * page_width / width if relative_width else 1.0
+    cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    half_width = scale * (abs(cos) * width + abs(sin) * height) / 2
+    half_height = scale * (abs(sin) * width + abs(cos) * height) / 2
+
+    placed = _multiply(
+        (scale, 0, 0, scale, -scale * width / 2, -scale * height / 2),
+        (cos, sin, -sin, cos, 0, 0),
+    )
+    commands = []
+    for x, y in _anchors(position, page_width, page_height, half_width, half_height):
+        matrix = _multiply(_multiply(placed, (1, 0, 0, 1, x, y)), to_user)
+        commands.append(f"q {' '.join(_num(v) for v in matrix)} cm {name} Do Q")
+    return "\n".join(commands)
+
+
+def stamp_pages(pdf, form, width, height, page_indexes, position="center", angle=0, relative_width=None):
+    """
+    Place form on the given pages, above their content. relative_width, if
+    given, scales each copy to that fraction of the displayed page width;
+    otherwise the form is drawn at its own size.
+    """
+    if position not in POSITIONS:
+        raise ValueError(f"Position must be one of {', '.join(POSITIONS)}")
+    pages = [pdf.pages[i] for i in sorted(set(page_indexes))]
+
+    used = set()
+    for page in pages:
+        xobjects = page.obj.get("/Resources", Dictionary()).get("/XObject", Dictionary())
+        used.update(str(key) for key in xobjects.keys())
+    index = 0
+    while f"/Wm{index}" in used:
+        index += 1
+    name = Name(f"/Wm{index}")
+
+    open_state = pdf.make_indirect(Stream(pdf, b"q"))
+    stamps = {}
+    for page in pages:
+        box = tuple(float(v) for v in page.cropbox)
+        rotate = int(page.obj.get("/Rotate", 0)) % 360
+        geometry = (box, rotate)
+        if geometry not in stamps:
+            commands = _placement(name, box, rotate, width, height, position, angle, relative_width)
+            content = "Q\n" + commands
+            stamps[geometry] = pdf.make_indirect(Stream(pdf, content.encode("ascii")))
+
+        if "/Resources" not in page.obj:
+            page.obj.Resources = Dictionary()
+        resources = page.obj.Resources
+        if "/XObject" not in resources:
+            resources.XObject = Dictionary()
+        resources.XObject[name] = form
+
+        contents = page.obj.get("/Contents")
+        if contents is None:
+            parts = []
+        elif isinstance(contents, Array):
+            parts = list(contents)
+        else:
+            parts = [contents]
+        page.obj.Contents = Array([open_state, *parts, stamps[geometry]])
@@ -0,0 +1,83 @@
+"""
+Streaming ZIP writer.
+
+zipfile.ZipFile writes entries with data descriptors when its target is not
+seekable, so the archive can be produced front to back. iter_zip() feeds
+ZipFile such a target and hands back whatever has been written after every
+entry, which lets a response start with the first file and never hold more
+than one entry in memory. Writing entries is timed as the "serialize" stage
+of the request metrics; producing them is not.
+"""
+import io
+import shutil
+import time
+import zipfile
+
+import metrics
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable buffer that is drained between entries."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Yield a ZIP archive as bytes chunks, one (or more) chunk per entry.
+
+    entries is an iterable of (arcname, data) or (arcname, data, compress_type)
+    tuples where data is bytes or a readable binary file object. It is consumed
+    lazily, so entries can be produced on demand.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression) as zip_file:
+        for entry in entries:
+            arcname, data = entry[0], entry[1]
+            compress_type = entry[2] if len(entry) > 2 else compression
+            with metrics.stage("serialize"):
+                if isinstance(data, (bytes, bytearray, memoryview)):
+                    zip_file.writestr(arcname, data, compress_type=compress_type)
+                else:
+                    info = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+                    info.external_attr = 0o600 << 16
+                    info.compress_type = compress_type
+                    with zip_file.open(info, "w") as dest:
+                        shutil.copyfileobj(data, dest, 1024 * 1024)
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+    chunk = sink.drain()
+    if chunk:
+        yield chunk
+
+
+def zip_to_buffer(entries, compression=zipfile.ZIP_DEFLATED):
+    """
+    Collect iter_zip() output into a BytesIO, for callers that need a file.
+    """
+    output = io.BytesIO()
+    for chunk in iter_zip(entries, compression):
+        output.write(chunk)
+    output.seek(0)
+    return output